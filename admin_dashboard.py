@@ -2,58 +2,43 @@
 """
 Simple Admin Dashboard for Wazuh Rules API
 """
-import sqlite3
-from datetime import datetime
 import json
+import time
+import asyncio
+from datetime import datetime, timedelta
 
-def get_stats():
-    """Get database statistics"""
-    conn = sqlite3.connect('deployments.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # Server statistics
-    cursor.execute("SELECT COUNT(*) as total_servers FROM servers")
-    total_servers = cursor.fetchone()['total_servers']
-    
-    cursor.execute("SELECT COUNT(*) as active_servers FROM servers WHERE is_active = 1")
-    active_servers = cursor.fetchone()['active_servers']
-    
-    cursor.execute("SELECT COUNT(*) as total_keys FROM api_keys WHERE active = 1")
-    total_keys = cursor.fetchone()['total_keys']
-    
-    # Deployment statistics
-    cursor.execute("SELECT COUNT(*) as total_deployments FROM deployments")
-    total_deployments = cursor.fetchone()['total_deployments']
-    
-    cursor.execute("SELECT COUNT(*) as successful_deployments FROM deployments WHERE success = 1")
-    successful_deployments = cursor.fetchone()['successful_deployments']
+from models import config, get_db_connection
+from schema import migrate, ROLLUP_TIME_BOUNDS, ROLLUP_HISTOGRAM, FLEET
+
+dashboard_config = config.get('dashboard', {})
+CACHE_TTL = dashboard_config.get('cache_ttl', 5)  # seconds a worker reuses a snapshot
+KEEPALIVE = dashboard_config.get('keepalive', 15)  # seconds between SSE comments
+RECENT_DEPLOYMENTS = 5
+MAX_PAGE_SIZE = 1000
+HISTORY_QUANTILE = 0.95
+HISTORY_DAYS = 7  # days of history the dashboard prints
+
+def fleet_stats(conn):
+    """Counters and the latest deployments, from fleet_stats rather than counting"""
+    counters = conn.execute("SELECT * FROM fleet_stats WHERE id = 1").fetchone()
     
-    # Recent deployments
-    cursor.execute("""
+    # Newest by rowid: no sort over the whole table
+    recent = conn.execute("""
         SELECT server_id, timestamp, success, file_count
-        FROM deployments 
-        ORDER BY timestamp DESC 
-        LIMIT 5
-    """)
-    recent = [dict(row) for row in cursor.fetchall()]
-    
-    # Server list
-    cursor.execute("""
-        SELECT server_id, description, last_seen, is_active
-        FROM servers 
-        ORDER BY last_seen DESC
-    """)
-    servers = [dict(row) for row in cursor.fetchall()]
-    
-    conn.close()
+        FROM deployments
+        ORDER BY id DESC
+        LIMIT ?
+    """, (RECENT_DEPLOYMENTS,)).fetchall()
     
+    total_deployments = counters['deployments_total']
+    successful_deployments = counters['deployments_successful']
     return {
         "generated": datetime.now().isoformat(),
+        "version": counters['changes'],
         "servers": {
-            "total": total_servers,
-            "active": active_servers,
-            "api_keys": total_keys
+            "total": counters['servers_total'],
+            "active": counters['servers_active'],
+            "api_keys": counters['api_keys_active']
         },
         "deployments": {
             "total": total_deployments,
@@ -61,13 +46,94 @@ def get_stats():
             "failed": total_deployments - successful_deployments,
             "success_rate": (successful_deployments / total_deployments * 100) if total_deployments > 0 else 0
         },
-        "recent_deployments": recent,
-        "server_list": servers
+        "recent_deployments": [dict(row) for row in recent]
     }
 
-def print_dashboard():
+SERVER_PAGE_QUERY = """
+    SELECT server_id, description, last_seen, is_active
+    FROM servers
+    ORDER BY last_seen DESC
+    LIMIT ? OFFSET ?
+"""
+
+def server_page(conn, limit=50, offset=0):
+    """One page of servers, most recently seen first"""
+    rows = conn.execute(SERVER_PAGE_QUERY, (limit, offset)).fetchall()
+    total = conn.execute("SELECT servers_total FROM fleet_stats WHERE id = 1").fetchone()[0]
+    return {"total": total, "offset": offset, "limit": limit, "servers": [dict(row) for row in rows]}
+
+def histogram_quantile(counts, q, time_max):
+    """Deployment time at quantile q, interpolated within its histogram bucket"""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = ROLLUP_TIME_BOUNDS[index - 1] if index else 0.0
+            upper = ROLLUP_TIME_BOUNDS[index] if index < len(ROLLUP_TIME_BOUNDS) else time_max
+            return min(lower + (upper - lower) * (rank - seen) / count, time_max)
+        seen += count
+    return time_max
+
+DEPLOYMENT_HISTORY_QUERY = """
+    SELECT * FROM deployment_rollups
+    WHERE period = ? AND server_id = ? AND bucket >= ?
+    ORDER BY bucket
+"""
+
+def deployment_history(conn, period="day", server_id=FLEET, since=""):
+    """Deployments per hour or day from the rollups, never the raw rows"""
+    rows = conn.execute(DEPLOYMENT_HISTORY_QUERY, (period, server_id, since)).fetchall()
+    return [{
+        "bucket": row['bucket'],
+        "total": row['total'],
+        "successful": row['successful'],
+        "failed": row['total'] - row['successful'],
+        "files": row['files'],
+        "avg_time": row['time_sum'] / row['total'],
+        "p95_time": histogram_quantile([row[column] for column in ROLLUP_HISTOGRAM], HISTORY_QUANTILE, row['time_max']),
+        "max_time": row['time_max']
+    } for row in rows]
+
+def get_stats(server_limit=50):
+    """Get database statistics"""
+    conn = get_db_connection()
+    try:
+        migrate(conn)
+        stats = fleet_stats(conn)
+        stats["server_list"] = server_page(conn, server_limit)["servers"]
+        since = (datetime.now() - timedelta(days=HISTORY_DAYS - 1)).date().isoformat()
+        stats["history"] = deployment_history(conn, "day", FLEET, since)
+    finally:
+        conn.close()
+    return stats
+
+class DashboardCache:
+    """fleet_stats() shared by a worker's requests for CACHE_TTL seconds"""
+
+    def __init__(self, database, ttl=CACHE_TTL):
+        self.database = database
+        self.ttl = ttl
+        self._stats = None
+        self._expires = 0.0
+        self._lock = None
+
+    async def get(self):
+        if self._stats is None or time.monotonic() >= self._expires:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            # One query however many requests arrive while it runs
+            async with self._lock:
+                if self._stats is None or time.monotonic() >= self._expires:
+                    self._stats = await self.database.run(fleet_stats)
+                    self._expires = time.monotonic() + self.ttl
+        return self._stats
+
+def print_dashboard(server_limit=50):
     """Print a simple dashboard"""
-    stats = get_stats()
+    stats = get_stats(server_limit)
     
     print("=" * 60)
     print("WAZUH RULES API - ADMIN DASHBOARD")
@@ -101,6 +167,15 @@ def print_dashboard():
             print(f"{status} {dep['server_id']} - {dep['file_count']} files - {dep['timestamp'][:19]}")
         print()
     
+    # Daily history
+    if stats['history']:
+        print(f"LAST {HISTORY_DAYS} DAYS")
+        print("-" * 40)
+        for day in stats['history']:
+            print(f"{day['bucket']}  {day['total']:6} deployments  {day['failed']:4} failed  "
+                  f"avg {day['avg_time']:.2f}s  p95 {day['p95_time']:.2f}s")
+        print()
+    
     # Server list
     if stats['server_list']:
         print("REGISTERED SERVERS")
@@ -109,6 +184,8 @@ def print_dashboard():
             status = "ACTIVE" if server['is_active'] else "INACTIVE"
             last_seen = server['last_seen'][:19] if server['last_seen'] else "Never"
             print(f"{server['server_id']:20} {status:10} Last: {last_seen}")
+        if stats['servers']['total'] > len(stats['server_list']):
+            print(f"... and {stats['servers']['total'] - len(stats['server_list'])} more")
     
     print("=" * 60)
 
@@ -116,10 +193,11 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--json", action="store_true", help="Output as JSON")
+    parser.add_argument("--servers", type=int, default=50, help="Most recently seen servers to list")
     args = parser.parse_args()
     
     if args.json:
-        stats = get_stats()
+        stats = get_stats(args.servers)
         print(json.dumps(stats, indent=2))
     else:
-        print_dashboard()
+        print_dashboard(args.servers)
@@ -1,29 +1,79 @@
-from fastapi import FastAPI, HTTPException, Depends
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 from datetime import datetime
-import sqlite3
+import asyncio
 import os
 
+from storage import db, writer
+from auth import revocations
+from schema import migrate
+from maintenance import maintenance
+from ratelimit import RATE_LIMIT_ENABLED, RateLimitMiddleware
+from utils.git_sync import SYNC_ENABLED, sync_worker
+from utils.repo_index import repo_index, record_revision_time, PUBLISH_ENABLED
+from utils.rule_index import rule_index
+from utils.publisher import publisher
+from utils.revision_watch import revision_watch, raise_fd_limit
+from utils.admission import transfer_gate
+from utils.metrics import METRICS_ENABLED, MetricsMiddleware, collect_exited, render
+from utils.profiler import ProfilerMiddleware, request_profiler
+from routes.rules import precompute_packages
+
+@asynccontextmanager
+async def lifespan(app):
+    await db.run(migrate)
+    await db.run(revocations.load)
+    writer.start()
+    if METRICS_ENABLED:
+        collect_exited()
+    repo_index.add_listener(record_revision_time)
+    repo_index.add_listener(precompute_packages)
+    repo_index.add_listener(rule_index.update)
+    repo_index.add_listener(revision_watch.notify)
+    loop = asyncio.get_running_loop()
+    revision_watch.attach(loop)
+    request_profiler.attach(loop)
+    raise_fd_limit()
+    if SYNC_ENABLED:
+        # Fetch the branch (in one worker) before the first scan
+        await loop.run_in_executor(None, sync_worker.start)
+    if PUBLISH_ENABLED:
+        # Validate and publish the working tree before serving it
+        await loop.run_in_executor(None, publisher.start)
+    await loop.run_in_executor(None, repo_index.refresh)
+    watchers = [
+        asyncio.create_task(repo_index.watch()),
+        asyncio.create_task(request_profiler.watch()),
+        asyncio.create_task(maintenance.watch()),
+        asyncio.create_task(revocations.watch())
+    ]
+    if SYNC_ENABLED:
+        watchers.append(asyncio.create_task(sync_worker.watch()))
+    if PUBLISH_ENABLED:
+        watchers.append(asyncio.create_task(publisher.watch()))
+    yield
+    for watcher in watchers:
+        watcher.cancel()
+    request_profiler.stop()
+    await writer.stop()
+    db.close()
+
 app = FastAPI(
     title="Wazuh Rules API",
     description="Centralized API for Wazuh rules distribution",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
-security = HTTPBearer()
-
-def verify_api_key(api_key: str) -> dict:
-    """Simple API key verification"""
-    conn = sqlite3.connect('deployments.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT key, server_id FROM api_keys WHERE key = ? AND active = 1", (api_key,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
-    return {"key": result[0], "server_id": result[1]}
+# Switched on and off at runtime through /api/admin/profile
+app.add_middleware(ProfilerMiddleware)
+if RATE_LIMIT_ENABLED:
+    app.add_middleware(RateLimitMiddleware)
+if METRICS_ENABLED:
+    # Outermost, so rate-limited requests are timed too
+    app.add_middleware(MetricsMiddleware)
 
 @app.get("/")
 async def root():
@@ -34,9 +84,18 @@ async def root():
         "timestamp": datetime.now().isoformat(),
         "endpoints": [
             "/health",
+            "/metrics",
+            "/api/auth/token",
             "/api/rules/list",
             "/api/rules/package",
-            "/api/rules/stats"
+            "/api/rules/search",
+            "/api/rules/watch",
+            "/api/rules/validation",
+            "/api/rules/stats",
+            "/api/admin/profile",
+            "/api/admin/dashboard",
+            "/api/admin/servers",
+            "/api/admin/history"
         ]
     }
 
@@ -45,15 +104,14 @@ async def health_check():
     """Health check endpoint"""
     try:
         # Test database connection
-        conn = sqlite3.connect('deployments.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1")
-        conn.close()
+        await db.fetchone("SELECT 1")
         
         return {
             "status": "healthy",
             "timestamp": datetime.now().isoformat(),
-            "database": "connected"
+            "database": "connected",
+            # This worker's package transfers: in progress, retry backlog, rejections
+            "transfers": transfer_gate.stats()
         }
     except Exception as e:
         return {
@@ -62,9 +120,17 @@ async def health_check():
             "timestamp": datetime.now().isoformat()
         }
 
+if METRICS_ENABLED:
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics():
+        """Prometheus metrics, summed over all workers"""
+        return PlainTextResponse(await run_in_threadpool(render), media_type="text/plain; version=0.0.4")
+
 # Import and include routes
-from routes import rules
+from routes import admin, auth, rules
+app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
 app.include_router(rules.router, prefix="/api/rules", tags=["rules"])
+app.include_router(admin.router, prefix="/api/admin", tags=["admin"])
 
 if __name__ == "__main__":
     import uvicorn
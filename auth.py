@@ -1,40 +1,252 @@
 """
 Authentication module
 """
-import sqlite3
-from fastapi import HTTPException
-
-def verify_api_key(api_key: str) -> dict:
-    """Verify API key against database"""
-    if not api_key:
-        raise HTTPException(status_code=401, detail="No API key provided")
-    
-    conn = sqlite3.connect('deployments.db')
-    cursor = conn.cursor()
-    
-    # Check if key exists and is active
-    cursor.execute("""
-        SELECT key, server_id, is_admin 
-        FROM api_keys 
-        WHERE key = ? AND active = 1
-    """, (api_key,))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import jwt
+from fastapi import HTTPException, Depends
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+
+from models import config, get_db_connection
+from storage import db
+from utils.metrics import AUTH_SECONDS
+
+logger = logging.getLogger(__name__)
+security = HTTPBearer()
+
+auth_config = config.get('auth', {})
+SECRET_KEY = auth_config.get('secret_key', '')
+TOKEN_EXPIRY = auth_config.get('token_expiry', 15)  # minutes
+KEY_CACHE_TTL = auth_config.get('key_cache_ttl', 60)  # seconds
+NEGATIVE_CACHE_TTL = auth_config.get('negative_cache_ttl', 10)  # seconds
+REVOCATION_POLL = auth_config.get('revocation_poll', 5)  # seconds before other workers see a revocation
+KEY_CACHE_SIZE = 10000
+JWT_ALGORITHM = "HS256"
+# Secrets shipped in this repository's config files: anyone could sign
+# tokens (admin ones included) with them
+PUBLIC_SECRETS = {
+    "",
+    "your-secret-key-change-in-production",
+    "changeme-in-production-please-change",
+    "change-this-to-a-secure-random-key",
+    "dev-secret-key-change-in-production",
+}
+
+def tokens_enabled() -> bool:
+    """Access tokens are issued and accepted only with a private secret_key"""
+    return SECRET_KEY not in PUBLIC_SECRETS
+
+if not tokens_enabled():
+    logger.warning("auth.secret_key is empty or a published default; access tokens are disabled")
+
+class KeyCache:
+    """In-process TTL cache of API key lookups, including misses"""
+
+    def __init__(self, max_size=KEY_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # api_key -> (expires_at, info or None)
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        """Return (hit, info); info is None for a cached miss"""
+        with self._lock:
+            entry = self._entries.get(api_key)
+            if entry is None:
+                return False, None
+            if entry[0] < time.monotonic():
+                del self._entries[api_key]
+                return False, None
+            return True, entry[1]
+
+    def put(self, api_key, info, ttl):
+        with self._lock:
+            self._entries[api_key] = (time.monotonic() + ttl, info)
+            self._entries.move_to_end(api_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, api_key=None):
+        """Forget one key, or every key when api_key is None"""
+        with self._lock:
+            if api_key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(api_key, None)
+
+    def invalidate_hash(self, key_hash):
+        """Forget the key with this SHA-256 (revoked in another worker, which only shares the hash)"""
+        with self._lock:
+            for api_key in [api_key for api_key in self._entries if key_digest(api_key) == key_hash]:
+                del self._entries[api_key]
+
+def key_digest(api_key: str) -> str:
+    """api_keys.key_hash of a key"""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+def key_id(key_hash: str) -> str:
+    """The "kid" claim naming a key in its tokens, without embedding it"""
+    return key_hash[:16]
+
+key_cache = KeyCache()
+
+REVOKED_SINCE_QUERY = "SELECT key_hash, revoked_at FROM api_keys WHERE revoked_at > ?"
+
+class Revocations:
+    """Keys revoked in any worker, so their tokens and cached lookups stop working.
+
+    Tokens are checked without the database, and each worker caches keys
+    for KEY_CACHE_TTL; a revocation only matters for as long as either can
+    outlive it. Every REVOCATION_POLL seconds the keys revoked within that
+    window are read back from api_keys.revoked_at: tokens issued for them
+    before the revocation are rejected and their cache entries dropped.
+    """
+
+    def __init__(self):
+        self.window = max(TOKEN_EXPIRY * 60, KEY_CACHE_TTL) + REVOCATION_POLL
+        self._revoked = {}  # kid -> revoked_at
+
+    def add(self, key_hash, revoked_at):
+        kid = key_id(key_hash)
+        if self._revoked.get(kid) != revoked_at:
+            self._revoked[kid] = revoked_at
+            key_cache.invalidate_hash(key_hash)
+
+    def is_revoked(self, kid, issued_at):
+        revoked_at = self._revoked.get(kid)
+        return revoked_at is not None and issued_at <= revoked_at
+
+    def load(self, conn):
+        """Pick up revocations made within the window, and forget older ones"""
+        cutoff = time.time() - self.window
+        for key_hash, revoked_at in conn.execute(REVOKED_SINCE_QUERY, (cutoff,)).fetchall():
+            self.add(key_hash, revoked_at)
+        self._revoked = {kid: revoked_at for kid, revoked_at in self._revoked.items() if revoked_at > cutoff}
+
+    async def watch(self):
+        """Follow revocations made by other workers in the background"""
+        while True:
+            await asyncio.sleep(REVOCATION_POLL)
+            try:
+                await db.run(self.load)
+            except Exception as e:
+                logger.error(f"Revocation check failed: {e}")
+
+revocations = Revocations()
+
+API_KEY_QUERY = """
+    SELECT key, server_id, is_admin
+    FROM api_keys
+    WHERE key = ? AND active = 1
+"""
+
+def key_info_from_row(result):
+    """Turn an api_keys row into the dict handed to endpoints"""
     if not result:
-        raise HTTPException(status_code=401, detail="Invalid or inactive API key")
-    
+        return None
+
     return {
         "key": result[0],
         "server_id": result[1],
         "is_admin": bool(result[2])
     }
 
-def is_admin(api_key: str) -> bool:
-    """Check if API key has admin privileges"""
+async def api_key_info(api_key: str):
+    """Return (cached, info) for an API key; info is None unless the key is active.
+
+    Lookups, misses included, are cached in-process; only a cache miss goes
+    to the database, through the async pool.
+    """
+    hit, info = key_cache.get(api_key)
+    if not hit:
+        info = key_info_from_row(await db.fetchone(API_KEY_QUERY, (api_key,)))
+        key_cache.put(api_key, info, KEY_CACHE_TTL if info else NEGATIVE_CACHE_TTL)
+    return hit, info
+
+def issue_token(key_info: dict) -> dict:
+    """Sign a short-lived access token for a verified API key"""
+    if not tokens_enabled():
+        raise HTTPException(status_code=503, detail="Access tokens are disabled: auth.secret_key is not set")
+    now = int(time.time())
+    expires_in = TOKEN_EXPIRY * 60
+    token = jwt.encode({
+        "sub": key_info['server_id'],
+        "adm": key_info['is_admin'],
+        "kid": key_id(key_digest(key_info['key'])),
+        "iat": now,
+        "exp": now + expires_in
+    }, SECRET_KEY, algorithm=JWT_ALGORITHM)
+
+    return {
+        "access_token": token,
+        "token_type": "bearer",
+        "expires_in": expires_in
+    }
+
+def verify_token(token: str) -> dict:
+    """Validate an access token without touching the database"""
+    if not tokens_enabled():
+        raise HTTPException(status_code=401, detail="Invalid token")
     try:
-        info = verify_api_key(api_key)
-        return info.get('is_admin', False)
-    except:
-        return False
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if revocations.is_revoked(claims.get('kid'), claims.get('iat', 0)):
+        raise HTTPException(status_code=401, detail="Token revoked")
+
+    return {
+        "server_id": claims['sub'],
+        "is_admin": bool(claims.get('adm', False))
+    }
+
+async def require_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    """FastAPI dependency accepting either an API key or an access token.
+
+    Tokens and cached keys are checked on the event loop; only a key cache
+    miss goes to the database, through the async pool.
+    """
+    credential = credentials.credentials
+    start = time.perf_counter()
+    if credential.count(".") == 2:
+        try:
+            return verify_token(credential)
+        finally:
+            AUTH_SECONDS.labels("token").observe(time.perf_counter() - start)
+
+    hit, info = await api_key_info(credential)
+    AUTH_SECONDS.labels("key_cache" if hit else "key_database").observe(time.perf_counter() - start)
+
+    if not info:
+        raise HTTPException(status_code=401, detail="Invalid or inactive API key")
+    return info
+
+async def require_admin(server_info: dict = Depends(require_api_key)) -> dict:
+    """FastAPI dependency for admin-only endpoints"""
+    if not server_info.get('is_admin'):
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    return server_info
+
+REVOKE_KEY_QUERY = "UPDATE api_keys SET active = 0, revoked_at = ? WHERE key = ?"
+
+def revoke_api_key(api_key: str) -> bool:
+    """Deactivate an API key; its tokens and cached lookups stop working in every worker"""
+    revoked_at = time.time()
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(REVOKE_KEY_QUERY, (revoked_at, api_key))
+        conn.commit()
+        revoked = cursor.rowcount > 0
+    finally:
+        conn.close()
+
+    key_cache.invalidate(api_key)
+    if revoked:
+        revocations.add(key_digest(api_key), revoked_at)
+    logger.info(f"API key revoked: {revoked}")
+    return revoked
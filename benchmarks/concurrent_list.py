@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Concurrent /api/rules/list benchmark
+
+Start the API (e.g. `uvicorn app:app --port 8000`) and run:
+
+    python3 benchmarks/concurrent_list.py --key <api key> --concurrency 32
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def run(url, key, concurrency, total):
+    headers = {"Authorization": f"Bearer {key}"}
+    local = threading.local()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one_request(_):
+        nonlocal errors
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            ok = session.get(f"{url}/api/rules/list", headers=headers, timeout=30).status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+
+    # Warm up connections and caches
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_request, range(concurrency)))
+    latencies.clear()
+    errors = 0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_request, range(total)))
+    wall = time.perf_counter() - start
+
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput_rps": total / wall,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent /api/rules/list benchmark")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--key", required=True, help="API key or access token")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    result = run(args.url.rstrip("/"), args.key, args.concurrency, args.requests)
+    for name, value in result.items():
+        print(f"{name:16} {value:,.2f}" if isinstance(value, float) else f"{name:16} {value}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,621 @@
+#!/usr/bin/env python3
+"""
+Fleet load test: thousands of simulated managers running the puller's requests
+
+Each simulated manager sends what WazuhAPIPuller.run() sends: /health,
+/api/auth/token, /api/rules/list, then /api/rules/delta (once it has a
+deployed commit), /api/rules/manifest plus /api/rules/files, and
+/api/rules/package, each conditional on what it deployed the round before,
+honouring Retry-After on 429/503. --strategy package skips straight to the
+package, as older pullers did. Managers start each round all at once
+(--arrival cron, spread over --jitter seconds) or spread over the whole
+--period (--arrival uniform).
+
+With --spawn the API is started here (uvicorn or gunicorn, --workers) on a
+copy of this tree, against a synthetic git repository of --rule-files files
+with --rules-per-file rules, and --change-every N commits a change every N
+rounds. Otherwise point it at a running API with --url and --key (and
+--server-pid for CPU/RSS):
+
+    python3 benchmarks/fleet_load.py --spawn uvicorn --workers 4 --managers 2000 \\
+        --rounds 3 --period 60 --arrival cron --jitter 5 --rule-files 200 --change-every 1
+
+Latency percentiles, throughput, status counts and errors are reported per
+endpoint. Server CPU is sampled from /proc and shared out between the
+endpoints in flight during each sample; peak RSS is the largest total seen
+while an endpoint had requests in flight. The client runs on the same
+machine, so its own CPU time is reported too.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import resource
+import secrets
+import shutil
+import sqlite3
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from urllib.parse import urlencode, urlsplit
+
+import yaml
+
+ROOT = Path(__file__).parent.parent
+ENDPOINTS = ["health", "token", "list", "delta", "manifest", "files", "package"]
+PACKAGE_ACCEPT = "application/zstd;q=1.0, application/x-xz;q=0.9, application/gzip;q=0.5, application/zip;q=0.1"
+SAMPLE_INTERVAL = 0.2  # seconds between /proc samples
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+class HTTPError(Exception):
+    pass
+
+class Client:
+    """Minimal HTTP/1.1 client: one connection per request, like the puller's requests.get"""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.timeout = timeout
+        self.ssl = None
+        if parts.scheme == "https":
+            # The puller defaults to verify_ssl false
+            self.ssl = ssl.create_default_context()
+            self.ssl.check_hostname = False
+            self.ssl.verify_mode = ssl.CERT_NONE
+
+    async def request(self, method, path, headers=None, body=None, keep_body=True):
+        """(status, headers, body or None, bytes received)"""
+        return await asyncio.wait_for(self._request(method, path, headers or {}, body, keep_body), self.timeout)
+
+    async def _request(self, method, path, headers, body, keep_body):
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl, limit=1 << 20)
+        try:
+            lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                     "Connection: close", "Accept-Encoding: identity"]
+            lines += [f"{name}: {value}" for name, value in headers.items()]
+            if body is not None:
+                lines += ["Content-Type: application/json", f"Content-Length: {len(body)}"]
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + (body or b""))
+
+            head = await reader.readuntil(b"\r\n\r\n")
+            status_line, *header_lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+            status = int(status_line.split()[1])
+            response_headers = {}
+            for line in header_lines:
+                name, _, value = line.partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+
+            parts = []
+            received = 0
+
+            async def take(data):
+                nonlocal received
+                received += len(data)
+                if keep_body:
+                    parts.append(data)
+
+            if method == "HEAD" or status in (204, 304):
+                pass
+            elif "content-length" in response_headers:
+                remaining = int(response_headers["content-length"])
+                while remaining:
+                    data = await reader.read(min(remaining, 65536))
+                    if not data:
+                        raise HTTPError("connection closed mid-body")
+                    remaining -= len(data)
+                    await take(data)
+            elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+                while True:
+                    size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+                    if size == 0:
+                        while (await reader.readline()) not in (b"\r\n", b""):
+                            pass
+                        break
+                    await take(await reader.readexactly(size))
+                    await reader.readexactly(2)
+            else:
+                while data := await reader.read(65536):
+                    await take(data)
+            return status, response_headers, b"".join(parts) if keep_body else None, received
+        finally:
+            writer.close()
+
+class Recorder:
+    """Per-endpoint latencies, statuses and bytes, plus what is in flight"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.in_flight = defaultdict(int)
+        self.sequences = []
+        self.failed_sequences = 0
+
+    def start(self, endpoint):
+        self.in_flight[endpoint] += 1
+        return time.perf_counter()
+
+    def finish(self, endpoint, started, status=None, received=0, error=None):
+        self.in_flight[endpoint] -= 1
+        self.latencies[endpoint].append(time.perf_counter() - started)
+        self.bytes[endpoint] += received
+        if error is not None:
+            self.errors[endpoint] += 1
+            self.statuses[endpoint][type(error).__name__] += 1
+        else:
+            self.statuses[endpoint][status] += 1
+            if status >= 500 and status != 503:
+                self.errors[endpoint] += 1
+
+class ProcSampler:
+    """CPU and RSS of a server process and its children, from /proc"""
+
+    def __init__(self, pid, recorder):
+        self.pid = pid
+        self.recorder = recorder
+        self.cpu = defaultdict(float)  # endpoint -> server CPU seconds while it was in flight
+        self.peak_rss = defaultdict(int)
+        self.total_cpu = 0.0
+        self.max_rss = 0
+
+    def _pids(self):
+        children = defaultdict(list)
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+                children[ppid].append(int(entry))
+        pids, queue = [], [self.pid]
+        while queue:
+            pid = queue.pop()
+            pids.append(pid)
+            queue.extend(children.get(pid, ()))
+        return pids
+
+    def read(self):
+        """(CPU seconds, RSS bytes) summed over the process tree"""
+        cpu = rss = 0
+        for pid in self._pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                with open(f"/proc/{pid}/statm") as f:
+                    resident = int(f.read().split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            cpu += (int(fields[11]) + int(fields[12])) / CLK_TCK
+            rss += resident * PAGE_SIZE
+        return cpu, rss
+
+    async def run(self):
+        last_cpu, _ = self.read()
+        while True:
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            cpu, rss = self.read()
+            used, last_cpu = cpu - last_cpu, cpu
+            self.total_cpu += used
+            self.max_rss = max(self.max_rss, rss)
+            busy = {endpoint: n for endpoint, n in self.recorder.in_flight.items() if n > 0}
+            if not busy:
+                self.cpu["(idle)"] += used
+            for endpoint, n in busy.items():
+                self.cpu[endpoint] += used * n / sum(busy.values())
+                self.peak_rss[endpoint] = max(self.peak_rss[endpoint], rss)
+
+class Manager:
+    """One simulated Wazuh manager and what it deployed last"""
+
+    def __init__(self, index, api_key, client, recorder, args):
+        self.index = index
+        self.api_key = api_key
+        self.client = client
+        self.recorder = recorder
+        self.args = args
+        self.state = {}
+        self.files = None  # path -> sha256 deployed, when known
+
+    async def call(self, endpoint, method, path, headers=None, body=None, keep_body=True, retry=True):
+        """One request, waiting out 429/503 where the puller does; None on a transport error"""
+        headers = dict(headers or {}, **{"User-Agent": f"Wazuh-Puller/load-{self.index}"})
+        attempts = self.args.max_retries + 1 if retry else 1
+        for attempt in range(attempts):
+            started = self.recorder.start(endpoint)
+            try:
+                status, response_headers, content, received = await self.client.request(
+                    method, path, headers, body, keep_body
+                )
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, HTTPError, ValueError) as e:
+                self.recorder.finish(endpoint, started, error=e)
+                return None
+            self.recorder.finish(endpoint, started, status, received)
+            if status not in (429, 503) or attempt == attempts - 1:
+                return status, response_headers, content
+            try:
+                delay = float(response_headers.get("retry-after", ""))
+            except ValueError:
+                delay = 30.0
+            if delay > self.args.max_retry_after:
+                return status, response_headers, content
+            await asyncio.sleep(delay + random.uniform(0, self.args.retry_jitter))
+
+    def deployed(self, headers):
+        self.state['revision'] = headers.get("x-ruleset-revision") or self.state.get('revision')
+        self.state['commit'] = headers.get("x-ruleset-commit") or self.state.get('commit')
+        self.state['subset'] = headers.get("x-ruleset-subset")
+
+    async def sync(self, auth):
+        """Delta, then manifest and files; True when done, False to fall back to the package"""
+        if self.state.get('commit'):
+            result = await self.call("delta", "GET", "/api/rules/delta?" + urlencode({"since": self.state['commit']}),
+                                     auth, keep_body=False)
+            if result and result[0] in (200, 304) and result[1].get("x-ruleset-subset") == self.state.get('subset'):
+                if result[0] == 200:
+                    self.deployed(result[1])
+                    self.files = None
+                return True
+
+        headers = dict(auth)
+        if self.state.get('revision'):
+            subset = f"-s{self.state['subset']}" if self.state.get('subset') else ""
+            headers["If-None-Match"] = f'"{self.state["revision"]}{subset}"'
+        result = await self.call("manifest", "GET", "/api/rules/manifest", headers)
+        if result is None or result[0] not in (200, 304):
+            return False
+        if result[0] == 304:
+            return True
+        manifest = json.loads(result[2])
+        remote = {entry['path']: entry['sha256'] for entry in manifest['files']}
+        local = self.files or {}
+        changed = sorted(path for path, sha in remote.items() if local.get(path) != sha)
+        if changed:
+            result = await self.call("files", "POST", "/api/rules/files", auth,
+                                     json.dumps({"files": changed}).encode(), keep_body=False)
+            if result is None or result[0] != 200:
+                return False
+        self.state.update(revision=manifest.get('revision'), commit=manifest.get('commit'),
+                          subset=manifest.get('subset'))
+        self.files = remote
+        return True
+
+    async def run(self):
+        """One puller run; returns True if the manager ended up on the served revision"""
+        key_auth = {"Authorization": f"Bearer {self.api_key}"}
+        result = await self.call("health", "GET", "/health", key_auth, retry=False)
+        if result is None or result[0] != 200:
+            return False
+
+        auth = key_auth
+        result = await self.call("token", "POST", "/api/auth/token", key_auth, retry=False)
+        if result and result[0] == 200:
+            auth = {"Authorization": f"Bearer {json.loads(result[2])['access_token']}"}
+
+        result = await self.call("list", "GET", "/api/rules/list", auth, retry=False)
+        if result is None or result[0] != 200:
+            return False
+
+        if self.args.strategy == "puller" and await self.sync(auth):
+            return True
+
+        headers = dict(auth, Accept=PACKAGE_ACCEPT)
+        if self.state.get('etag'):
+            headers["If-None-Match"] = self.state['etag']
+        elif self.state.get('revision'):
+            headers["If-None-Match"] = f'"{self.state["revision"]}"'
+        result = await self.call("package", "GET", "/api/rules/package", headers, keep_body=False)
+        if result is None or result[0] not in (200, 304):
+            return False
+        if result[0] == 200:
+            self.deployed(result[1])
+            self.state['etag'] = result[1].get("etag")
+            self.files = None
+        return True
+
+async def run_manager(manager, delay, recorder):
+    await asyncio.sleep(delay)
+    started = time.perf_counter()
+    try:
+        ok = await manager.run()
+    except Exception:
+        ok = False
+    recorder.sequences.append(time.perf_counter() - started)
+    if not ok:
+        recorder.failed_sequences += 1
+
+def make_repository(path, rule_files, rules_per_file, decoder_files):
+    """Synthetic rules/ and decoders/ in a git repository, rule ids from 100000"""
+    (path / "rules").mkdir(parents=True)
+    (path / "decoders").mkdir()
+    for index in range(decoder_files):
+        (path / "decoders" / f"load_{index:04d}.xml").write_text(
+            f'<decoder name="load_{index}">\n  <prematch>^load{index}: </prematch>\n</decoder>\n'
+        )
+    for index in range(rule_files):
+        write_rule_file(path, index, rules_per_file, 0)
+    git(path, "init", "-q", "-b", "main")
+    commit(path, "Synthetic ruleset")
+
+def write_rule_file(path, index, rules_per_file, generation):
+    rules = []
+    for offset in range(rules_per_file):
+        rule_id = 100000 + index * rules_per_file + offset
+        parent = f"\n    <if_sid>{rule_id - 1}</if_sid>" if offset else ""
+        rules.append(
+            f'  <rule id="{rule_id}" level="{3 + offset % 10}">{parent}\n'
+            f'    <match>load event {rule_id} v{generation}</match>\n'
+            f'    <description>Synthetic rule {rule_id}</description>\n'
+            f'    <group>load_{index % 10},</group>\n'
+            f'  </rule>'
+        )
+    (path / "rules" / f"load_{index:04d}.xml").write_text(
+        f'<group name="load,">\n' + "\n".join(rules) + "\n</group>\n"
+    )
+
+def git(path, *args):
+    subprocess.run(["git", "-c", "user.name=fleet-load", "-c", "user.email=fleet-load@localhost", *args],
+                   cwd=path, check=True, capture_output=True)
+
+def commit(path, message):
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", message)
+
+def change_repository(path, rule_files, rules_per_file, count, generation):
+    for index in random.sample(range(rule_files), min(count, rule_files)):
+        write_rule_file(path, index, rules_per_file, generation)
+    commit(path, f"Synthetic change {generation}")
+
+def set_option(config, assignment):
+    """Apply a dotted.key=value override (value parsed as YAML)"""
+    name, _, value = assignment.partition("=")
+    *parents, leaf = name.split(".")
+    section = config
+    for parent in parents:
+        section = section.setdefault(parent, {})
+    section[leaf] = yaml.safe_load(value)
+
+def prepare_server(work, args):
+    """Copy of the API under work/app configured for the synthetic repository; returns (dir, keys)"""
+    app_dir = work / "app"
+    app_dir.mkdir()
+    for entry in ROOT.iterdir():
+        if entry.suffix == ".py":
+            shutil.copy2(entry, app_dir)
+    for package in ("routes", "utils"):
+        shutil.copytree(ROOT / package, app_dir / package, ignore=shutil.ignore_patterns("__pycache__"))
+
+    with open(ROOT / "config.yaml") as f:
+        config = yaml.safe_load(f)
+    config['git'].update(repo_path=str(work / "repo"), sync_enabled=False)
+    config['database']['path'] = str(work / "deployments.db")
+    config['cache']['dir'] = str(work / "cache")
+    config.setdefault('publish', {})['dir'] = str(work / "published")
+    config.setdefault('metrics', {})['dir'] = str(work / "metrics")
+    config.setdefault('profiling', {})['dir'] = str(work / "profiles")
+    config.setdefault('rate_limit', {}).update(state_file=str(work / "ratelimit"), enabled=args.rate_limit)
+    config['auth'].update(require_https=False, secret_key=secrets.token_urlsafe(32))
+    for assignment in args.set:
+        set_option(config, assignment)
+    with open(app_dir / "config.yaml", "w") as f:
+        yaml.safe_dump(config, f)
+
+    subprocess.run([sys.executable, "-c", "import models; models.init_db()"], cwd=app_dir, check=True,
+                   capture_output=True)
+    keys = [f"fleet-load-{index:05d}" for index in range(args.managers)]
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+    conn = sqlite3.connect(work / "deployments.db")
+    with conn:
+        conn.executemany(
+            "INSERT INTO servers (server_id, first_seen, last_seen, is_active) VALUES (?, ?, ?, 1)",
+            [(f"load-{index:05d}", now, now) for index in range(args.managers)]
+        )
+        conn.executemany(
+            "INSERT INTO api_keys (key, key_hash, server_id, is_admin, created_at, active) VALUES (?, ?, ?, 0, ?, 1)",
+            [(key, hashlib.sha256(key.encode()).hexdigest(), f"load-{index:05d}", now)
+             for index, key in enumerate(keys)]
+        )
+    conn.close()
+    return app_dir, keys
+
+def start_server(app_dir, args):
+    if args.spawn == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "app:app", "-k", "uvicorn.workers.UvicornWorker",
+                   "-w", str(args.workers), "-b", f"127.0.0.1:{args.port}", "--log-level", "warning",
+                   "--backlog", "4096"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(args.port),
+                   "--workers", str(args.workers), "--log-level", "warning", "--no-access-log",
+                   "--backlog", "4096"]
+    log = open(app_dir / "server.out", "w")
+    return subprocess.Popen(command, cwd=app_dir, stdout=log, stderr=subprocess.STDOUT)
+
+async def wait_ready(client, key, timeout=180):
+    """Wait until the API answers the manifest; returns its revision"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status, _, body, _ = await client.request("GET", "/api/rules/manifest",
+                                                      {"Authorization": f"Bearer {key}"})
+            if status == 200:
+                return json.loads(body)['revision']
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, HTTPError):
+            pass
+        await asyncio.sleep(0.5)
+    raise SystemExit("API did not come up; see server.out in the work directory")
+
+async def wait_revision(client, key, old, timeout=120):
+    """Wait until the API serves a revision other than old; returns it"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        revision = await wait_ready(client, key)
+        if revision != old:
+            return revision
+        await asyncio.sleep(0.5)
+    print("warning: the API did not pick up the change; the round runs against the old revision")
+    return old
+
+def report(recorder, sampler, wall, client_cpu, args):
+    rows = []
+    for endpoint in ENDPOINTS + sorted(set(recorder.latencies) - set(ENDPOINTS)):
+        latencies = recorder.latencies.get(endpoint)
+        if not latencies:
+            continue
+        rows.append({
+            "endpoint": endpoint,
+            "requests": len(latencies),
+            "throughput_rps": len(latencies) / wall,
+            "errors": recorder.errors[endpoint],
+            "statuses": {str(status): n for status, n in sorted(recorder.statuses[endpoint].items(), key=str)},
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": max(latencies) * 1000,
+            "mb_received": recorder.bytes[endpoint] / 1e6,
+            "server_cpu_s": sampler.cpu.get(endpoint) if sampler else None,
+            "server_peak_rss_mb": sampler.peak_rss[endpoint] / 1e6 if sampler and endpoint in sampler.peak_rss else None,
+        })
+    sequences = recorder.sequences or [0.0]
+    summary = {
+        "managers": args.managers,
+        "rounds": args.rounds,
+        "arrival": args.arrival,
+        "wall_s": wall,
+        "requests": sum(row["requests"] for row in rows),
+        "throughput_rps": sum(row["requests"] for row in rows) / wall,
+        "runs": len(recorder.sequences),
+        "failed_runs": recorder.failed_sequences,
+        "run_p50_ms": percentile(sequences, 50) * 1000,
+        "run_p95_ms": percentile(sequences, 95) * 1000,
+        "run_p99_ms": percentile(sequences, 99) * 1000,
+        "server_cpu_s": sampler.total_cpu if sampler else None,
+        "server_cpu_idle_s": sampler.cpu.get("(idle)", 0.0) if sampler else None,
+        "server_max_rss_mb": sampler.max_rss / 1e6 if sampler else None,
+        "client_cpu_s": client_cpu,
+    }
+
+    print(f"\n{'endpoint':10} {'requests':>8} {'rps':>8} {'err':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8} {'MB':>8} {'cpu s':>7} {'rss MB':>7}  statuses")
+    for row in rows:
+        cpu = f"{row['server_cpu_s']:7.2f}" if row['server_cpu_s'] is not None else f"{'-':>7}"
+        rss = f"{row['server_peak_rss_mb']:7.0f}" if row['server_peak_rss_mb'] is not None else f"{'-':>7}"
+        statuses = " ".join(f"{status}:{n}" for status, n in row['statuses'].items())
+        print(f"{row['endpoint']:10} {row['requests']:8} {row['throughput_rps']:8.1f} {row['errors']:5} "
+              f"{row['p50_ms']:8.1f} {row['p95_ms']:8.1f} {row['p99_ms']:8.1f} {row['max_ms']:8.1f} "
+              f"{row['mb_received']:8.2f} {cpu} {rss}  {statuses}")
+    print()
+    for name, value in summary.items():
+        if value is not None:
+            print(f"{name:18} {value:,.2f}" if isinstance(value, float) else f"{name:18} {value}")
+    return {"summary": summary, "endpoints": rows}
+
+async def run(args, url, keys, server_pid, repo):
+    client = Client(url, args.timeout)
+    recorder = Recorder()
+    managers = [Manager(index, keys[index % len(keys)], client, recorder, args) for index in range(args.managers)]
+    revision = await wait_ready(client, keys[0])
+
+    sampler = ProcSampler(server_pid, recorder) if server_pid else None
+    sampling = asyncio.create_task(sampler.run()) if sampler else None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    client_cpu = usage.ru_utime + usage.ru_stime
+    start = time.perf_counter()
+    for round_index in range(args.rounds):
+        if repo and args.change_every and round_index and round_index % args.change_every == 0:
+            change_repository(repo, args.rule_files, args.rules_per_file, args.change_files, round_index)
+            revision = await wait_revision(client, keys[0], revision)
+        round_start = time.perf_counter()
+        if args.arrival == "cron":
+            delays = [random.uniform(0, args.jitter) for _ in managers]
+        else:
+            delays = [random.uniform(0, args.period) for _ in managers]
+        print(f"round {round_index + 1}/{args.rounds}: {len(managers)} managers, revision {revision}")
+        await asyncio.gather(*(run_manager(manager, delay, recorder) for manager, delay in zip(managers, delays)))
+        if round_index + 1 < args.rounds:
+            await asyncio.sleep(max(0.0, args.period - (time.perf_counter() - round_start)))
+    wall = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    client_cpu = usage.ru_utime + usage.ru_stime - client_cpu
+    if sampling:
+        sampling.cancel()
+    return report(recorder, sampler, wall, client_cpu, args)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="API to test when not spawning one")
+    parser.add_argument("--key", action="append", default=[], help="API key(s) the managers use (repeatable)")
+    parser.add_argument("--server-pid", type=int, help="API master process, for CPU/RSS when not spawning")
+    parser.add_argument("--spawn", choices=["uvicorn", "gunicorn"], help="start the API here on a synthetic repository")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="config.yaml override for the spawned API, e.g. admission.max_transfers=16")
+    parser.add_argument("--rate-limit", action="store_true", help="keep rate limiting on in the spawned API")
+    parser.add_argument("--keep", action="store_true", help="keep the spawned API's work directory")
+    parser.add_argument("--rule-files", type=int, default=100)
+    parser.add_argument("--rules-per-file", type=int, default=20)
+    parser.add_argument("--decoder-files", type=int, default=20)
+    parser.add_argument("--change-every", type=int, default=0, help="commit a change every N rounds (spawned API)")
+    parser.add_argument("--change-files", type=int, default=3, help="rule files each change rewrites")
+    parser.add_argument("--managers", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--period", type=float, default=60.0, help="seconds between round starts")
+    parser.add_argument("--arrival", choices=["cron", "uniform"], default="cron")
+    parser.add_argument("--jitter", type=float, default=0.0, help="cron arrivals are spread over this many seconds")
+    parser.add_argument("--strategy", choices=["puller", "package"], default="puller")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--retry-jitter", type=float, default=10.0)
+    parser.add_argument("--max-retry-after", type=float, default=900.0)
+    parser.add_argument("--json", help="also write the results here")
+    args = parser.parse_args()
+
+    # Every simulated manager holds a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server = work = repo = None
+    try:
+        if args.spawn:
+            work = Path(tempfile.mkdtemp(prefix="fleet-load-"))
+            repo = work / "repo"
+            make_repository(repo, args.rule_files, args.rules_per_file, args.decoder_files)
+            app_dir, keys = prepare_server(work, args)
+            server = start_server(app_dir, args)
+            url, server_pid = f"http://127.0.0.1:{args.port}", server.pid
+            print(f"{args.spawn} with {args.workers} workers in {work}")
+        else:
+            if not args.key:
+                parser.error("--key is required unless --spawn is used")
+            url, keys, server_pid = args.url.rstrip("/"), args.key, args.server_pid
+        results = asyncio.run(run(args, url, keys, server_pid, repo))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(dict(results, options=vars(args)), f, indent=2)
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if work is not None and not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Per-request overhead of the metrics instrumentation
+
+Times Histogram.observe() on a labelled series, a full pass through
+MetricsMiddleware (around an app that only sends a response) minus the
+same app called directly, and rendering /metrics, with the value files in
+a temporary directory:
+
+    python3 benchmarks/metrics.py --requests 200000 --workers 4
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from utils import metrics
+
+ROUTES = ["/api/rules/list", "/api/rules/package", "/api/rules/delta", "/api/auth/token"]
+
+class Route:
+    def __init__(self, path):
+        self.path = path
+
+async def app(scope, receive, send):
+    scope["route"] = Route(ROUTES[scope["n"] % len(ROUTES)])
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+async def sink(message):
+    pass
+
+def time_worker(directory, requests):
+    metrics.METRICS_DIR = Path(directory)
+    series = metrics.REQUEST_SECONDS.labels("GET", "/api/rules/list", 200)
+    start = time.perf_counter()
+    for n in range(requests):
+        series.observe(n % 1000 / 10000)
+    observe = (time.perf_counter() - start) / requests
+
+    middleware = metrics.MetricsMiddleware(app)
+    scopes = [{"type": "http", "method": "GET", "path": route, "n": n} for n, route in enumerate(ROUTES)]
+
+    async def run(handler):
+        start = time.perf_counter()
+        for n in range(requests):
+            await handler(scopes[n % len(scopes)], None, sink)
+        return (time.perf_counter() - start) / requests
+
+    bare = asyncio.run(run(app))
+    wrapped = asyncio.run(run(middleware))
+    return observe, wrapped - bare
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        with ProcessPoolExecutor(args.workers) as pool:
+            results = list(pool.map(time_worker, [directory] * args.workers, [args.requests] * args.workers))
+        metrics.METRICS_DIR = Path(directory)
+        start = time.perf_counter()
+        body = metrics.render()
+        render_ms = (time.perf_counter() - start) * 1000
+        files = len(os.listdir(directory))
+
+    print(f"{'workers':>7} {'observe() us':>13} {'middleware us':>14} {'render ms':>10} {'files':>6}")
+    print(f"{args.workers:>7} {max(r[0] for r in results) * 1e6:>13.2f} "
+          f"{max(r[1] for r in results) * 1e6:>14.2f} {render_ms:>10.2f} {files:>6}")
+    count = sum(
+        float(line.rsplit(" ", 1)[1]) for line in body.splitlines()
+        if line.startswith("wazuh_api_request_duration_seconds_count")
+    )
+    print(f"requests counted across workers: {count:.0f} (expected {2 * args.workers * args.requests})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Per-request overhead of the shared rate limiter
+
+Times TokenBuckets.take() and a full pass through RateLimitMiddleware
+(around an app that does nothing) against a bucket file in a temporary
+directory, with one or several processes hitting the same file:
+
+    python3 benchmarks/rate_limit.py --requests 200000 --processes 1 4
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ratelimit import TokenBuckets, RateLimitMiddleware, bucket_hash
+
+CLIENTS = 1000  # distinct keys and addresses cycled through
+
+async def noop_app(scope, receive, send):
+    pass
+
+def time_take(path, requests):
+    buckets = TokenBuckets(path)
+    limits = [
+        [(bucket_hash(b"ip", f"10.0.{n // 256}.{n % 256}"), 1e9, 1e9),
+         (bucket_hash(b"key", f"Bearer key-{n}".encode()), 1e9, 1e9)]
+        for n in range(CLIENTS)
+    ]
+    start = time.perf_counter()
+    for n in range(requests):
+        buckets.take(limits[n % CLIENTS])
+    return (time.perf_counter() - start) / requests
+
+def time_middleware(path, requests):
+    middleware = RateLimitMiddleware(noop_app, TokenBuckets(path))
+    middleware.key_rate = middleware.ip_rate = 1e9
+    scopes = [
+        {"type": "http", "path": "/api/rules/list", "client": (f"10.0.{n // 256}.{n % 256}", 40000),
+         "headers": [(b"host", b"api"), (b"authorization", f"Bearer key-{n}".encode())]}
+        for n in range(CLIENTS)
+    ]
+
+    async def run():
+        start = time.perf_counter()
+        for n in range(requests):
+            await middleware(scopes[n % CLIENTS], None, None)
+        return (time.perf_counter() - start) / requests
+
+    return asyncio.run(run())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    print(f"{'processes':>9} {'take() us':>10} {'middleware us':>14}")
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "buckets")
+        for processes in args.processes:
+            with ProcessPoolExecutor(processes) as pool:
+                take = list(pool.map(time_take, [path] * processes, [args.requests] * processes))
+                middleware = list(pool.map(time_middleware, [path] * processes, [args.requests] * processes))
+            print(f"{processes:>9} {max(take) * 1e6:>10.2f} {max(middleware) * 1e6:>14.2f}")
+
+if __name__ == "__main__":
+    main()
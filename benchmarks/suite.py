@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the API's hot paths, with stored JSON baselines
+
+Covers API key and token verification, ruleset listing and index refresh,
+package building for synthetic repositories of --sizes files, deployment
+inserts (one per connection, as models.record_deployment does outside the
+API, and write-behind batches), and admin_dashboard.get_stats() against a
+deployments table of --deployment-rows rows. Everything runs against
+temporary files, never the configured database or cache.
+
+Record a baseline before a change and compare after it, on the same
+machine (exits 1 when a benchmark got slower than --threshold):
+
+    python3 benchmarks/suite.py run --save main
+    python3 benchmarks/suite.py compare main
+    python3 benchmarks/suite.py compare main current.json --threshold 0.05
+
+Baselines are kept in benchmarks/baselines/<name>.json; --only selects
+benchmarks by glob (e.g. --only 'package.*').
+"""
+import argparse
+import asyncio
+import fnmatch
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+import models
+from utils import metrics
+
+BASELINE_DIR = Path(__file__).parent / "baselines"
+
+RULE_TEMPLATE = """<group name="synthetic,">
+  <rule id="{rule_id}" level="5">
+    <if_sid>5700</if_sid>
+    <match>synthetic event {rule_id}</match>
+    <description>Synthetic rule {rule_id}</description>
+  </rule>
+</group>
+"""
+
+def make_ruleset(root, count):
+    """count rule files (and a decoder per 20) under root"""
+    (root / "rules").mkdir(parents=True)
+    (root / "decoders").mkdir()
+    for n in range(count):
+        if n % 20 == 19:
+            (root / "decoders" / f"synthetic_{n:06d}.xml").write_text(
+                f'<decoder name="synthetic_{n}">\n  <prematch>^synthetic{n}: </prematch>\n</decoder>\n'
+            )
+        else:
+            (root / "rules" / f"synthetic_{n:06d}.xml").write_text(RULE_TEMPLATE.format(rule_id=100000 + n) * 4)
+
+def measure(fn, repeat, min_time):
+    """Seconds per call of fn, one sample per round; each round loops long enough to last min_time"""
+    start = time.perf_counter()
+    fn()  # warm-up, and how many calls a round needs
+    elapsed = time.perf_counter() - start
+    number = max(1, int(min_time / elapsed)) if elapsed < min_time else 1
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return samples, number
+
+def auth_cases(work, args):
+    """API key lookups, cached and from the database, and access tokens"""
+    import auth
+    auth.SECRET_KEY = "benchmark-" + os.urandom(16).hex()
+    conn = models.get_db_connection()
+    conn.executemany(
+        "INSERT INTO api_keys (key, key_hash, server_id, is_admin, created_at, active) VALUES (?, ?, ?, 0, ?, 1)",
+        [(f"bench-key-{n:06d}", f"{n:064x}", f"bench-{n:06d}", datetime.now().isoformat()) for n in range(args.keys)]
+    )
+    conn.commit()
+    conn.close()
+    keys = [f"bench-key-{n:06d}" for n in range(args.keys)]
+    loop = asyncio.new_event_loop()
+    lookup = lambda key: loop.run_until_complete(auth.api_key_info(key))[1]
+    auth.key_cache.invalidate()
+    for key in keys[:1000]:
+        lookup(key)
+    info = lookup(keys[0])
+    token = auth.issue_token(info)['access_token']
+    yield "auth.api_key_info.cached", lambda: lookup(random.choice(keys[:1000]))
+    yield "auth.api_key_info.database", lambda: loop.run_until_complete(
+        auth.db.fetchone(auth.API_KEY_QUERY, (random.choice(keys),))
+    )
+    yield "auth.issue_token", lambda: auth.issue_token(info)
+    yield "auth.verify_token", lambda: auth.verify_token(token)
+
+def index_cases(work, args):
+    """Listing, full and incremental index refresh, and the /list body"""
+    from utils.git_sync import get_ruleset_files
+    from utils.repo_index import RepoIndex
+    for size in args.sizes:
+        root = work / f"repo-{size}"
+        if not root.exists():
+            make_ruleset(root, size)
+        index = RepoIndex(root, commit_reader=lambda path: None)
+        snapshot = index.refresh(force=True)
+        yield f"index.listing.{size}", lambda: get_ruleset_files(root)
+        yield f"index.refresh.full.{size}", lambda: RepoIndex(root, commit_reader=lambda path: None).refresh(force=True)
+        yield f"index.refresh.rescan.{size}", lambda: index.refresh(force=True)
+        yield f"index.refresh.unchanged.{size}", index.refresh
+        yield f"index.list_body.{size}", lambda: snapshot.list_body("bench-000000")
+
+def package_cases(work, args):
+    """Building each package format from a snapshot"""
+    from utils.package_cache import PACKAGE_FORMATS, iter_package
+    from utils.repo_index import RepoIndex
+    formats = args.formats or list(PACKAGE_FORMATS)
+    for size in args.sizes:
+        root = work / f"repo-{size}"
+        if not root.exists():
+            make_ruleset(root, size)
+        entries = RepoIndex(root, commit_reader=lambda path: None).refresh(force=True).source_files()
+        for package_format in formats:
+            def build(package_format=package_format, entries=entries):
+                for chunk in iter_package(entries, package_format):
+                    pass
+            yield f"package.{package_format}.{size}", build
+
+def database_cases(work, args):
+    """Deployment inserts, one connection per row and write-behind batches"""
+    from storage import WriteBehind
+    batch_writer = WriteBehind(None)
+    conn = models.get_db_connection()
+    servers = [f"bench-{n:06d}" for n in range(1000)]
+
+    def record():
+        models.record_deployment(random.choice(servers), True, "bench", None, 10, 1.0)
+
+    def write_batch():
+        timestamp = datetime.now().isoformat()
+        deployments = [(server_id, timestamp, "bench", 1, None, 10, 1.0) for server_id in servers[:500]]
+        batch_writer._write_batch(conn, {server_id: timestamp for server_id in servers[:500]}, deployments)
+
+    yield "db.record_deployment", record
+    yield "db.write_batch.500", write_batch
+
+def dashboard_cases(work, args):
+    """The admin dashboard queries on a large deployments table"""
+    import admin_dashboard
+    conn = models.get_db_connection()
+    started = datetime.now() - timedelta(days=365)
+    rows = args.deployment_rows
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO servers (server_id, first_seen, last_seen, is_active) VALUES (?, ?, ?, 1)",
+            [(f"bench-{n:06d}", started.isoformat(), datetime.now().isoformat()) for n in range(args.servers)]
+        )
+        conn.executemany(
+            "INSERT INTO deployments (server_id, timestamp, ruleset_version, success, file_count, deployment_time) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            ((f"bench-{n % args.servers:06d}", (started + timedelta(seconds=n * 31_536_000 // rows)).isoformat(),
+              "bench", 0 if n % 50 == 0 else 1, 10, 1.0) for n in range(rows))
+        )
+    conn.close()
+    yield f"dashboard.get_stats.{rows}", admin_dashboard.get_stats
+    conn = models.get_db_connection()
+    yield f"dashboard.fleet_stats.{rows}", lambda: admin_dashboard.fleet_stats(conn)
+    yield f"dashboard.server_page.{args.servers}", lambda: admin_dashboard.server_page(conn, 50, args.servers // 2)
+
+# Benchmark names start with the group's prefix; groups nothing selects are not set up
+GROUPS = {
+    "auth": auth_cases,
+    "index": index_cases,
+    "package": package_cases,
+    "db": database_cases,
+    "dashboard": dashboard_cases,
+}
+
+def selected(name, patterns):
+    return not patterns or any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+def group_selected(prefix, patterns):
+    return not patterns or any(fnmatch.fnmatch(prefix, pattern.split(".", 1)[0]) for pattern in patterns)
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "sqlite": sqlite3.sqlite_version,
+    }
+
+def run_suite(args):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="wazuh-api-bench-") as directory:
+        work = Path(directory)
+        # Never touch the configured database or metrics files
+        models.DATABASE_PATH = str(work / "deployments.db")
+        metrics.METRICS_DIR = work / "metrics"
+        models.init_db()
+        for prefix, group in GROUPS.items():
+            if not group_selected(prefix, args.only):
+                continue
+            for name, fn in group(work, args):
+                if not selected(name, args.only):
+                    continue
+                samples, number = measure(fn, args.repeat, args.min_time)
+                results[name] = {
+                    "median_s": statistics.median(samples),
+                    "min_s": min(samples),
+                    "stdev_s": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+                    "rounds": len(samples),
+                    "calls_per_round": number,
+                }
+                print(f"{name:42} {format_seconds(results[name]['median_s']):>10} "
+                      f"(min {format_seconds(results[name]['min_s'])}, {len(samples)}x{number})", flush=True)
+    return {"environment": environment(), "options": options(args), "results": results}
+
+def options(args):
+    return {name: getattr(args, name) for name in ("sizes", "formats", "keys", "servers", "deployment_rows")}
+
+def format_seconds(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+def baseline_path(name):
+    """A path as given, or the name of a stored baseline"""
+    path = Path(name)
+    return path if path.suffix == ".json" or path.exists() else BASELINE_DIR / f"{name}.json"
+
+def load(name):
+    with open(baseline_path(name)) as f:
+        return json.load(f)
+
+def compare(baseline, current, threshold, stat, patterns=()):
+    """Print both runs side by side; returns the names that regressed"""
+    regressions = []
+    old, new = baseline['results'], current['results']
+    for key in ("processor", "cpus", "python"):
+        if baseline['environment'].get(key) != current['environment'].get(key):
+            print(f"warning: {key} differs ({baseline['environment'].get(key)} vs "
+                  f"{current['environment'].get(key)}); timings may not be comparable")
+    print(f"baseline {baseline['environment'].get('commit')} ({baseline['environment']['date']}), "
+          f"current {current['environment'].get('commit')} ({current['environment']['date']}), "
+          f"{stat}, threshold {threshold:.0%}\n")
+    print(f"{'benchmark':42} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name in sorted(name for name in set(old) | set(new) if selected(name, patterns)):
+        if name not in new:
+            print(f"{name:42} {format_seconds(old[name][stat]):>10} {'-':>10} {'':>8}  missing")
+            continue
+        if name not in old:
+            print(f"{name:42} {'-':>10} {format_seconds(new[name][stat]):>10} {'':>8}  new")
+            continue
+        change = new[name][stat] / old[name][stat] - 1
+        verdict = ""
+        if change > threshold:
+            verdict = "REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            verdict = "faster"
+        print(f"{name:42} {format_seconds(old[name][stat]):>10} {format_seconds(new[name][stat]):>10} "
+              f"{change:>+8.1%}  {verdict}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmarks")
+    run.add_argument("--save", metavar="NAME", help="store the results as benchmarks/baselines/NAME.json")
+
+    check = commands.add_parser("compare", help="compare against a baseline, running the suite if no results are given")
+    check.add_argument("baseline", help="baseline name or results file")
+    check.add_argument("current", nargs="?", help="results file (default: run the baseline's benchmarks now)")
+    check.add_argument("--threshold", type=float, default=0.10, help="slowdown flagged as a regression (0.10 = 10%%)")
+    # The fastest round is the least disturbed by whatever else the machine is doing
+    check.add_argument("--stat", choices=["min_s", "median_s"], default="min_s")
+
+    for command in (run, check):
+        command.add_argument("--only", action="append", default=[], metavar="GLOB")
+        command.add_argument("--output", help="write the results to this file")
+        command.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 50000],
+                             help="files in the synthetic repositories")
+        command.add_argument("--formats", nargs="+", help="package formats (default: all available)")
+        command.add_argument("--keys", type=int, default=10000, help="rows in api_keys")
+        command.add_argument("--servers", type=int, default=1000, help="rows in servers")
+        command.add_argument("--deployment-rows", type=int, default=2_000_000, help="rows in deployments")
+        command.add_argument("--repeat", type=int, default=5, help="rounds per benchmark")
+        command.add_argument("--min-time", type=float, default=0.2, help="seconds per round, at least")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_suite(args)
+        if args.save:
+            BASELINE_DIR.mkdir(exist_ok=True)
+        for path in filter(None, (args.output, args.save and baseline_path(args.save))):
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+        return
+
+    baseline = load(args.baseline)
+    if args.current:
+        current = load(args.current)
+    else:
+        # Same workload as the baseline, and only what it measured
+        for name, value in baseline.get('options', {}).items():
+            setattr(args, name, value)
+        current = run_suite(argparse.Namespace(**dict(vars(args), only=args.only or sorted(baseline['results']))))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(current, f, indent=2)
+    if compare(baseline, current, args.threshold, args.stat, args.only):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Peak memory of streamed zip generation
+
+Builds a synthetic ruleset of N files in a temporary directory, streams it
+through utils.package_cache.iter_zip and reports the tracemalloc peak:
+
+    python3 benchmarks/zip_memory.py --files 5000 50000
+
+Exits 1 if any peak exceeds --max-peak-mb, or if the peak grows by more
+than --max-bytes-per-file per additional file between the smallest and the
+largest run. The only state iter_zip keeps per file is its central
+directory record (46 bytes plus the name), so anything above that budget
+means entries are being buffered.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from utils.package_cache import iter_zip
+
+RULE_TEMPLATE = """<group name="synthetic,">
+  <rule id="{rule_id}" level="5">
+    <if_sid>5700</if_sid>
+    <match>synthetic event {rule_id}</match>
+    <description>Synthetic rule {rule_id}</description>
+  </rule>
+</group>
+"""
+
+def make_ruleset(root, count):
+    rules_dir = Path(root) / "rules"
+    rules_dir.mkdir(parents=True, exist_ok=True)
+    files = []
+    for n in range(count):
+        path = rules_dir / f"synthetic_{n:06d}.xml"
+        path.write_text(RULE_TEMPLATE.format(rule_id=100000 + n) * 4)
+        files.append((f"rules/{path.name}", path))
+    return files
+
+def measure(files):
+    """Stream files into /dev/null; returns (archive bytes, peak bytes, seconds)"""
+    total = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, "wb") as sink:
+        for chunk in iter_zip(files):
+            sink.write(chunk)
+            total += len(chunk)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return total, peak, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, nargs="+", default=[5000, 50000])
+    parser.add_argument("--max-peak-mb", type=float, default=8.0)
+    parser.add_argument("--max-bytes-per-file", type=int, default=128)
+    args = parser.parse_args()
+
+    peaks = {}
+    print(f"{'files':>8} {'archive MB':>11} {'peak MB':>8} {'peak B/file':>12} {'seconds':>8}")
+    for count in args.files:
+        with tempfile.TemporaryDirectory() as root:
+            files = make_ruleset(root, count)
+            total, peak, elapsed = measure(files)
+        peaks[count] = peak
+        print(f"{count:>8} {total / 1e6:>11.1f} {peak / 1e6:>8.1f} {peak / count:>12.0f} {elapsed:>8.2f}")
+
+    failures = [
+        f"peak {peak / 1e6:.1f} MB for {count} files exceeds {args.max_peak_mb} MB"
+        for count, peak in peaks.items() if peak > args.max_peak_mb * 1e6
+    ]
+    low, high = min(peaks), max(peaks)
+    if high > low:
+        growth = (peaks[high] - peaks[low]) / (high - low)
+        print(f"growth {growth:.0f} B/file from {low} to {high} files")
+        if growth > args.max_bytes_per_file:
+            failures.append(f"peak grows {growth:.0f} B/file, over {args.max_bytes_per_file}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -34,6 +34,9 @@ services:
       - ENVIRONMENT=production
       - WORKERS=4
       - LOG_LEVEL=WARNING
+      # nginx reaches the API over the compose network (the API port is only
+      # published on 127.0.0.1), so its forwarded client addresses are trusted
+      - TRUSTED_PROXIES=127.0.0.1,172.16.0.0/12,192.168.0.0/16
       
       # Database
       - DATABASE_PATH=/data/deployments.db
@@ -6,6 +6,15 @@ echo "Time: $(date)"
 echo "Python: $(python3 --version)"
 echo ""
 
+# Keep the repository in sync in the background when a remote is given
+if [ -n "$GIT_REPO_URL" ]; then GIT_SYNC_DEFAULT=true; else GIT_SYNC_DEFAULT=false; fi
+
+# Sign access tokens with a random secret unless one is given (tokens
+# issued before a restart then stop working; pullers fetch new ones)
+if [ -z "$SECRET_KEY" ]; then
+    SECRET_KEY=$(python3 -c "import secrets; print(secrets.token_urlsafe(48))")
+fi
+
 # Generate config.yaml from environment variables
 echo "Generating configuration..."
 cat > config.yaml << CONFIG_EOF
@@ -17,20 +26,110 @@ server:
 git:
   repo_url: "${GIT_REPO_URL:-https://github.com/Abhishek-s-kumar/prox-wazuh-ci.git }"
   repo_path: "${GIT_REPO_PATH:-/git-repo}"
-  sync_interval: 300
+  sync_interval: ${GIT_SYNC_INTERVAL:-300}
   branch: "${GIT_BRANCH:-main}"
+  sync_enabled: ${GIT_SYNC_ENABLED:-$GIT_SYNC_DEFAULT}
+  depth: ${GIT_SYNC_DEPTH:-50}
+  keep_checkouts: 3
+
+index:
+  poll_interval: 1.0
+  full_rescan_interval: 30
+  history_size: 8
 
 auth:
-  secret_key: "${SECRET_KEY:-changeme-in-production-please-change}"
-  token_expiry: 1440
+  secret_key: "${SECRET_KEY}"
+  token_expiry: 15
+  key_cache_ttl: 60
+  negative_cache_ttl: 10
+  revocation_poll: 5
   require_https: false
 
 database:
   path: "${DATABASE_PATH:-/data/deployments.db}"
+  pool_size: 4
+  busy_timeout_ms: 5000
+  write_behind:
+    flush_interval_ms: 500
+    max_batch_rows: 500
+
+cache:
+  dir: "${CACHE_PATH:-/data/cache}"
+  max_entries: 16
+  max_delta_entries: 16
+  max_size_mb: 512
+
+package:
+  formats: ["zip", "tar.gz", "tar.xz", "tar.zst"]
+  default_format: "zip"
+  precompute: ["zip", "tar.xz"]
+  minify: false
+
+publish:
+  enabled: ${PUBLISH_ENABLED:-true}
+  dir: "${PUBLISH_PATH:-/data/published}"
+  keep: 5
+  startup_wait: 120
+
+validation:
+  max_regex_length: 2048
+  builtin_rule_max: 99999
+  external_decoders: []
+  parallel_threshold: 200
+  workers: 0
+
+subsets:
+  include_all_decoders: true
+  environments: {}
+  locations: {}
+
+watch:
+  timeout: 55
+  max_timeout: 300
+  jitter: 5
+  keepalive: 15
+
+admission:
+  enabled: true
+  max_transfers: ${MAX_TRANSFERS:-8}
+  bytes_per_second: ${TRANSFER_BYTES_PER_SECOND:-0}
+  retry_window: 300
 
 rate_limit:
   enabled: true
   requests_per_minute: 60
+  burst_limit: 10
+  ip_requests_per_minute: 600
+  ip_burst_limit: 100
+  state_file: "/dev/shm/wazuh-api-ratelimit"
+  slots: 65536
+  trusted_proxies: "${TRUSTED_PROXIES:-127.0.0.1,::1}"
+
+metrics:
+  enabled: true
+  dir: "/dev/shm/wazuh-api-metrics"
+
+profiling:
+  dir: "/tmp/wazuh-api-profiles"
+  interval_ms: 5
+  max_stacks: 20000
+
+dashboard:
+  cache_ttl: 5
+  keepalive: 15
+
+retention:
+  enabled: true
+  raw_days: 30
+  hourly_days: 14
+  daily_days: 0
+  archive_dir: ""
+  batch_rows: 2000
+  batch_pause_ms: 100
+  interval: 3600
+  analyze_interval: 86400
+  vacuum_interval: 604800
+  vacuum_free_ratio: 0.25
 
 logging:
   level: "${LOG_LEVEL:-INFO}"
@@ -39,65 +138,25 @@ CONFIG_EOF
 
 echo "Configuration generated."
 
-# Initialize database if not exists
-if [ ! -f "${DATABASE_PATH:-/data/deployments.db}" ]; then
-    echo "Initializing database..."
+# Create the database, or migrate an existing one to the current schema
+DB_FILE="${DATABASE_PATH:-/data/deployments.db}"
+if [ -f "$DB_FILE" ]; then NEW_DATABASE=false; else NEW_DATABASE=true; fi
+mkdir -p "$(dirname "$DB_FILE")"
+python3 schema.py
+
+if [ "$NEW_DATABASE" = "true" ]; then
+    # Create test server and key for initial testing
     python3 -c "
 import sqlite3
 import os
+import secrets
+import hashlib
+from datetime import datetime
 
 db_path = os.environ.get('DATABASE_PATH', '/data/deployments.db')
-db_dir = os.path.dirname(db_path)
-if db_dir:
-    os.makedirs(db_dir, exist_ok=True)
-
 conn = sqlite3.connect(db_path)
 cursor = conn.cursor()
 
-# Create tables
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS servers (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        server_id TEXT UNIQUE NOT NULL,
-        description TEXT,
-        first_seen TEXT NOT NULL,
-        last_seen TEXT NOT NULL,
-        is_active INTEGER DEFAULT 1,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )
-''')
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS api_keys (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        key TEXT UNIQUE NOT NULL,
-        server_id TEXT,
-        is_admin INTEGER DEFAULT 0,
-        active INTEGER DEFAULT 1,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (server_id) REFERENCES servers (server_id)
-    )
-''')
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS deployments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        server_id TEXT NOT NULL,
-        timestamp TEXT NOT NULL,
-        success INTEGER DEFAULT 0,
-        file_count INTEGER DEFAULT 0,
-        error_message TEXT,
-        deployment_time REAL,
-        FOREIGN KEY (server_id) REFERENCES servers (server_id)
-    )
-''')
-
-conn.commit()
-
-# Create test server and key for initial testing
-import secrets
-from datetime import datetime
-
 test_key = 'wazuh_test_' + secrets.token_hex(16)
 cursor.execute('''
     INSERT OR IGNORE INTO servers (server_id, description, first_seen, last_seen, is_active)
@@ -105,9 +164,9 @@ cursor.execute('''
 ''', ('test-server-01', 'Docker Test Server', datetime.now().isoformat(), datetime.now().isoformat()))
 
 cursor.execute('''
-    INSERT INTO api_keys (key, server_id, is_admin, active, created_at)
-    VALUES (?, ?, 0, 1, ?)
-''', (test_key, 'test-server-01', datetime.now().isoformat()))
+    INSERT INTO api_keys (key, key_hash, server_id, is_admin, active, created_at)
+    VALUES (?, ?, ?, 0, 1, ?)
+''', (test_key, hashlib.sha256(test_key.encode()).hexdigest(), 'test-server-01', datetime.now().isoformat()))
 
 conn.commit()
 conn.close()
@@ -116,11 +175,13 @@ print(f'Database initialized at {db_path}')
 print(f'Test API Key: {test_key}')
 "
 else
-    echo "Database already exists at ${DATABASE_PATH:-/data/deployments.db}"
+    echo "Database already exists at $DB_FILE"
 fi
 
-# Clone Git repository if specified
-if [ -n "$GIT_REPO_URL" ] && [ ! -d "/git-repo/.git" ]; then
+# Clone Git repository if specified (the API fetches it itself when syncing)
+if [ "${GIT_SYNC_ENABLED:-$GIT_SYNC_DEFAULT}" = "true" ]; then
+    echo "Repository $GIT_REPO_URL is synced by the API into /git-repo"
+elif [ -n "$GIT_REPO_URL" ] && [ ! -d "/git-repo/.git" ]; then
     echo "Cloning Git repository: $GIT_REPO_URL"
     git clone "$GIT_REPO_URL" /git-repo
     echo "Repository cloned to /git-repo"
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import secrets
 import sqlite3
+import hashlib
 from datetime import datetime
 import socket
 
@@ -19,9 +20,9 @@ def generate_key(server_id, description=""):
     
     # Add API key
     cursor.execute("""
-        INSERT INTO api_keys (key, server_id, is_admin, active, created_at)
-        VALUES (?, ?, 0, 1, ?)
-    """, (api_key, server_id, datetime.now().isoformat()))
+        INSERT INTO api_keys (key, key_hash, server_id, is_admin, active, created_at)
+        VALUES (?, ?, ?, 0, 1, ?)
+    """, (api_key, hashlib.sha256(api_key.encode()).hexdigest(), server_id, datetime.now().isoformat()))
     
     conn.commit()
     conn.close()
@@ -24,8 +24,9 @@ def generate_server_key(server_id, description=""):
         
         # Add to servers table
         cursor.execute("""
-            INSERT OR REPLACE INTO servers (server_id, description, first_seen, last_seen, is_active)
+            INSERT INTO servers (server_id, description, first_seen, last_seen, is_active)
             VALUES (?, ?, ?, ?, 1)
+            ON CONFLICT (server_id) DO UPDATE SET description = excluded.description, is_active = 1
         """, (server_id, description, datetime.now().isoformat(), datetime.now().isoformat()))
         
         conn.commit()
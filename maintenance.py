@@ -0,0 +1,253 @@
+"""
+Deployment history maintenance: rollup backfill, retention, ANALYZE and VACUUM
+"""
+import gzip
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from models import config
+from schema import rollup_insert_sql
+from storage import db
+
+retention_config = config.get('retention', {})
+RETENTION_ENABLED = retention_config.get('enabled', True)  # off: nothing is deleted, rollups are still backfilled
+RAW_DAYS = retention_config.get('raw_days', 30)  # deployment rows kept; older ones live on in the rollups
+HOURLY_DAYS = retention_config.get('hourly_days', 14)  # hourly rollups kept
+DAILY_DAYS = retention_config.get('daily_days', 0)  # daily rollups kept; 0 = forever
+ARCHIVE_DIR = retention_config.get('archive_dir') or None  # gzip'd JSON lines of pruned rows; unset = just delete
+BATCH_ROWS = retention_config.get('batch_rows', 2000)  # rows per transaction
+BATCH_PAUSE = retention_config.get('batch_pause_ms', 100) / 1000  # between transactions, so other writers get in
+INTERVAL = retention_config.get('interval', 3600)  # seconds between maintenance passes
+ANALYZE_INTERVAL = retention_config.get('analyze_interval', 86400)
+VACUUM_INTERVAL = retention_config.get('vacuum_interval', 604800)
+VACUUM_FREE_RATIO = retention_config.get('vacuum_free_ratio', 0.25)  # free pages that justify a full VACUUM
+CHECK_INTERVAL = 60  # seconds between checks for due tasks
+INCREMENTAL_VACUUM_PAGES = 1000
+ANALYSIS_LIMIT = 1000  # rows ANALYZE samples per index
+
+logger = logging.getLogger(__name__)
+
+def claim(conn, task, interval):
+    """True if task is due and this process is the one to run it"""
+    now = time.time()
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO maintenance (name, value) VALUES (?, 0)", (f"{task}_at",))
+        # Checked and set in one write transaction: one worker wins
+        cursor = conn.execute(
+            "UPDATE maintenance SET value = ? WHERE name = ? AND value <= ?", (now, f"{task}_at", now - interval)
+        )
+    return cursor.rowcount == 1
+
+def backfill_pending(conn):
+    return conn.execute("SELECT 1 FROM maintenance WHERE name = 'rollup_backfill_next'").fetchone() is not None
+
+def backfill_batch(conn, batch_rows=BATCH_ROWS):
+    """Roll up the next batch of deployments that predate the rollups; returns rows covered"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        state = dict(conn.execute(
+            "SELECT name, value FROM maintenance WHERE name IN ('rollup_backfill_next', 'rollup_backfill_end')"
+        ).fetchall())
+        if len(state) < 2:
+            conn.rollback()
+            return 0
+        first = state['rollup_backfill_next']
+        last = min(first + batch_rows - 1, state['rollup_backfill_end'])
+        conn.execute(rollup_insert_sql("deployments WHERE id BETWEEN ? AND ?"), (first, last))
+        if last >= state['rollup_backfill_end']:
+            conn.execute("DELETE FROM maintenance WHERE name IN ('rollup_backfill_next', 'rollup_backfill_end')")
+            logger.info("Deployment rollup backfill complete")
+        else:
+            conn.execute("UPDATE maintenance SET value = ? WHERE name = 'rollup_backfill_next'", (last + 1,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return last - first + 1
+
+def archive_rows(rows, archive_dir):
+    """Append rows to a gzip'd JSON lines file named after the oldest row's day"""
+    archive_dir = Path(archive_dir)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    path = archive_dir / f"deployments-{str(rows[0]['timestamp'])[:10]}.jsonl.gz"
+    # Each append is a gzip member of its own; readers see one stream
+    with gzip.open(path, "at") as f:
+        for row in rows:
+            f.write(json.dumps(dict(row)) + "\n")
+
+PRUNE_DEPLOYMENT_FILES_QUERY = "DELETE FROM deployment_files WHERE deployment_id <= ?"
+
+def retention_batch(conn, cutoff, batch_rows=BATCH_ROWS, archive_dir=ARCHIVE_DIR):
+    """Delete (after archiving) the oldest deployments up to the first one newer than cutoff.
+
+    Walks rowid order rather than searching by timestamp, so each batch
+    reads only the rows it removes and nothing needs an index. Returns the
+    rows deleted; fewer than batch_rows means the pass is done.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            "SELECT * FROM deployments ORDER BY id LIMIT ?" if archive_dir else
+            "SELECT id, timestamp FROM deployments ORDER BY id LIMIT ?", (batch_rows,)
+        ).fetchall()
+        expired = []
+        for row in rows:
+            if str(row['timestamp']) >= cutoff:
+                break
+            expired.append(row)
+        if not expired:
+            conn.rollback()
+            return 0
+        if archive_dir:
+            archive_rows(expired, archive_dir)
+        last = expired[-1]['id']
+        conn.execute("DELETE FROM deployments WHERE id <= ?", (last,))
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'deployment_files'").fetchone():
+            conn.execute(PRUNE_DEPLOYMENT_FILES_QUERY, (last,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(expired)
+
+NEXT_ROLLUP_SERVER_QUERY = (
+    "SELECT server_id FROM deployment_rollups WHERE period = ? AND server_id > ? ORDER BY server_id LIMIT 1"
+)
+PRUNE_ROLLUPS_QUERY = "DELETE FROM deployment_rollups WHERE period = ? AND server_id = ? AND bucket < ?"
+
+def prune_rollups_batch(conn, period, cutoff, after, servers=100):
+    """Drop period rollups older than cutoff for the next servers after `after`.
+
+    Rollups are keyed by server, so each server's old buckets are one
+    index range. Returns (last server handled or None when done, rows deleted).
+    """
+    server_ids = []
+    server_id = after
+    for _ in range(servers):
+        row = conn.execute(NEXT_ROLLUP_SERVER_QUERY, (period, server_id)).fetchone()
+        if row is None:
+            break
+        server_id = row[0]
+        server_ids.append(server_id)
+    if not server_ids:
+        return None, 0
+    with conn:
+        deleted = conn.executemany(
+            PRUNE_ROLLUPS_QUERY, [(period, server_id, cutoff) for server_id in server_ids]
+        ).rowcount
+    return server_ids[-1], deleted
+
+def analyze(conn):
+    """Refresh the planner's statistics, sampling rather than reading whole tables"""
+    conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+    conn.execute("ANALYZE")
+    conn.commit()
+
+def free_pages(conn):
+    """(auto_vacuum mode, free pages, total pages)"""
+    return (conn.execute("PRAGMA auto_vacuum").fetchone()[0], conn.execute("PRAGMA freelist_count").fetchone()[0],
+            conn.execute("PRAGMA page_count").fetchone()[0])
+
+def incremental_vacuum(conn, pages=INCREMENTAL_VACUUM_PAGES):
+    # execute() steps the pragma once, freeing a single page; a script runs it to the end
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+
+def full_vacuum(conn):
+    """Rewrite the database, switching it to incremental auto-vacuum for next time"""
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+class Maintenance:
+    """Keeps the deployment history bounded without long write locks.
+
+    Every INTERVAL one worker (whichever claims the pass in the maintenance
+    table) rolls up deployments that predate the rollups, deletes raw rows
+    older than RAW_DAYS (archiving them first if ARCHIVE_DIR is set) and
+    rollups past their retention, each in transactions of BATCH_ROWS with a
+    pause in between. Raw rows are only pruned once the backfill is done,
+    so nothing leaves the table before it is counted. ANALYZE and VACUUM
+    are claimed the same way on their own intervals; a full VACUUM runs
+    only on databases without incremental auto-vacuum and with at least
+    VACUUM_FREE_RATIO of their pages free.
+    """
+
+    def __init__(self, database=db):
+        self.database = database
+
+    async def _batches(self, fn, *args):
+        """Run fn until it reports nothing left; returns the total it reported"""
+        total = 0
+        while True:
+            count = await self.database.run(fn, *args)
+            total += count
+            if count < BATCH_ROWS:
+                return total
+            await asyncio.sleep(BATCH_PAUSE)
+
+    async def backfill(self):
+        rows = await self._batches(backfill_batch)
+        if rows:
+            logger.info(f"Rolled up {rows} existing deployments")
+
+    async def prune(self):
+        if await self.database.run(backfill_pending):
+            logger.info("Deployment rollup backfill not finished; raw rows kept")
+        else:
+            cutoff = (datetime.now() - timedelta(days=RAW_DAYS)).isoformat()
+            rows = await self._batches(retention_batch, cutoff)
+            if rows:
+                logger.info(f"Retention removed {rows} deployments older than {RAW_DAYS} days")
+
+        for period, days in (("hour", HOURLY_DAYS), ("day", DAILY_DAYS)):
+            if not days:
+                continue
+            cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+            after, deleted = "", 0
+            while after is not None:
+                after, count = await self.database.run(prune_rollups_batch, period, cutoff, after)
+                deleted += count
+                await asyncio.sleep(BATCH_PAUSE)
+            if deleted:
+                logger.info(f"Retention removed {deleted} {period} rollups older than {days} days")
+
+    async def vacuum(self):
+        mode, free, total = await self.database.run(free_pages)
+        if mode == 2:
+            while free:
+                await self.database.run(incremental_vacuum)
+                remaining = (await self.database.run(free_pages))[1]
+                if remaining >= free:
+                    break
+                free = remaining
+                await asyncio.sleep(BATCH_PAUSE)
+        elif total and free / total >= VACUUM_FREE_RATIO:
+            # Blocks writers while the file is rewritten; the write-behind
+            # queue holds its rows until it is done
+            logger.info(f"VACUUM: {free} of {total} pages free")
+            await self.database.run(full_vacuum)
+
+    async def run_due(self):
+        """Run whichever maintenance tasks are due and claimed by this process"""
+        if await self.database.run(claim, "retention", INTERVAL):
+            await self.backfill()
+            if RETENTION_ENABLED:
+                await self.prune()
+        if ANALYZE_INTERVAL and await self.database.run(claim, "analyze", ANALYZE_INTERVAL):
+            await self.database.run(analyze)
+        if VACUUM_INTERVAL and await self.database.run(claim, "vacuum", VACUUM_INTERVAL):
+            await self.vacuum()
+
+    async def watch(self):
+        """Check for due tasks in the background"""
+        while True:
+            await asyncio.sleep(CHECK_INTERVAL)
+            try:
+                await self.run_due()
+            except Exception as e:
+                logger.error(f"Database maintenance failed: {e}")
+
+maintenance = Maintenance()
@@ -13,9 +13,20 @@ with open(config_path, "r") as f:
     config = yaml.safe_load(f)
 
 DATABASE_PATH = config['database']['path']
+BUSY_TIMEOUT_MS = config['database'].get('busy_timeout_ms', 5000)
 logger = logging.getLogger(__name__)
 
-def get_db_connection():
+def configure_connection(conn):
+    """Apply the connection settings every database handle should use"""
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers proceed while a writer commits; NORMAL is durable
+    # across application crashes in WAL mode and avoids an fsync per commit
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT_MS)}")
+    return conn
+
+def get_db_connection(check_same_thread=True):
     """Get a database connection with proper error handling"""
     try:
         # Ensure directory exists
@@ -23,8 +34,9 @@ def get_db_connection():
         if db_dir:
             os.makedirs(db_dir, exist_ok=True)
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = sqlite3.connect(DATABASE_PATH, timeout=BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=check_same_thread)
+        configure_connection(conn)
         logger.info(f"Database connection established: {DATABASE_PATH}")
         return conn
     except Exception as e:
@@ -32,72 +44,18 @@ def get_db_connection():
         # Try fallback location
         fallback_path = "/tmp/deployments.db"
         logger.info(f"Trying fallback database: {fallback_path}")
-        conn = sqlite3.connect(fallback_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+        conn = sqlite3.connect(fallback_path, timeout=BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=check_same_thread)
+        return configure_connection(conn)
 
 def init_db():
-    """Initialize the database with required tables"""
+    """Create the database, or bring an existing one up to the current schema"""
+    from schema import migrate
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Create deployments table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS deployments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            server_id TEXT NOT NULL,
-            timestamp DATETIME NOT NULL,
-            ruleset_version TEXT,
-            success BOOLEAN NOT NULL,
-            error_message TEXT,
-            file_count INTEGER,
-            deployment_time REAL
-        )
-    ''')
-    
-    # Create servers table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS servers (
-            server_id TEXT PRIMARY KEY,
-            description TEXT,
-            first_seen DATETIME,
-            last_seen DATETIME,
-            is_active BOOLEAN DEFAULT 1,
-            contact_email TEXT,
-            environment TEXT,
-            location TEXT
-        )
-    ''')
-    
-    # Create api_keys table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS api_keys (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            key TEXT UNIQUE NOT NULL,
-            key_hash TEXT NOT NULL,
-            server_id TEXT,
-            is_admin BOOLEAN DEFAULT 0,
-            created_at DATETIME,
-            last_used DATETIME,
-            active BOOLEAN DEFAULT 1,
-            FOREIGN KEY (server_id) REFERENCES servers (server_id)
-        )
-    ''')
-    
-    # Create deployment_files table (for detailed tracking)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS deployment_files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            deployment_id INTEGER,
-            filename TEXT NOT NULL,
-            size_bytes INTEGER,
-            action TEXT,  -- 'added', 'modified', 'deleted'
-            FOREIGN KEY (deployment_id) REFERENCES deployments (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
     logger.info("Database initialized successfully")
     
     # Verify the database file was created
@@ -111,6 +69,13 @@ def init_db():
 def record_deployment(server_id, success=True, ruleset_version=None, 
                      error_message=None, file_count=0, deployment_time=0.0):
     """Record a deployment in the database"""
+    from storage import writer
+    if writer.running:
+        # Inside the API: let the write-behind queue batch it
+        writer.record_deployment(server_id, success, ruleset_version,
+                                 error_message, file_count, deployment_time)
+        return
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -128,11 +93,14 @@ def record_deployment(server_id, success=True, ruleset_version=None,
         deployment_time
     ))
     
-    # Update server's last_seen timestamp
+    # Update server's last_seen timestamp (an upsert: REPLACE would delete
+    # the row's other columns and bypass the fleet_stats triggers)
+    now = datetime.now().isoformat()
     cursor.execute('''
-        INSERT OR REPLACE INTO servers (server_id, last_seen, is_active)
-        VALUES (?, ?, 1)
-    ''', (server_id, datetime.now().isoformat()))
+        INSERT INTO servers (server_id, first_seen, last_seen, is_active)
+        VALUES (?, ?, ?, 1)
+        ON CONFLICT (server_id) DO UPDATE SET last_seen = excluded.last_seen, is_active = 1
+    ''', (server_id, now, now))
     
     conn.commit()
     conn.close()
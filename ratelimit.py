@@ -0,0 +1,195 @@
+"""
+Token-bucket rate limiting shared by all workers
+"""
+import os
+import math
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import logging
+import functools
+import ipaddress
+
+from starlette.responses import JSONResponse
+
+from models import config
+
+rate_config = config.get('rate_limit', {})
+RATE_LIMIT_ENABLED = rate_config.get('enabled', False)
+REQUESTS_PER_MINUTE = rate_config.get('requests_per_minute', 60)  # per API key or token
+BURST_LIMIT = rate_config.get('burst_limit', 10)
+IP_REQUESTS_PER_MINUTE = rate_config.get('ip_requests_per_minute', 600)  # per client address
+IP_BURST_LIMIT = rate_config.get('ip_burst_limit', 100)
+STATE_FILE = rate_config.get('state_file', '/dev/shm/wazuh-api-ratelimit')
+SLOTS = rate_config.get('slots', 65536)  # buckets kept; the least recently used is reused
+# Addresses or networks of reverse proxies whose X-Forwarded-For/X-Real-IP
+# name the client; a list or a comma-separated string
+TRUSTED_PROXIES = rate_config.get('trusted_proxies') or []
+if isinstance(TRUSTED_PROXIES, str):
+    TRUSTED_PROXIES = TRUSTED_PROXIES.split(",")
+TRUSTED_NETWORKS = [ipaddress.ip_network(proxy.strip(), strict=False) for proxy in TRUSTED_PROXIES if proxy.strip()]
+EXEMPT_PATHS = {"/", "/health", "/metrics"}
+PROBE_SLOTS = 4
+
+SLOT = struct.Struct("<Qdd")  # key hash (0 = free), tokens, last refill (unix time)
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=SLOTS)
+def bucket_hash(kind, value):
+    """Hash that is the same in every worker (unlike hash()); value is str or bytes"""
+    if isinstance(value, str):
+        value = value.encode()
+    digest = hashlib.blake2b(value, digest_size=8, person=kind).digest()
+    return int.from_bytes(digest, "little") or 1
+
+@functools.lru_cache(maxsize=1024)
+def is_trusted_proxy(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_NETWORKS)
+
+def client_address(scope):
+    """Address of the client behind any trusted proxies, or None.
+
+    The peer is the client unless it is a trusted proxy; then the client is
+    the last X-Forwarded-For hop that is not itself a trusted proxy (each
+    proxy appends the address it saw, so earlier hops are the client's word
+    and may be forged), or X-Real-IP without X-Forwarded-For.
+    """
+    client = scope.get("client")
+    if not client:
+        return None
+    address = client[0]
+    if not is_trusted_proxy(address):
+        return address
+
+    forwarded = []
+    real_ip = None
+    for name, value in scope["headers"]:
+        if name == b"x-forwarded-for":
+            forwarded.extend(hop.strip() for hop in value.decode("latin-1").split(","))
+        elif name == b"x-real-ip":
+            real_ip = value.decode("latin-1").strip()
+    if not forwarded and real_ip:
+        return real_ip
+    for hop in reversed(forwarded):
+        if hop:
+            address = hop
+            if not is_trusted_proxy(hop):
+                break
+    return address
+
+class TokenBuckets:
+    """Token buckets in a memory-mapped file, so every worker draws from the same ones.
+
+    The file is a fixed open-addressed table of SLOT records; a key probes
+    PROBE_SLOTS slots from its hash and, if none holds it, takes a free slot
+    or the one refilled longest ago. An flock on the file serializes the
+    read-modify-write, which is two system calls per request.
+    """
+
+    def __init__(self, path=STATE_FILE, slots=SLOTS):
+        self.slots = slots
+        size = slots * SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size != size:
+                # New file or a different slot count: start empty
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+
+    def _probe(self, key, offset):
+        """Slot for a key not in its home slot: (offset, tokens, last), last None if new"""
+        reuse = None
+        reuse_last = math.inf
+        for i in range(PROBE_SLOTS):
+            slot_key, tokens, last = SLOT.unpack_from(self._map, offset)
+            if slot_key == key:
+                return offset, tokens, last
+            if slot_key == 0:
+                last = -math.inf
+            if last < reuse_last:
+                reuse, reuse_last = offset, last
+            offset = (offset + SLOT.size) % (self.slots * SLOT.size)
+        return reuse, 0.0, None
+
+    def take(self, buckets):
+        """Take one token from every (key, per_second, capacity) bucket.
+
+        Returns 0 if all had one, else the seconds until they will (and
+        takes nothing).
+        """
+        now = time.time()
+        mm = self._map
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            found = []
+            wait = 0.0
+            for key, rate, capacity in buckets:
+                offset = key % self.slots * SLOT.size
+                slot_key, tokens, last = SLOT.unpack_from(mm, offset)
+                if slot_key != key:
+                    offset, tokens, last = self._probe(key, offset)
+                if last is None:
+                    tokens = capacity
+                elif now > last:
+                    tokens = min(capacity, tokens + (now - last) * rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                found.append((offset, key, tokens))
+            if wait:
+                return wait
+            for offset, key, tokens in found:
+                SLOT.pack_into(mm, offset, key, tokens - 1, now)
+            return 0.0
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+class RateLimitMiddleware:
+    """Limits each credential (API key or access token) and each client address.
+
+    Runs before authentication, so the credential is limited as presented;
+    a client minting new tokens is still held back by the limits on the
+    token endpoint's API key and on its address. Behind a reverse proxy the
+    address comes from its forwarding headers, if the proxy is listed in
+    TRUSTED_PROXIES (otherwise all clients share the proxy's bucket).
+    Excess requests get 429 with Retry-After.
+    """
+
+    def __init__(self, app, buckets=None):
+        self.app = app
+        self.buckets = buckets or TokenBuckets()
+        self.key_rate = REQUESTS_PER_MINUTE / 60
+        self.ip_rate = IP_REQUESTS_PER_MINUTE / 60
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS:
+            return await self.app(scope, receive, send)
+
+        limits = []
+        address = client_address(scope)
+        if address:
+            limits.append((bucket_hash(b"ip", address), self.ip_rate, IP_BURST_LIMIT))
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                limits.append((bucket_hash(b"key", value), self.key_rate, BURST_LIMIT))
+                break
+
+        wait = self.buckets.take(limits) if limits else 0
+        if wait:
+            response = JSONResponse(
+                {"detail": "Rate limit exceeded"},
+                status_code=429,
+                headers={"Retry-After": str(math.ceil(wait))}
+            )
+            return await response(scope, receive, send)
+        return await self.app(scope, receive, send)
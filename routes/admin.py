@@ -0,0 +1,135 @@
+"""
+Administration endpoints
+"""
+import os
+import json
+import time
+import asyncio
+import secrets
+from datetime import datetime, timedelta
+
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
+
+from auth import require_admin
+from storage import db, writer
+from schema import ROLLUP_PERIODS, FLEET
+from admin_dashboard import DashboardCache, server_page, deployment_history, CACHE_TTL, KEEPALIVE, MAX_PAGE_SIZE
+from utils.profiler import (
+    PROFILE_DIR, PROFILE_HEADER, read_control, write_control, merged_stacks, request_profiler
+)
+
+router = APIRouter()
+dashboard_cache = DashboardCache(db)
+
+class ProfileRequest(BaseModel):
+    enabled: bool = True
+    sample_rate: float = Field(0.01, ge=0.0, le=1.0)  # fraction of all requests profiled
+    duration: int = Field(300, ge=0, le=86400)  # seconds until profiling switches itself off; 0 = never
+    reset: bool = False  # discard the stacks collected so far
+
+def profile_status(control):
+    """Control settings as returned to admins"""
+    return {
+        "enabled": bool(control.get('enabled')) and (
+            not control.get('until') or control['until'] > time.time()
+        ),
+        "sample_rate": control.get('sample_rate', 0.0),
+        "until": control.get('until'),
+        "header": PROFILE_HEADER.decode(),
+        "token": control.get('token'),
+        "worker": {"pid": os.getpid(), **request_profiler.stats()}
+    }
+
+@router.get("/profile")
+async def get_profile(admin_info: dict = Depends(require_admin)):
+    """Current profiling settings (admin only)"""
+    return profile_status(await run_in_threadpool(read_control))
+
+@router.put("/profile")
+async def set_profile(profile_request: ProfileRequest, admin_info: dict = Depends(require_admin)):
+    """Switch request profiling on or off in every worker (admin only).
+
+    Besides the sampled fraction, any request sent with the returned token
+    in the X-Profile header is profiled while profiling is on.
+    """
+    control = await run_in_threadpool(read_control)
+    generation = control.get('generation') or 0
+    control = {
+        "enabled": profile_request.enabled,
+        "sample_rate": profile_request.sample_rate,
+        "until": time.time() + profile_request.duration if profile_request.duration else None,
+        "token": control.get('token') if control.get('enabled') else secrets.token_urlsafe(16),
+        "generation": generation + 1 if profile_request.reset else generation
+    }
+    await run_in_threadpool(write_control, control)
+    return profile_status(control)
+
+@router.get("/profile/stacks", response_class=PlainTextResponse)
+async def get_profile_stacks(admin_info: dict = Depends(require_admin)):
+    """Collapsed stacks of every worker, for flamegraph.pl or speedscope (admin only)"""
+    stacks = await run_in_threadpool(merged_stacks, PROFILE_DIR)
+    return PlainTextResponse("".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items())))
+
+async def dashboard_events(version):
+    """Server-sent events: the dashboard whenever its counters change, comments in between"""
+    idle = 0
+    while True:
+        stats = await dashboard_cache.get()
+        if str(stats['version']) != version:
+            version = str(stats['version'])
+            idle = 0
+            yield f"id: {version}\nevent: dashboard\ndata: {json.dumps(stats)}\n\n".encode()
+        elif idle >= KEEPALIVE:
+            idle = 0
+            yield b": keepalive\n\n"
+        await asyncio.sleep(CACHE_TTL)
+        idle += CACHE_TTL
+
+@router.get("/dashboard")
+async def get_dashboard(request: Request, admin_info: dict = Depends(require_admin)):
+    """Fleet counters and the latest deployments, at most CACHE_TTL seconds old (admin only).
+    
+    With Accept: text/event-stream the connection stays open and gets an
+    event whenever the counters change; Last-Event-ID (the "version" of the
+    last event seen) skips the first event if nothing changed since.
+    """
+    if "text/event-stream" in (request.headers.get("accept") or ""):
+        return StreamingResponse(
+            dashboard_events(request.headers.get("last-event-id")),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    return await dashboard_cache.get()
+
+@router.get("/servers")
+async def list_servers(
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    admin_info: dict = Depends(require_admin)
+):
+    """Registered servers, most recently seen first, one page at a time (admin only)"""
+    page = await db.run(server_page, limit, offset)
+    writer.apply_pending(page['servers'])
+    return page
+
+@router.get("/history")
+async def get_history(
+    period: str = Query("day", pattern=f"^({'|'.join(ROLLUP_PERIODS)})$"),
+    server_id: str = Query(FLEET),
+    days: int = Query(7, ge=1, le=3660),
+    admin_info: dict = Depends(require_admin)
+):
+    """Deployments per hour or day, fleet-wide or for one server (admin only).
+
+    Read from the rollups, so history outlives the raw rows removed by
+    retention; p95_time is estimated from a histogram of deployment times.
+    """
+    since = (datetime.now() - timedelta(days=days)).isoformat()[:ROLLUP_PERIODS[period]]
+    return {
+        "period": period,
+        "server_id": server_id,
+        "buckets": await db.run(deployment_history, period, server_id, since)
+    }
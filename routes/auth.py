@@ -0,0 +1,29 @@
+"""
+Authentication endpoints
+"""
+from fastapi import APIRouter, HTTPException, Depends
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel
+
+from auth import require_api_key, issue_token, require_admin, revoke_api_key
+
+router = APIRouter()
+
+class RevokeRequest(BaseModel):
+    key: str
+
+@router.post("/token")
+async def create_token(key_info: dict = Depends(require_api_key)):
+    """Exchange an API key for a short-lived access token"""
+    if 'key' not in key_info:
+        # A token must not renew itself past its expiry (or its key's revocation)
+        raise HTTPException(status_code=401, detail="An API key is required to obtain a token")
+    return issue_token(key_info)
+
+@router.post("/revoke")
+async def revoke_key(revoke_request: RevokeRequest, admin_info: dict = Depends(require_admin)):
+    """Deactivate an API key (admin only)"""
+    revoked = await run_in_threadpool(revoke_api_key, revoke_request.key)
+    if not revoked:
+        raise HTTPException(status_code=404, detail="API key not found")
+    return {"success": True, "revoked": True}
@@ -1,19 +1,35 @@
 """
 Rules API endpoints
 """
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import JSONResponse, FileResponse
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-import sqlite3
+from fastapi import APIRouter, HTTPException, Depends, Request, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from typing import List, Optional
 from datetime import datetime
 from pathlib import Path
 import yaml
-import tempfile
-import zipfile
 import os
+import json
+import time
+import threading
+import logging
+
+from auth import require_api_key
+from storage import db, writer
+from utils.git_sync import resolve_commit, get_ruleset_changes
+from utils.package_cache import (
+    DELTA_PREFIX, PACKAGE_FORMATS, iter_zip, iter_delta_zip, iter_package, iter_file_range, minified_entries,
+    write_chunks, package_cache
+)
+from utils.repo_index import repo_index, snapshot_at, PUBLISH_ENABLED
+from utils.publisher import publisher
+from utils.admission import ADMISSION_ENABLED, transfer_gate
+from utils.revision_watch import revision_watch, WATCH_TIMEOUT, MAX_WATCH_TIMEOUT, SSE_KEEPALIVE
+from utils.rule_index import rule_index
+from utils.subsets import make_selection, parse_ranges, selection_for, configured_selections, resolve_subset
 
 router = APIRouter()
-security = HTTPBearer()
 
 # Load config
 config_path = Path(__file__).parent.parent / "config.yaml"
@@ -22,129 +38,507 @@ with open(config_path, "r") as f:
 
 REPO_PATH = Path(config['git']['repo_path'])
 
-def verify_api_key(api_key: str) -> dict:
-    """Simple API key verification"""
-    conn = sqlite3.connect('deployments.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT key, server_id FROM api_keys WHERE key = ? AND active = 1", (api_key,))
-    result = cursor.fetchone()
-    conn.close()
+package_config = config.get('package', {})
+ENABLED_FORMATS = [fmt for fmt in package_config.get('formats', ["zip"]) if fmt in PACKAGE_FORMATS]
+DEFAULT_FORMAT = package_config.get('default_format', "zip")
+PRECOMPUTE_FORMATS = [fmt for fmt in package_config.get('precompute', [DEFAULT_FORMAT]) if fmt in ENABLED_FORMATS]
+MINIFY_DEFAULT = package_config.get('minify', False)
+SERVER_SELECTION_TTL = 60  # seconds a server's environment/location lookup is reused
+
+logger = logging.getLogger(__name__)
+
+class FileRequest(BaseModel):
+    files: List[str]
+    revision: Optional[str] = None
+
+async def requested_snapshot(server_info, revision=None):
+    """The served snapshot, or the commit, tag or branch asked for with ?revision=.
+
+    With publishing enabled only revisions that passed validation are
+    served to non-admin keys, as they are through `current`.
+    """
+    if not revision:
+        return repo_index.snapshot
+    snapshot = await run_in_threadpool(snapshot_at, revision)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail=f"Unknown revision: {revision}")
+    if PUBLISH_ENABLED and not server_info.get('is_admin'):
+        report = await run_in_threadpool(publisher.load_report, snapshot.revision)
+        if not report or not report.get('valid'):
+            raise HTTPException(status_code=403, detail=f"Revision {revision} has not passed validation")
+    return snapshot
+
+def ruleset_version(snapshot):
+    """What deployments.ruleset_version records: the commit, or the content revision without git"""
+    return snapshot.commit or snapshot.revision
+
+@router.get("/list")
+async def list_rules(revision: str = None, server_info: dict = Depends(require_api_key)):
+    """List available rules (of a past commit or tag with ?revision=)"""
+    snapshot = await requested_snapshot(server_info, revision)
     
-    if not result:
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    # Update server last seen (batched by the write-behind queue)
+    writer.touch_server(server_info['server_id'])
     
-    return {"key": result[0], "server_id": result[1]}
+    return Response(content=snapshot.list_body(server_info['server_id']), media_type="application/json")
 
-@router.get("/list")
-async def list_rules(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """List available rules"""
-    api_key = credentials.credentials
+def etag_matches(if_none_match, *etags):
+    """Check an If-None-Match header value against strong ETags"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(etag in candidates or f"W/{etag}" in candidates for etag in etags)
+
+def parse_range(range_header, size):
+    """(first, last) byte of a single "bytes=" range, or None to send the whole file.
     
-    # Verify API key
-    server_info = verify_api_key(api_key)
+    Multiple ranges and malformed headers are ignored, as RFC 9110 allows;
+    a range starting past the end gets 416.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            first = int(first)
+            last = min(int(last), size - 1) if last else size - 1
+        else:
+            # Suffix range: the final N bytes
+            first = max(size - int(last), 0)
+            last = size - 1
+    except ValueError:
+        return None
+    if first > last or first >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return first, last
+
+def archive_stream(chunks, filename, media_type, headers):
+    """Send an archive as it is generated"""
+    headers = dict(headers, **{"Content-Disposition": f'attachment; filename="{filename}"'})
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+def artifact_stream(artifact, filename, media_type, headers):
+    """Send a whole cached artifact from the file package_cache.open() returned"""
+    size = os.fstat(artifact.fileno()).st_size
+    headers = dict(headers, **{"Content-Length": str(size)})
+    return archive_stream(iter_file_range(artifact, 0, size - 1), filename, media_type, headers)
+
+def negotiate_format(requested, accept):
+    """Pick a package format from ?format= or the Accept header"""
+    if requested:
+        if requested not in ENABLED_FORMATS:
+            raise HTTPException(
+                status_code=406, detail=f"Unsupported format: {requested} (available: {', '.join(ENABLED_FORMATS)})"
+            )
+        return requested
+    if not accept:
+        return DEFAULT_FORMAT
     
-    # Get rules from repository
-    rules = []
-    decoders = []
+    by_media_type = {PACKAGE_FORMATS[fmt][0]: fmt for fmt in ENABLED_FORMATS}
+    ranges = []
+    for position, part in enumerate(accept.split(",")):
+        media_type, _, params = part.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        ranges.append((-quality, position, media_type.strip().lower()))
     
-    rules_path = REPO_PATH / "rules"
-    decoders_path = REPO_PATH / "decoders"
+    for negative_quality, _, media_type in sorted(ranges):
+        if negative_quality >= 0:
+            break
+        if media_type in by_media_type:
+            return by_media_type[media_type]
     
-    if rules_path.exists():
-        for xml_file in rules_path.glob("*.xml"):
-            rules.append(xml_file.name)
+    # Older clients send generic Accept headers and expect the default
+    return DEFAULT_FORMAT
+
+SERVER_PROFILE_QUERY = "SELECT environment, location FROM servers WHERE server_id = ?"
+_server_selections = {}  # server_id -> (expires_at, Selection or None)
+
+async def server_selection(server_id):
+    """Subset configured for a server through servers.environment/location, or None"""
+    if not configured_selections():
+        return None
     
-    if decoders_path.exists():
-        for xml_file in decoders_path.glob("*.xml"):
-            decoders.append(xml_file.name)
+    cached = _server_selections.get(server_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
     
-    # Update server last seen
-    conn = sqlite3.connect('deployments.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE servers SET last_seen = ? WHERE server_id = ?
-    """, (datetime.now().isoformat(), server_info['server_id']))
-    conn.commit()
-    conn.close()
+    # Schema migration 2 adds environment/location to older databases
+    row = await db.fetchone(SERVER_PROFILE_QUERY, (server_id,))
+    selection = selection_for(row[0], row[1]) if row else None
+    _server_selections[server_id] = (time.monotonic() + SERVER_SELECTION_TTL, selection)
+    return selection
+
+async def request_selection(server_info, groups=None, rule_ids=None):
+    """Subset asked for with ?groups=/?rule_ids=, else the server's configured one"""
+    if groups or rule_ids:
+        try:
+            selection = make_selection((groups or "").split(","), parse_ranges([rule_ids or ""]))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return selection or None
+    return await server_selection(server_info['server_id'])
+
+def subset_files(snapshot, selection):
+    """Relative paths of the files a selection needs (dependency closure)"""
+    return [
+        rel_path for rel_path in resolve_subset(rule_index.get(snapshot), selection)
+        if rel_path in snapshot.files
+    ]
+
+def package_key(revision, package_format, minify, selection=None):
+    """Cache key for one representation of a revision"""
+    subset = f"-s{selection.key}" if selection else ""
+    return f"{revision}{subset}{'-min' if minify else ''}-{package_format.replace('.', '')}"
+
+def package_chunks(snapshot, package_format, minify, files=None):
+    entries = snapshot.source_files(files)
+    if minify:
+        entries = minified_entries(entries)
+    return iter_package(entries, package_format)
+
+def precompute_packages(snapshot):
+    """Build the configured package formats (full and per configured subset)
+    for a new revision in the background"""
+    def build():
+        for selection in [None] + sorted(configured_selections()):
+            for package_format in PRECOMPUTE_FORMATS:
+                suffix = PACKAGE_FORMATS[package_format][1]
+                try:
+                    files = subset_files(snapshot, selection) if selection else None
+                    package_cache.get(
+                        package_key(snapshot.revision, package_format, MINIFY_DEFAULT, selection),
+                        lambda dest: write_chunks(dest, package_chunks(snapshot, package_format, MINIFY_DEFAULT, files)),
+                        suffix=suffix
+                    )
+                except Exception as e:
+                    logger.error(f"Precomputing {package_format} package failed: {e}")
+    threading.Thread(target=build, name="package-precompute", daemon=True).start()
+
+@router.get("/package")
+async def download_package(request: Request, format: str = None, minify: bool = None,
+                           groups: str = None, rule_ids: str = None, revision: str = None,
+                           server_info: dict = Depends(require_api_key)):
+    """Download the rules as one package (zip, tar.gz, tar.xz or tar.zst).
     
-    return {
-        "success": True,
-        "server": server_info['server_id'],
-        "rules": sorted(rules),
-        "decoders": sorted(decoders),
-        "counts": {
-            "rules": len(rules),
-            "decoders": len(decoders),
-            "total": len(rules) + len(decoders)
-        },
-        "timestamp": datetime.now().isoformat()
+    Servers with a subset configured for their environment/location, or
+    requests with ?groups= / ?rule_ids=, get only the selected rules and
+    everything they depend on. Once built, a package can be fetched in
+    pieces (Range, with If-Range) and carries its SHA-256 in Digest.
+    ?revision= (a commit, tag or branch; one that passed validation unless
+    the key is an admin's) packages that commit straight from the git
+    object database, e.g. to roll back or pin canaries.
+    """
+    package_format = negotiate_format(format, request.headers.get("accept"))
+    if minify is None:
+        minify = MINIFY_DEFAULT
+    media_type, suffix = PACKAGE_FORMATS[package_format]
+    selection = await request_selection(server_info, groups, rule_ids)
+    
+    # Packages are built once per ruleset revision, subset and format and served from the cache
+    snapshot = await requested_snapshot(server_info, revision)
+    key = package_key(snapshot.revision, package_format, minify, selection)
+    full_zip = package_format == "zip" and not minify and not selection
+    etag = f'"{snapshot.revision}"' if full_zip else f'"{key}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept",
+        "X-Ruleset-Revision": snapshot.revision,
+        "X-Package-Format": package_format
     }
+    
+    # Lets the puller ask for deltas against this commit next time
+    if snapshot.commit:
+        headers["X-Ruleset-Commit"] = snapshot.commit
+    
+    files = None
+    if selection:
+        headers["X-Ruleset-Subset"] = selection.key
+        files = await run_in_threadpool(subset_files, snapshot, selection)
+    
+    # The bare revision also matches full packages, whichever format it was fetched in
+    matching = (etag, f'"{snapshot.revision}"') if not selection else (etag,)
+    if etag_matches(request.headers.get("if-none-match"), *matching):
+        return Response(status_code=304, headers=headers)
+    
+    package_file = package_cache.open(key, suffix)
+    range_header = request.headers.get("range")
+    if range_header and not package_file:
+        # A resumed download needs the complete artifact, so wait for the build
+        package_file = await run_in_threadpool(
+            package_cache.open, key, suffix,
+            lambda dest: write_chunks(dest, package_chunks(snapshot, package_format, minify, files))
+        )
+    
+    byte_range = None
+    if package_file:
+        package_size = os.fstat(package_file.fileno()).st_size
+        digest = await run_in_threadpool(package_cache.digest, package_file)
+        headers["Accept-Ranges"] = "bytes"
+        headers["Digest"] = f"sha-256={digest}"
+        headers["Repr-Digest"] = f"sha-256=:{digest}:"
+        # If-Range holds the ETag of the partial copy; ranges of another revision are useless
+        if_range = request.headers.get("if-range")
+        if range_header and (if_range is None or if_range.strip() == etag):
+            try:
+                byte_range = parse_range(range_header, package_size)
+            except HTTPException:
+                package_file.close()
+                raise
+    
+    started = None
+    if ADMISSION_ENABLED:
+        if byte_range:
+            expected_bytes = byte_range[1] - byte_range[0] + 1
+        elif package_file:
+            expected_bytes = package_size
+        else:
+            # Not built yet: the uncompressed size is an upper bound
+            expected_bytes = sum(
+                snapshot.files[rel_path].size for rel_path in (files if files is not None else snapshot.files)
+            )
+        started = transfer_gate.admit(expected_bytes)
+        if started is None:
+            if package_file:
+                package_file.close()
+            return transfer_gate.reject()
+    
+    # Log the download (once, not for every resumed piece)
+    if byte_range is None or byte_range[0] == 0:
+        file_count = len(files) if files is not None else len(snapshot.files)
+        writer.record_deployment(
+            server_info['server_id'], ruleset_version=ruleset_version(snapshot), file_count=file_count
+        )
+    
+    filename = f"wazuh-rules-{datetime.now().strftime('%Y%m%d')}{suffix}"
+    if byte_range:
+        first, last = byte_range
+        headers["Content-Range"] = f"bytes {first}-{last}/{package_size}"
+        headers["Content-Length"] = str(last - first + 1)
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        response = StreamingResponse(
+            iter_file_range(package_file, first, last), status_code=206, media_type=media_type, headers=headers
+        )
+    elif package_file:
+        response = artifact_stream(package_file, filename, media_type, headers)
+    else:
+        # First request for this revision: stream the archive while it is cached
+        chunks = package_cache.stream(key, package_chunks(snapshot, package_format, minify, files), suffix)
+        response = archive_stream(chunks, filename, media_type, headers)
+    return transfer_gate.track(response, started)
 
-@router.get("/package")
-async def download_package(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Download all rules as zip package"""
-    api_key = credentials.credentials
-    
-    # Verify API key
-    server_info = verify_api_key(api_key)
-    
-    # Create temp zip file
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-    
-    with zipfile.ZipFile(temp_file.name, 'w') as zipf:
-        # Add rules
-        rules_path = REPO_PATH / "rules"
-        if rules_path.exists():
-            for xml_file in rules_path.glob("*.xml"):
-                zipf.write(xml_file, f"rules/{xml_file.name}")
-        
-        # Add decoders
-        decoders_path = REPO_PATH / "decoders"
-        if decoders_path.exists():
-            for xml_file in decoders_path.glob("*.xml"):
-                zipf.write(xml_file, f"decoders/{xml_file.name}")
+@router.get("/delta")
+async def download_delta(since: str, groups: str = None, rule_ids: str = None,
+                         server_info: dict = Depends(require_api_key)):
+    """Download only the rules changed since a given commit"""
+    selection = await request_selection(server_info, groups, rule_ids)
+    snapshot = repo_index.snapshot
+    head = snapshot.commit
+    if not head:
+        raise HTTPException(status_code=404, detail="Repository has no git history")
+    
+    since_commit = await run_in_threadpool(resolve_commit, since)
+    if not since_commit:
+        raise HTTPException(status_code=404, detail=f"Unknown revision: {since}")
+    
+    headers = {"X-Ruleset-Commit": head, "X-Ruleset-Revision": snapshot.revision, "Cache-Control": "no-cache"}
+    wanted = None
+    if selection:
+        headers["X-Ruleset-Subset"] = selection.key
+        wanted = set(await run_in_threadpool(subset_files, snapshot, selection))
+    if since_commit == head:
+        return Response(status_code=304, headers=headers)
+    
+    key = f"{DELTA_PREFIX}{since_commit}-{head}" + (f"-s{selection.key}" if selection else "")
+    filename = f"wazuh-rules-delta-{since_commit[:8]}-{head[:8]}.zip"
+    package_file = package_cache.open(key)
+    if not package_file:
+        changes = await run_in_threadpool(get_ruleset_changes, since_commit, head)
+        if changes is None:
+            raise HTTPException(status_code=404, detail="Repository has no git history")
     
     # Log the download
-    conn = sqlite3.connect('deployments.db')
-    cursor = conn.cursor()
+    writer.record_deployment(
+        server_info['server_id'], ruleset_version=ruleset_version(snapshot),
+        file_count=len(wanted if wanted is not None else snapshot.files)
+    )
+    
+    if package_file:
+        return artifact_stream(package_file, filename, "application/zip", headers)
     
-    # Count files
-    rules_count = len(list(rules_path.glob("*.xml"))) if rules_path.exists() else 0
-    decoders_count = len(list(decoders_path.glob("*.xml"))) if decoders_path.exists() else 0
+    changed, deleted = changes
+    if wanted is not None:
+        changed = [(rel_path, data) for rel_path, data in changed if rel_path in wanted]
+    chunks = iter_delta_zip(changed, deleted, {"from": since_commit, "to": head})
+    return archive_stream(package_cache.stream(key, chunks), filename, "application/zip", headers)
+
+@router.get("/manifest")
+async def get_manifest(request: Request, groups: str = None, rule_ids: str = None,
+                       server_info: dict = Depends(require_api_key)):
+    """List every rule and decoder file (of the server's subset) with its size and SHA-256"""
+    selection = await request_selection(server_info, groups, rule_ids)
+    snapshot = repo_index.snapshot
+    etag = f'"{snapshot.revision}-s{selection.key}"' if selection else f'"{snapshot.revision}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "X-Ruleset-Revision": snapshot.revision}
+    if selection:
+        headers["X-Ruleset-Subset"] = selection.key
     
-    cursor.execute("""
-        INSERT INTO deployments (server_id, timestamp, success, file_count)
-        VALUES (?, ?, 1, ?)
-    """, (server_info['server_id'], datetime.now().isoformat(), rules_count + decoders_count))
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
     
-    conn.commit()
-    conn.close()
+    if not selection:
+        return Response(content=snapshot.manifest_body, media_type="application/json", headers=headers)
     
-    return FileResponse(
-        path=temp_file.name,
-        filename=f"wazuh-rules-{datetime.now().strftime('%Y%m%d')}.zip",
-        media_type="application/zip"
-    )
+    files = await run_in_threadpool(subset_files, snapshot, selection)
+    body = json.dumps({
+        "revision": snapshot.revision,
+        "commit": snapshot.commit,
+        "subset": selection.key,
+        "files": [
+            {"path": rel_path, "size": snapshot.files[rel_path].size, "sha256": snapshot.files[rel_path].sha256}
+            for rel_path in files
+        ]
+    })
+    return Response(content=body, media_type="application/json", headers=headers)
 
-@router.get("/stats")
-async def get_stats(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get repository statistics"""
-    api_key = credentials.credentials
-    server_info = verify_api_key(api_key)
+@router.post("/files")
+async def download_files(file_request: FileRequest, server_info: dict = Depends(require_api_key)):
+    """Download a selected set of rule and decoder files as one zip"""
+    snapshot = await requested_snapshot(server_info, file_request.revision)
+    files = []
+    for rel_path in sorted(set(file_request.files)):
+        if rel_path not in snapshot.files:
+            raise HTTPException(status_code=404, detail=f"File not found: {rel_path}")
+        files.append(rel_path)
     
-    rules_path = REPO_PATH / "rules"
-    decoders_path = REPO_PATH / "decoders"
+    started = None
+    if ADMISSION_ENABLED:
+        started = transfer_gate.admit(sum(snapshot.files[rel_path].size for rel_path in files))
+        if started is None:
+            return transfer_gate.reject()
+
+    # Log the download: manifest syncs deploy through here
+    writer.record_deployment(
+        server_info['server_id'], ruleset_version=ruleset_version(snapshot), file_count=len(files)
+    )
+
+    return transfer_gate.track(archive_stream(
+        iter_zip(snapshot.source_files(files)), "wazuh-rules-files.zip", "application/zip",
+        {"X-Ruleset-Revision": snapshot.revision}
+    ), started)
+
+@router.get("/search")
+async def search_rules(
+    type: str = Query("rule", pattern="^(rule|decoder)$"),
+    id: int = None,
+    id_from: int = None,
+    id_to: int = None,
+    level: int = None,
+    min_level: int = None,
+    group: str = None,
+    q: str = None,
+    name: str = None,
+    parent: str = None,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    server_info: dict = Depends(require_api_key)
+):
+    """Find rules by id, id range, level, group/compliance tag or description words,
+    or decoders by name and parent"""
+    snapshot = repo_index.snapshot
+    ruleset = rule_index.get(snapshot)
     
-    rules_count = len(list(rules_path.glob("*.xml"))) if rules_path.exists() else 0
-    decoders_count = len(list(decoders_path.glob("*.xml"))) if decoders_path.exists() else 0
+    if type == "decoder":
+        matches = ruleset.search_decoders(name=name, parent=parent)
+    else:
+        matches = ruleset.search_rules(
+            rule_id=id, id_from=id_from, id_to=id_to, level=level,
+            min_level=min_level, group=group, text=q
+        )
     
-    return {
-        "server": server_info['server_id'],
-        "repository": str(REPO_PATH),
-        "file_counts": {
-            "rules": rules_count,
-            "decoders": decoders_count,
-            "total": rules_count + decoders_count
+    return JSONResponse(
+        content={
+            "revision": snapshot.revision,
+            "total": len(matches),
+            "offset": offset,
+            "limit": limit,
+            "results": [match.to_dict() for match in matches[offset:offset + limit]]
         },
-        "last_checked": datetime.now().isoformat()
+        headers={"X-Ruleset-Revision": snapshot.revision}
+    )
+
+def revision_body(snapshot):
+    return {
+        "changed": True,
+        "revision": snapshot.revision,
+        "commit": snapshot.commit,
+        "checked_at": snapshot.checked_at
     }
+
+async def revision_events(since):
+    """Server-sent events: one per new revision, comments in between to keep proxies open"""
+    while True:
+        snapshot = await revision_watch.wait(since, SSE_KEEPALIVE)
+        if snapshot is None:
+            yield b": keepalive\n\n"
+            continue
+        since = snapshot.revision
+        yield f"id: {since}\nevent: revision\ndata: {json.dumps(revision_body(snapshot))}\n\n".encode()
+
+@router.get("/watch")
+async def watch_revision(request: Request, since: str = None, timeout: float = None,
+                         server_info: dict = Depends(require_api_key)):
+    """Wait for a ruleset revision other than `since`.
+    
+    Long-poll by default: answers as soon as the served revision differs
+    from since (at once if it already does), or with "changed": false after
+    timeout seconds. With Accept: text/event-stream the connection stays
+    open and gets an event for every new revision; Last-Event-ID takes the
+    place of since when a client reconnects.
+    """
+    writer.touch_server(server_info['server_id'])
+    
+    if "text/event-stream" in (request.headers.get("accept") or ""):
+        since = request.headers.get("last-event-id") or since
+        return StreamingResponse(
+            revision_events(since),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    
+    timeout = min(WATCH_TIMEOUT if timeout is None else max(timeout, 0), MAX_WATCH_TIMEOUT)
+    snapshot = await revision_watch.wait(since, timeout)
+    if snapshot is None:
+        return {"changed": False, "revision": since}
+    return revision_body(snapshot)
+
+@router.get("/validation")
+async def get_validation(revision: str = None, server_info: dict = Depends(require_api_key)):
+    """Published revision and the validation report of the latest (or a given) revision"""
+    if not PUBLISH_ENABLED:
+        raise HTTPException(status_code=404, detail="Validation gating is disabled")
+    
+    status = await run_in_threadpool(publisher.status)
+    revision = revision or (status.get('latest') or {}).get('revision')
+    report = await run_in_threadpool(publisher.load_report, revision) if revision else None
+    if revision and report is None:
+        raise HTTPException(status_code=404, detail=f"No validation report for {revision}")
+    
+    return dict(status, report=report)
+
+@router.get("/stats")
+async def get_stats(server_info: dict = Depends(require_api_key)):
+    """Get repository statistics"""
+    snapshot = repo_index.snapshot
+    return Response(content=snapshot.stats_body(server_info['server_id']), media_type="application/json")
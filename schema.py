@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Database schema: tables, versioned migrations and the indexes hot queries rely on
+
+Usage: python3 schema.py [--check | --status]
+"""
+import os
+import sys
+import hashlib
+import sqlite3
+import logging
+import tempfile
+from datetime import datetime
+
+from models import get_db_connection, configure_connection
+
+logger = logging.getLogger(__name__)
+
+TABLES = {
+    "deployments": '''
+        CREATE TABLE IF NOT EXISTS deployments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id TEXT NOT NULL,
+            timestamp DATETIME NOT NULL,
+            ruleset_version TEXT,
+            success BOOLEAN NOT NULL,
+            error_message TEXT,
+            file_count INTEGER,
+            deployment_time REAL
+        )
+    ''',
+    "servers": '''
+        CREATE TABLE IF NOT EXISTS servers (
+            server_id TEXT PRIMARY KEY,
+            description TEXT,
+            first_seen DATETIME,
+            last_seen DATETIME,
+            is_active BOOLEAN DEFAULT 1,
+            contact_email TEXT,
+            environment TEXT,
+            location TEXT
+        )
+    ''',
+    "api_keys": '''
+        CREATE TABLE IF NOT EXISTS api_keys (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE NOT NULL,
+            key_hash TEXT NOT NULL,
+            server_id TEXT,
+            is_admin BOOLEAN DEFAULT 0,
+            created_at DATETIME,
+            last_used DATETIME,
+            active BOOLEAN DEFAULT 1,
+            revoked_at REAL,  -- epoch seconds; tokens issued before it are rejected
+            FOREIGN KEY (server_id) REFERENCES servers (server_id)
+        )
+    ''',
+    # Per-file detail of a deployment
+    "deployment_files": '''
+        CREATE TABLE IF NOT EXISTS deployment_files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            deployment_id INTEGER,
+            filename TEXT NOT NULL,
+            size_bytes INTEGER,
+            action TEXT,  -- 'added', 'modified', 'deleted'
+            FOREIGN KEY (deployment_id) REFERENCES deployments (id)
+        )
+    ''',
+}
+
+VERSION_TABLE = '''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at DATETIME NOT NULL
+    )
+'''
+
+# Single-row counters for the admin dashboard, kept current by triggers so
+# nothing has to count the deployments table
+FLEET_STATS_TABLE = """
+    CREATE TABLE fleet_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        servers_total INTEGER NOT NULL DEFAULT 0,
+        servers_active INTEGER NOT NULL DEFAULT 0,
+        api_keys_active INTEGER NOT NULL DEFAULT 0,
+        deployments_total INTEGER NOT NULL DEFAULT 0,
+        deployments_successful INTEGER NOT NULL DEFAULT 0,
+        changes INTEGER NOT NULL DEFAULT 0  -- bumped on every counted write
+    )
+"""
+
+FLEET_STATS_BACKFILL = """
+    INSERT INTO fleet_stats (id, servers_total, servers_active, api_keys_active,
+                             deployments_total, deployments_successful)
+    SELECT 1,
+        (SELECT COUNT(*) FROM servers),
+        (SELECT COUNT(*) FROM servers WHERE is_active IS 1),
+        (SELECT COUNT(*) FROM api_keys WHERE active IS 1),
+        (SELECT COUNT(*) FROM deployments),
+        (SELECT COUNT(*) FROM deployments WHERE success IS 1)
+"""
+
+FLEET_STATS_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS fleet_servers_insert AFTER INSERT ON servers BEGIN
+        UPDATE fleet_stats SET servers_total = servers_total + 1,
+            servers_active = servers_active + (NEW.is_active IS 1), changes = changes + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS fleet_servers_delete AFTER DELETE ON servers BEGIN
+        UPDATE fleet_stats SET servers_total = servers_total - 1,
+            servers_active = servers_active - (OLD.is_active IS 1), changes = changes + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS fleet_servers_update AFTER UPDATE OF is_active ON servers
+    WHEN (NEW.is_active IS 1) != (OLD.is_active IS 1) BEGIN
+        UPDATE fleet_stats SET servers_active = servers_active + (NEW.is_active IS 1) - (OLD.is_active IS 1),
+            changes = changes + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS fleet_api_keys_insert AFTER INSERT ON api_keys BEGIN
+        UPDATE fleet_stats SET api_keys_active = api_keys_active + (NEW.active IS 1), changes = changes + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS fleet_api_keys_delete AFTER DELETE ON api_keys BEGIN
+        UPDATE fleet_stats SET api_keys_active = api_keys_active - (OLD.active IS 1), changes = changes + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS fleet_api_keys_update AFTER UPDATE OF active ON api_keys
+    WHEN (NEW.active IS 1) != (OLD.active IS 1) BEGIN
+        UPDATE fleet_stats SET api_keys_active = api_keys_active + (NEW.active IS 1) - (OLD.active IS 1),
+            changes = changes + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS fleet_deployments_insert AFTER INSERT ON deployments BEGIN
+        UPDATE fleet_stats SET deployments_total = deployments_total + 1,
+            deployments_successful = deployments_successful + (NEW.success IS 1), changes = changes + 1;
+    END""",
+    # Deployment totals are all-time: rows removed by retention still count
+    "DROP TRIGGER IF EXISTS fleet_deployments_delete",
+]
+
+# Deployment time histogram bounds (seconds) behind the rollups' p95; a
+# last bucket counts everything slower
+ROLLUP_TIME_BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+ROLLUP_HISTOGRAM = [f"h{index}" for index in range(len(ROLLUP_TIME_BOUNDS) + 1)]
+ROLLUP_PERIODS = {"hour": 13, "day": 10}  # period -> length of the timestamp prefix naming its bucket
+FLEET = "*"  # server_id of the fleet-wide rollups
+
+ROLLUP_TABLES = [
+    f"""CREATE TABLE IF NOT EXISTS deployment_rollups (
+        period TEXT NOT NULL,  -- 'hour' or 'day'
+        bucket TEXT NOT NULL,  -- timestamp prefix: 'YYYY-MM-DDTHH' or 'YYYY-MM-DD'
+        server_id TEXT NOT NULL,  -- '{FLEET}' for the whole fleet
+        total INTEGER NOT NULL,
+        successful INTEGER NOT NULL,
+        files INTEGER NOT NULL,
+        time_sum REAL NOT NULL,
+        time_max REAL NOT NULL,
+        {", ".join(f"{column} INTEGER NOT NULL" for column in ROLLUP_HISTOGRAM)},
+        PRIMARY KEY (period, server_id, bucket)
+    ) WITHOUT ROWID""",
+    # Rollup backfill progress and when each maintenance task last ran
+    "CREATE TABLE IF NOT EXISTS maintenance (name TEXT PRIMARY KEY, value)",
+]
+
+def rollup_insert_sql(source):
+    """INSERT adding the deployments selected by source into every rollup they belong to"""
+    bounds = ROLLUP_TIME_BOUNDS
+    histogram = [f"d.t <= {bounds[0]}"]
+    histogram += [f"d.t > {lower} AND d.t <= {upper}" for lower, upper in zip(bounds, bounds[1:])]
+    histogram.append(f"d.t > {bounds[-1]}")
+    periods = " UNION ALL ".join(
+        f"SELECT '{period}' AS period, {length} AS length" for period, length in ROLLUP_PERIODS.items()
+    )
+    return f"""
+        INSERT INTO deployment_rollups (period, bucket, server_id, total, successful, files, time_sum, time_max,
+                                        {", ".join(ROLLUP_HISTOGRAM)})
+        SELECT p.period, substr(d.timestamp, 1, p.length), CASE f.fleet WHEN 1 THEN '{FLEET}' ELSE d.server_id END,
+            COUNT(*), SUM(d.success IS 1), SUM(IFNULL(d.file_count, 0)), SUM(d.t), MAX(d.t),
+            {", ".join(f"SUM({term})" for term in histogram)}
+        FROM (SELECT server_id, timestamp, success, file_count, IFNULL(deployment_time, 0) AS t FROM {source}) d,
+            ({periods}) p,
+            (SELECT 0 AS fleet UNION ALL SELECT 1) f
+        WHERE true
+        GROUP BY 1, 2, 3
+        ON CONFLICT (period, server_id, bucket) DO UPDATE SET
+            total = total + excluded.total,
+            successful = successful + excluded.successful,
+            files = files + excluded.files,
+            time_sum = time_sum + excluded.time_sum,
+            time_max = max(time_max, excluded.time_max),
+            {", ".join(f"{column} = {column} + excluded.{column}" for column in ROLLUP_HISTOGRAM)}
+    """
+
+ROLLUP_TRIGGER = f"""
+    CREATE TRIGGER IF NOT EXISTS rollup_deployments_insert AFTER INSERT ON deployments BEGIN
+        {rollup_insert_sql("(SELECT NEW.server_id AS server_id, NEW.timestamp AS timestamp, NEW.success AS success, "
+                           "NEW.file_count AS file_count, NEW.deployment_time AS deployment_time)")};
+    END
+"""
+
+# Secondary indexes; check() holds the queries in hot_queries() to them.
+# API keys are also found through the UNIQUE index on key (and
+# API_KEY_LOOKUP_INDEX), servers and rollups through their primary keys.
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_api_keys_server ON api_keys (server_id)",
+    # A server's deployments, newest first
+    "CREATE INDEX IF NOT EXISTS idx_deployments_server_time ON deployments (server_id, timestamp)",
+    # Recent deployments across the fleet
+    "CREATE INDEX IF NOT EXISTS idx_deployments_timestamp ON deployments (timestamp)",
+    # Retention deletes a deployment's files with it
+    "CREATE INDEX IF NOT EXISTS idx_deployment_files_deployment ON deployment_files (deployment_id)",
+    # The dashboard's server list pages through servers by last_seen
+    "CREATE INDEX IF NOT EXISTS idx_servers_last_seen ON servers (last_seen)",
+]
+
+def hot_queries():
+    """Queries on the request path, the dashboard and maintenance, with sample
+    parameters; check() fails if any of them scans a table or sorts.
+
+    The SQL is imported from the modules that run it (which import this one,
+    hence not at module level). The dashboard's latest deployments walk the
+    rowid backwards, and retention walks it forwards, which EXPLAIN also calls
+    a SCAN, so they are not listed.
+    """
+    import auth
+    import admin_dashboard
+    import maintenance
+    from routes import rules
+    return {
+        "api key lookup": (auth.API_KEY_QUERY, ("k",)),
+        "api key revoke": (auth.REVOKE_KEY_QUERY, (0, "k")),
+        "recent revocations": (auth.REVOKED_SINCE_QUERY, (0,)),
+        "server profile": (rules.SERVER_PROFILE_QUERY, ("s",)),
+        "server page": (admin_dashboard.SERVER_PAGE_QUERY, (50, 0)),
+        "rollup history": (admin_dashboard.DEPLOYMENT_HISTORY_QUERY, ("day", FLEET, "t")),
+        "deployment files": (maintenance.PRUNE_DEPLOYMENT_FILES_QUERY, (0,)),
+        "next rollup server": (maintenance.NEXT_ROLLUP_SERVER_QUERY, ("hour", "")),
+        "rollup pruning": (maintenance.PRUNE_ROLLUPS_QUERY, ("hour", "s", "t")),
+    }
+
+def create_tables(conn):
+    for statement in TABLES.values():
+        conn.execute(statement)
+
+def add_missing_columns(conn):
+    """Add the columns older schemas lack (entrypoint.sh built servers, api_keys and deployments its own way)"""
+    canonical = sqlite3.connect(":memory:")
+    for table, statement in TABLES.items():
+        canonical.execute(statement)
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for _, name, column_type, not_null, default, _ in canonical.execute(f"PRAGMA table_info({table})"):
+            if name in existing:
+                continue
+            # ADD COLUMN cannot be NOT NULL without a default; new rows get one anyway
+            definition = f"{name} {column_type}" + (f" DEFAULT {default}" if default is not None else "")
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {definition}")
+            logger.info(f"Added {table}.{name}")
+    canonical.close()
+
+    keys = conn.execute("SELECT id, key FROM api_keys WHERE key_hash IS NULL").fetchall()
+    conn.executemany("UPDATE api_keys SET key_hash = ? WHERE id = ?",
+                     [(hashlib.sha256(key.encode()).hexdigest(), key_id) for key_id, key in keys])
+
+def create_fleet_stats(conn):
+    """Counters taken once, when the table is created; from then on the triggers adjust them"""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fleet_stats'").fetchone():
+        conn.execute(FLEET_STATS_TABLE)
+        conn.execute(FLEET_STATS_BACKFILL)
+    for statement in FLEET_STATS_TRIGGERS:
+        conn.execute(statement)
+
+def create_rollups(conn):
+    """Rollups and the trigger adding each new deployment to them.
+
+    Deployments already in the table are added later, a batch at a time, by
+    maintenance (rollup_backfill_next up to rollup_backfill_end in the
+    maintenance table).
+    """
+    created = not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'deployment_rollups'"
+    ).fetchone()
+    for statement in ROLLUP_TABLES:
+        conn.execute(statement)
+    if created:
+        first, last = conn.execute("SELECT MIN(id), MAX(id) FROM deployments").fetchone()
+        if last is not None:
+            conn.executemany("INSERT OR REPLACE INTO maintenance (name, value) VALUES (?, ?)",
+                             [("rollup_backfill_next", first), ("rollup_backfill_end", last)])
+    conn.execute(ROLLUP_TRIGGER)
+
+def create_indexes(conn):
+    for statement in INDEXES:
+        conn.execute(statement)
+
+# Covers the API key lookup. auth.API_KEY_QUERY leaves the choice to the
+# planner (which takes the UNIQUE (key) index and reads one row), so auth
+# does not depend on this index existing.
+API_KEY_LOOKUP_INDEX = "CREATE INDEX IF NOT EXISTS idx_api_keys_lookup ON api_keys (key, active, server_id, is_admin)"
+
+def create_key_lookup_index(conn):
+    conn.execute(API_KEY_LOOKUP_INDEX)
+
+def add_key_revocation(conn):
+    """api_keys.revoked_at, which every worker polls for recent revocations"""
+    add_missing_columns(conn)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_api_keys_revoked ON api_keys (revoked_at) WHERE revoked_at IS NOT NULL"
+    )
+
+# Applied in order, each once, in its own write transaction. Never edit or
+# renumber a released migration: append a new one. Every step tolerates
+# objects that databases from before versioning already have.
+MIGRATIONS = [
+    (1, "Tables", create_tables),
+    (2, "Columns missing from older schemas", add_missing_columns),
+    (3, "Fleet counters", create_fleet_stats),
+    (4, "Deployment rollups", create_rollups),
+    (5, "Indexes for hot queries", create_indexes),
+    (6, "API key revocation time", add_key_revocation),
+    (7, "Covering index for API key lookups", create_key_lookup_index),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def current_version(conn):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'").fetchone():
+        return 0
+    return conn.execute("SELECT IFNULL(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate(conn):
+    """Bring the database up to SCHEMA_VERSION; returns the versions applied"""
+    if current_version(conn) >= SCHEMA_VERSION:
+        return []
+
+    # A new database gets incremental auto-vacuum, so maintenance can hand
+    # back pages freed by retention a few at a time (VACUUM applies it; the
+    # file already exists once WAL mode is on)
+    if not conn.execute("SELECT 1 FROM sqlite_master").fetchone():
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+    applied = []
+    for version, description, apply in MIGRATIONS:
+        # The version is re-read under the write lock, so workers starting
+        # together apply each migration once
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(VERSION_TABLE)
+            if current_version(conn) >= version:
+                conn.rollback()
+                continue
+            apply(conn)
+            conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                         (version, description, datetime.now().isoformat()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Schema migration {version} applied: {description}")
+        applied.append(version)
+    return applied
+
+def query_plan(conn, sql, params):
+    """EXPLAIN QUERY PLAN details, one string per step"""
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+def plan_problems(plan):
+    """Steps of a plan that read a whole table or sort"""
+    return [step for step in plan if
+            (step.startswith("SCAN") and " USING " not in step) or "TEMP B-TREE" in step]
+
+def check(conn):
+    """Print the plan of every hot query; True if all of them use an index"""
+    ok = True
+    for name, (sql, params) in hot_queries().items():
+        plan = query_plan(conn, sql, params)
+        problems = plan_problems(plan)
+        ok = ok and not problems
+        print(f"{'❌' if problems else '✅'} {name}: {'; '.join(plan)}")
+    return ok
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--check", action="store_true",
+                        help="Verify every hot query uses an index, on a scratch database")
+    parser.add_argument("--status", action="store_true", help="Print the schema version without migrating")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.check:
+        # Plans depend only on the schema: migrate a scratch database rather
+        # than the configured one, which is left untouched
+        with tempfile.TemporaryDirectory() as scratch:
+            conn = configure_connection(sqlite3.connect(os.path.join(scratch, "check.db")))
+            try:
+                migrate(conn)
+                ok = check(conn)
+            finally:
+                conn.close()
+        sys.exit(0 if ok else 1)
+
+    conn = get_db_connection()
+    try:
+        if args.status:
+            print(f"Schema version {current_version(conn)} of {SCHEMA_VERSION}")
+            sys.exit(0)
+        applied = migrate(conn)
+        print(f"Schema at version {SCHEMA_VERSION}" + (f" (applied {', '.join(map(str, applied))})" if applied else ""))
+    finally:
+        conn.close()
@@ -0,0 +1,274 @@
+"""
+Async database access for the API workers
+"""
+import asyncio
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from models import config, get_db_connection
+from utils.metrics import DB_QUERY_SECONDS, Timer
+
+POOL_SIZE = config['database'].get('pool_size', 4)
+write_behind_config = config['database'].get('write_behind', {})
+FLUSH_INTERVAL_MS = write_behind_config.get('flush_interval_ms', 500)
+MAX_BATCH_ROWS = write_behind_config.get('max_batch_rows', 500)
+logger = logging.getLogger(__name__)
+
+class Database:
+    """Runs SQLite work on a small dedicated thread pool.
+
+    Each pool thread keeps its own connection (from models.get_db_connection,
+    so WAL and busy_timeout are applied), which makes the thread pool the
+    connection pool. Handlers await the queries instead of blocking the event
+    loop, and at most pool_size statements run at once per worker.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE):
+        self.pool_size = pool_size
+        self._executor = None
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.pool_size, thread_name_prefix="sqlite"
+                    )
+        return self._executor
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Only ever used by this thread, but closed from close()
+            conn = get_db_connection(check_same_thread=False)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, fn, args):
+        conn = self._connection()
+        try:
+            with Timer(DB_QUERY_SECONDS.labels()):
+                return fn(conn, *args)
+        except Exception:
+            conn.rollback()
+            raise
+
+    async def run(self, fn, *args):
+        """Run fn(conn, *args) on a pooled connection"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), self._call, fn, args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        """Run one write statement and commit it; returns the row count"""
+        def write(conn):
+            cursor = conn.execute(sql, params)
+            conn.commit()
+            return cursor.rowcount
+        return await self.run(write)
+
+    async def executemany(self, sql, seq_of_params):
+        def write(conn):
+            cursor = conn.executemany(sql, seq_of_params)
+            conn.commit()
+            return cursor.rowcount
+        return await self.run(write)
+
+    def close(self):
+        """Stop the pool threads and close their connections"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+db = Database()
+
+class WriteBehind:
+    """Batches last_seen updates and deployment records.
+
+    Writes are queued in memory and flushed by a background task in one
+    transaction every flush_interval_ms, or sooner once max_batch_rows are
+    pending. Repeated last_seen updates for a server collapse into one row.
+    Pending values are visible through pending_last_seen/apply_pending until
+    they are flushed, and stop() flushes whatever is left. A batch the
+    database rejects is written again row by row and the offending rows are
+    dropped; only a locked or busy database puts rows back in the queue.
+    """
+
+    def __init__(self, database, flush_interval_ms=FLUSH_INTERVAL_MS, max_batch_rows=MAX_BATCH_ROWS):
+        self.database = database
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch_rows = max_batch_rows
+        self._last_seen = {}  # server_id -> timestamp
+        self._deployments = []
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+        self._flush_lock = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def pending_rows(self):
+        return len(self._last_seen) + len(self._deployments)
+
+    def _queued(self):
+        if self._wakeup is not None and self.pending_rows() >= self.max_batch_rows:
+            # May be called from a thread pool thread
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def touch_server(self, server_id, timestamp=None):
+        """Queue a last_seen update for a server"""
+        if server_id is None:
+            return
+        self._last_seen[server_id] = timestamp or datetime.now().isoformat()
+        self._queued()
+
+    def record_deployment(self, server_id, success=True, ruleset_version=None,
+                          error_message=None, file_count=0, deployment_time=0.0):
+        """Queue a deployment row and the matching last_seen update"""
+        if server_id is None:
+            # e.g. an API key not assigned to a server; the row could never be written
+            return
+        timestamp = datetime.now().isoformat()
+        self._deployments.append((
+            server_id, timestamp, ruleset_version, 1 if success else 0,
+            error_message, file_count, deployment_time
+        ))
+        self._last_seen[server_id] = timestamp
+        self._queued()
+
+    def pending_last_seen(self, server_id):
+        """last_seen value waiting to be written for a server, or None"""
+        return self._last_seen.get(server_id)
+
+    def apply_pending(self, servers):
+        """Overlay pending last_seen values onto server rows (as dicts)"""
+        for server in servers:
+            pending = self._last_seen.get(server['server_id'])
+            if pending and (not server.get('last_seen') or pending > server['last_seen']):
+                server['last_seen'] = pending
+        return servers
+
+    DEPLOYMENT_COLUMNS = (
+        "server_id", "timestamp", "ruleset_version", "success",
+        "error_message", "file_count", "deployment_time"
+    )
+
+    def _write_batch(self, conn, last_seen, deployments):
+        with conn:
+            if deployments:
+                conn.executemany(
+                    f"INSERT INTO deployments ({', '.join(self.DEPLOYMENT_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' for _ in self.DEPLOYMENT_COLUMNS)})",
+                    deployments
+                )
+            if last_seen:
+                # Upsert: a server's first request registers it, later ones
+                # only move last_seen (a deactivated server stays inactive)
+                conn.executemany("""
+                    INSERT INTO servers (server_id, first_seen, last_seen, is_active)
+                    VALUES (?, ?, ?, 1)
+                    ON CONFLICT (server_id) DO UPDATE SET last_seen = excluded.last_seen
+                """, [(server_id, timestamp, timestamp) for server_id, timestamp in last_seen.items()])
+
+    async def flush(self):
+        """Write everything queued so far in a single transaction"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._last_seen and not self._deployments:
+                return
+            last_seen, self._last_seen = self._last_seen, {}
+            deployments, self._deployments = self._deployments, []
+            try:
+                await self.database.run(self._write_batch, last_seen, deployments)
+            except sqlite3.OperationalError as e:
+                # Locked or busy: the next flush retries the batch
+                self._requeue(last_seen, deployments)
+                logger.error(f"Write-behind flush failed: {e}")
+            except sqlite3.IntegrityError as e:
+                logger.error(f"Write-behind batch rejected ({e}); writing it row by row")
+                try:
+                    self._requeue(*await self.database.run(self._write_rows, last_seen, deployments))
+                except Exception as e:
+                    logger.error(f"Write-behind flush failed, batch dropped: {e}")
+            except Exception as e:
+                logger.error(f"Write-behind flush failed, batch dropped: {e}")
+
+    def _requeue(self, last_seen, deployments):
+        """Put unwritten rows back in front of anything queued since"""
+        for server_id, timestamp in last_seen.items():
+            self._last_seen.setdefault(server_id, timestamp)
+        self._deployments[:0] = deployments
+
+    def _write_rows(self, conn, last_seen, deployments):
+        """Write a rejected batch one row per transaction, dropping rows that break a constraint.
+
+        Returns the rows left unwritten because the database became locked
+        or busy, as (last_seen, deployments).
+        """
+        for index, row in enumerate(deployments):
+            try:
+                self._write_batch(conn, {}, [row])
+            except sqlite3.IntegrityError as e:
+                logger.error(f"Dropped deployment of {row[0]!r} at {row[1]}: {e}")
+            except sqlite3.OperationalError:
+                return last_seen, deployments[index:]
+        servers = list(last_seen.items())
+        for index, (server_id, timestamp) in enumerate(servers):
+            try:
+                self._write_batch(conn, {server_id: timestamp}, [])
+            except sqlite3.IntegrityError as e:
+                logger.error(f"Dropped last_seen of {server_id!r}: {e}")
+            except sqlite3.OperationalError:
+                return dict(servers[index:]), []
+        return {}, []
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        """Start the background flush task on the running event loop"""
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = self._loop.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush task and write out anything still queued"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+writer = WriteBehind(db)
@@ -38,15 +38,29 @@ echo "4. Checking database..."
 sqlite3 deployments.db "SELECT COUNT(*) as total_servers FROM servers;"
 sqlite3 deployments.db "SELECT server_id, last_seen FROM servers;"
 
-echo "5. Testing with API key..."
+echo "5. Checking schema version and query plans..."
+if python3 schema.py --check; then
+    SCHEMA_OK=1
+else
+    echo "   ❌ A hot query does not use an index"
+    SCHEMA_OK=0
+fi
+if python3 test_git_sync.py; then
+    GIT_SYNC_OK=1
+else
+    echo "   ❌ Git sync cycle failed"
+    GIT_SYNC_OK=0
+fi
+
+echo "6. Testing with API key..."
 API_KEY=$(sqlite3 deployments.db "SELECT key FROM api_keys LIMIT 1;")
 echo "Using API key: ${API_KEY:0:20}..."
 
-echo "6. Testing rules list..."
+echo "7. Testing rules list..."
 curl -H "Authorization: Bearer $API_KEY" \
      -s http://localhost:8000/api/rules/list | python3 -m json.tool | head -20
 
-echo "7. Testing package download..."
+echo "8. Testing package download..."
 curl -H "Authorization: Bearer $API_KEY" \
      http://localhost:8000/api/rules/package -o /tmp/test.zip 2>/dev/null
 
@@ -57,9 +71,11 @@ else
     echo "   ❌ Download failed"
 fi
 
-echo "8. Checking repository..."
+echo "9. Checking repository..."
 ls -la /opt/wazuh-rules-repo/
 find /opt/wazuh-rules-repo/ -name "*.xml" | wc -l
 
 echo ""
 echo "=== TEST COMPLETE ==="
+[ "$SCHEMA_OK" = 1 ] || exit 1
+[ "$GIT_SYNC_OK" = 1 ] || exit 1
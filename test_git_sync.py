@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Test of the git sync worker against a local bare repository - no network
+"""
+import os
+import tempfile
+from pathlib import Path
+import git
+
+from utils.git_sync import GitSyncWorker
+
+def commit_ruleset(work, n):
+    """Add a rule file (plus a file outside the ruleset) and push it; returns the commit id"""
+    (work / "rules").mkdir(exist_ok=True)
+    (work / "docs").mkdir(exist_ok=True)
+    (work / "rules" / f"{n:04d}-test_rules.xml").write_text(f'<group name="t{n}"><rule id="{100000 + n}"/></group>\n')
+    (work / "docs" / "README.md").write_text(f"revision {n}\n")
+    repo = git.Repo(work)
+    repo.git.add("-A")
+    repo.git.commit("-m", f"Ruleset {n}")
+    repo.git.push("origin", "HEAD:main")
+    return repo.head.commit.hexsha
+
+def make_remote(root):
+    """Bare repository that serves partial clones, with a working clone to commit from"""
+    bare = root / "remote.git"
+    git.Repo.init(bare, bare=True, initial_branch="main")
+    with git.Repo(bare).config_writer() as cw:
+        cw.set_value("uploadpack", "allowFilter", "true")
+        cw.set_value("uploadpack", "allowAnySHA1InWant", "true")
+    work = root / "work"
+    repo = git.Repo.clone_from(bare, work)
+    with repo.config_writer() as cw:
+        cw.set_value("user", "name", "Test")
+        cw.set_value("user", "email", "test@example.com")
+    return f"file://{bare}", work
+
+def test_sync_cycle():
+    """Fetch, check out, swap `current` and prune, over three commits"""
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        url, work = make_remote(root)
+        commit_ruleset(work, 1)
+        second = commit_ruleset(work, 2)
+
+        served = root / "served"
+        worker = GitSyncWorker(served, url=url, branch="main", depth=1, keep=1)
+        assert worker.sync() == second
+
+        # Shallow, blob-less mirror; a sparse checkout of the ruleset only
+        mirror = git.Git(served / "mirror.git")
+        assert mirror.config("remote.origin.partialclonefilter") == "blob:none"
+        assert (served / "mirror.git" / "shallow").exists()
+        assert os.readlink(served / "current") == os.path.join("checkouts", second)
+        current = served / "current"
+        assert sorted(p.name for p in (current / "rules").iterdir()) == ["0001-test_rules.xml", "0002-test_rules.xml"]
+        assert not (current / "docs").exists()
+        assert [p.name for p in (served / "checkouts").iterdir()] == [second]
+
+        # Nothing new: no checkout, no swap
+        assert worker.sync() == second
+        assert worker.current_commit() == second
+
+        third = commit_ruleset(work, 3)
+        assert worker.sync() == third
+        assert os.readlink(served / "current") == os.path.join("checkouts", third)
+        assert (served / "current" / "rules" / "0003-test_rules.xml").exists()
+
+        # keep=1: the previous checkout and its worktree registration are gone
+        assert [p.name for p in (served / "checkouts").iterdir()] == [third]
+        worktrees = mirror.worktree("list", "--porcelain")
+        assert second not in worktrees and third in worktrees
+
+if __name__ == "__main__":
+    test_sync_cycle()
+    print("✅ Git sync cycle")
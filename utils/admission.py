@@ -0,0 +1,151 @@
+"""
+Admission control for package transfers
+"""
+import math
+import time
+import random
+import logging
+
+from starlette.responses import JSONResponse, Response
+
+from utils.git_sync import config
+
+admission_config = config.get('admission', {})
+ADMISSION_ENABLED = admission_config.get('enabled', False)
+MAX_TRANSFERS = admission_config.get('max_transfers', 8)  # simultaneous transfers per worker
+BYTES_PER_SECOND = admission_config.get('bytes_per_second', 0)  # per worker; 0 = no byte budget
+RETRY_WINDOW = admission_config.get('retry_window', 300)  # seconds rejected clients are spread over
+MIN_RETRY_AFTER = 1
+
+logger = logging.getLogger(__name__)
+
+class TransferResponse(Response):
+    """Wraps a response so the transfer slot is released however the body ends"""
+
+    def __init__(self, response, gate, started):
+        self.response = response
+        self.gate = gate
+        self.started = started
+        self.status_code = response.status_code
+        self.background = None
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    async def __call__(self, scope, receive, send):
+        sent = 0
+
+        async def counting_send(message):
+            nonlocal sent
+            if message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        if self.background is not None and self.response.background is None:
+            self.response.background = self.background
+        try:
+            await self.response(scope, receive, counting_send)
+        finally:
+            self.gate.release(self.started, sent)
+
+class TransferGate:
+    """Limits concurrent package transfers and their byte rate in one worker.
+
+    A transfer is admitted while fewer than max_transfers are running and
+    the byte budget is not in debt; admitting one charges its expected size
+    to the budget, which is paid back at bytes_per_second. Rejected clients
+    get 503 with Retry-After taken from a schedule of retry slots, spaced by
+    how often a slot is expected to free up (from the average transfer time
+    and size), so a burst of rejections comes back spread out rather than
+    all at once. Past RETRY_WINDOW the slot is picked at random within it.
+    All methods run on the event loop, so no locking.
+    """
+
+    def __init__(self, max_transfers=MAX_TRANSFERS, bytes_per_second=BYTES_PER_SECOND,
+                 retry_window=RETRY_WINDOW):
+        self.max_transfers = max_transfers
+        self.bytes_per_second = bytes_per_second
+        self.retry_window = retry_window
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.bytes_sent = 0
+        self._debt = 0.0  # bytes admitted but not yet paid for by the budget
+        self._debt_at = time.monotonic()
+        self._next_slot = 0.0
+        self._avg_seconds = 1.0
+        self._avg_bytes = 0.0
+
+    def _pay_debt(self, now):
+        if self.bytes_per_second:
+            self._debt = max(0.0, self._debt - (now - self._debt_at) * self.bytes_per_second)
+        self._debt_at = now
+
+    def spacing(self):
+        """Expected seconds between freed transfer slots"""
+        spacing = self._avg_seconds / self.max_transfers
+        if self.bytes_per_second:
+            spacing = max(spacing, self._avg_bytes / self.bytes_per_second)
+        return max(spacing, 0.01)
+
+    def scheduled(self, now=None):
+        """Rejected clients whose retry slot is still ahead"""
+        now = time.monotonic() if now is None else now
+        return max(0, math.ceil((self._next_slot - now) / self.spacing()))
+
+    def retry_after(self, now):
+        """Seconds until the next free retry slot"""
+        spacing = self.spacing()
+        slot = max(self._next_slot, now) + spacing
+        if slot - now > self.retry_window:
+            return random.uniform(spacing, self.retry_window)
+        self._next_slot = slot
+        return slot - now
+
+    def admit(self, expected_bytes=0):
+        """Start time of an admitted transfer, or None when it must retry later"""
+        now = time.monotonic()
+        self._pay_debt(now)
+        if self.active >= self.max_transfers or self._debt > 0:
+            return None
+        self.active += 1
+        self.admitted += 1
+        self._debt += expected_bytes if self.bytes_per_second else 0
+        return now
+
+    def track(self, response, started):
+        """Response that releases the transfer admitted at started when it ends"""
+        return TransferResponse(response, self, started) if started is not None else response
+
+    def release(self, started, sent):
+        now = time.monotonic()
+        self.active -= 1
+        self.bytes_sent += sent
+        # Moving averages feed the retry spacing
+        self._avg_seconds += 0.2 * ((now - started) - self._avg_seconds)
+        self._avg_bytes += 0.2 * (sent - self._avg_bytes)
+
+    def reject(self):
+        now = time.monotonic()
+        self.rejected += 1
+        retry_after = max(MIN_RETRY_AFTER, math.ceil(self.retry_after(now)))
+        return JSONResponse(
+            {"detail": "Too many package transfers, retry later", "retry_after": retry_after},
+            status_code=503,
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    def stats(self):
+        return {
+            "enabled": ADMISSION_ENABLED,
+            "active": self.active,
+            "max_transfers": self.max_transfers,
+            "scheduled_retries": self.scheduled(),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "bytes_sent": self.bytes_sent,
+            "bytes_per_second": self.bytes_per_second
+        }
+
+transfer_gate = TransferGate()
@@ -2,29 +2,361 @@
 Git synchronization utilities
 """
 import os
+import re
+import fcntl
+import time
+import shutil
+import asyncio
+import logging
 from pathlib import Path
+import git
 import yaml
 
+from utils.metrics import GIT_SYNC_SECONDS, GIT_SYNC_TIMESTAMP
+
 # Load config
 config_path = Path(__file__).parent.parent / "config.yaml"
 with open(config_path, "r") as f:
     config = yaml.safe_load(f)
 
-REPO_PATH = Path(config['git']['repo_path'])
+git_config = config['git']
+REPO_PATH = Path(git_config['repo_path'])
+REPO_URL = git_config.get('repo_url', '').strip()
+BRANCH = git_config.get('branch', 'main')
+SYNC_ENABLED = git_config.get('sync_enabled', False)
+SYNC_INTERVAL = git_config.get('sync_interval', 300)
+SYNC_DEPTH = git_config.get('depth', 1)  # 0 = full history
+KEEP_CHECKOUTS = git_config.get('keep_checkouts', 3)  # old trees kept for in-flight builds
+RULESET_DIRS = ("rules", "decoders")
+COMMIT_PATTERN = re.compile(r"^[0-9a-f]{7,40}$")
+# Commit ids, tags, branches and suffixes like main~2; never an option or a range
+REVISION_PATTERN = re.compile(r"^(?!-)(?!.*\.\.)[A-Za-z0-9._/~^-]{1,200}$")
+
+# With sync enabled repo_path holds the mirror and one checkout per commit,
+# and the tree to serve is the `current` symlink
+SOURCE_PATH = REPO_PATH / "current" if SYNC_ENABLED else REPO_PATH
+
+logger = logging.getLogger(__name__)
 
 def get_rules_list(subdir="rules"):
     """Get list of files in a directory"""
-    target_path = REPO_PATH / subdir
-    if not target_path.exists():
-        return []
+    from utils.repo_index import repo_index
+    prefix = f"{subdir}/"
+    return [p[len(prefix):] for p in repo_index.snapshot.files if p.startswith(prefix)]
+
+def get_ruleset_files(repo_path=SOURCE_PATH):
+    """List (relative path, absolute path) for every rule and decoder file"""
+    files = []
+    for subdir in RULESET_DIRS:
+        target_path = Path(repo_path) / subdir
+        if not target_path.exists():
+            continue
+        for xml_file in target_path.glob("*.xml"):
+            files.append((f"{subdir}/{xml_file.name}", xml_file))
+    return sorted(files)
+
+def is_ruleset_path(rel_path):
+    """True for rules/*.xml and decoders/*.xml, matching get_ruleset_files"""
+    parts = rel_path.split("/")
+    return len(parts) == 2 and parts[0] in RULESET_DIRS and parts[1].endswith(".xml")
+
+def open_repo(repo_path=SOURCE_PATH):
+    """Open the rules repository, or None if it is not a git checkout"""
+    try:
+        return git.Repo(repo_path)
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+        return None
+
+def get_head_commit(repo_path=SOURCE_PATH):
+    """Commit currently checked out in the rules repository"""
+    repo = open_repo(repo_path)
+    if repo is None:
+        return None
+    try:
+        return repo.head.commit.hexsha
+    except ValueError:
+        # Repository without commits
+        return None
+    finally:
+        repo.close()
+
+def get_commit_time(commit, repo_path=SOURCE_PATH):
+    """Unix commit time of a commit, or None"""
+    repo = open_repo(repo_path)
+    if repo is None:
+        return None
+    try:
+        return repo.commit(commit).committed_date
+    except (git.BadName, ValueError):
+        return None
+    finally:
+        repo.close()
+
+def resolve_commit(revision):
+    """Expand an abbreviated commit id, or None if it is unknown"""
+    if not COMMIT_PATTERN.match(revision or ""):
+        return None
+    repo = open_repo()
+    if repo is None:
+        return None
+    try:
+        return repo.commit(revision).hexsha
+    except (git.BadName, ValueError):
+        return None
+    finally:
+        repo.close()
+
+def resolve_revision(revision):
+    """Commit id for a commit, tag or branch name, or None if it is unknown"""
+    if not REVISION_PATTERN.match(revision or ""):
+        return None
+    repo = open_repo()
+    if repo is None:
+        return None
+    try:
+        return repo.commit(revision).hexsha
+    except (git.BadName, git.GitCommandError, ValueError):
+        return None
+    finally:
+        repo.close()
+
+def iter_ruleset_blobs(repo, commit):
+    """(relative path, blob) for every rule and decoder file of a commit, without a checkout"""
+    tree = repo.commit(commit).tree
+    for subdir in RULESET_DIRS:
+        try:
+            subtree = tree / subdir
+        except KeyError:
+            continue
+        for blob in subtree.blobs:
+            rel_path = f"{subdir}/{blob.name}"
+            if is_ruleset_path(rel_path):
+                yield rel_path, blob
+
+def fetch_missing_blobs(commit, repo_path=SOURCE_PATH):
+    """Download the rule and decoder blobs of a commit that are not local, in one fetch.
+
+    The synced mirror is blob-less, so reading a commit that was never
+    checked out would otherwise fetch each blob lazily, one round trip per
+    file. Returns False if blobs are still missing (e.g. the remote is down).
+    """
+    repo = git.Git(repo_path)
+    wanted = set()
+    for line in repo.ls_tree("-r", commit, "--", *RULESET_DIRS).splitlines():
+        info, _, rel_path = line.partition("\t")
+        if is_ruleset_path(rel_path):
+            wanted.add(info.split()[2])
+    # --missing=print lists what is absent without fetching it
+    listed = repo.rev_list("--objects", "--no-walk", "--missing=print", commit).splitlines()
+    missing = sorted(wanted.intersection(line[1:] for line in listed if line.startswith("?")))
+    if not missing:
+        return True
+    try:
+        # What git itself runs to fill in a partial clone, for all the blobs at once
+        repo(c="fetch.negotiationAlgorithm=noop").fetch(
+            "origin", *missing, no_tags=True, no_write_fetch_head=True, recurse_submodules="no", filter="blob:none"
+        )
+    except git.GitCommandError as e:
+        logger.error(f"Fetching {len(missing)} blobs of {commit[:12]} failed: {e}")
+        return False
+    logger.info(f"Fetched {len(missing)} blobs of {commit[:12]}")
+    return True
+
+def get_ruleset_changes(since, until):
+    """Files changed between two commits.
+
+    Returns (changed, deleted): changed is a list of (relative path, content
+    at `until`) for added and modified files, deleted a list of paths.
+    Renames count as a deletion plus an addition. Returns None if the
+    repository is not a git checkout.
+    """
+    repo = open_repo()
+    if repo is None:
+        return None
+    try:
+        old_commit = repo.commit(since)
+        new_commit = repo.commit(until)
+        
+        changed = []
+        deleted = []
+        for diff in old_commit.diff(new_commit, paths=list(RULESET_DIRS)):
+            if diff.deleted_file or diff.renamed_file:
+                if is_ruleset_path(diff.a_path):
+                    deleted.append(diff.a_path)
+            if not diff.deleted_file and is_ruleset_path(diff.b_path):
+                changed.append((diff.b_path, diff.b_blob.data_stream.read()))
+    finally:
+        repo.close()
     
-    return [f.name for f in target_path.glob("*.xml")]
+    return sorted(changed), sorted(deleted)
+
+class GitSyncWorker:
+    """Keeps repo_path/current at the head of the configured branch.
+
+    One process (the holder of an flock in repo_path) fetches. The mirror is
+    a bare, shallow, blob-less clone, so a fetch transfers only commits and
+    trees; each new commit gets its own worktree under checkouts/ with a
+    sparse checkout of rules/ and decoders/, which downloads just those
+    blobs. The `current` symlink is then swapped to it atomically. A tree is
+    never modified once `current` points at it, so builds reading an older
+    tree are unaffected. Other workers pick up the new tree through
+    source_index, which follows the symlink.
+    """
+
+    def __init__(self, repo_path=REPO_PATH, url=REPO_URL, branch=BRANCH,
+                 depth=SYNC_DEPTH, keep=KEEP_CHECKOUTS):
+        self.repo_path = repo_path
+        self.url = url
+        self.branch = branch
+        self.depth = depth
+        self.keep = keep
+        self.mirror_path = repo_path / "mirror.git"
+        self.checkouts_dir = repo_path / "checkouts"
+        self.current_link = repo_path / "current"
+        self._lock_file = None
+
+    @property
+    def is_leader(self):
+        return self._lock_file is not None
+
+    def try_lead(self):
+        """Become the syncing process if no other worker is"""
+        if self._lock_file is None:
+            self.repo_path.mkdir(parents=True, exist_ok=True)
+            lock_file = open(self.repo_path / ".sync.lock", "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            logger.info(f"Syncing {self.url} ({self.branch}) into {self.repo_path} (pid {os.getpid()})")
+        return True
+
+    def current_commit(self):
+        target = os.path.basename(os.readlink(self.current_link)) if self.current_link.is_symlink() else None
+        return target if target and COMMIT_PATTERN.match(target) else None
+
+    def _mirror(self):
+        # Plain git commands: sparse checkouts move core.bare into
+        # config.worktree, which git.Repo does not read
+        if self.mirror_path.exists():
+            return git.Git(self.mirror_path)
+        # Cloned aside and renamed, so a failed clone leaves nothing behind
+        staging = self.repo_path / f".mirror.{os.getpid()}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        git.Git(self.repo_path).clone(
+            self.url, staging, bare=True, depth=self.depth or None, filter="blob:none", branch=self.branch
+        )
+        os.rename(staging, self.mirror_path)
+        return git.Git(self.mirror_path)
+
+    def fetch(self):
+        """Fetch the branch; returns the commit at its head"""
+        mirror = self._mirror()
+        mirror.fetch(
+            "origin", f"+refs/heads/{self.branch}:refs/heads/{self.branch}",
+            depth=self.depth or None, update_head_ok=True
+        )
+        return mirror.rev_parse(f"refs/heads/{self.branch}")
+
+    def checkout(self, commit):
+        """Create the sparse worktree for commit unless it exists"""
+        target = self.checkouts_dir / commit
+        if (target / ".git").exists():
+            return target
+        mirror = self._mirror()
+        shutil.rmtree(target, ignore_errors=True)
+        mirror.worktree("prune")
+        self.checkouts_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            mirror.worktree("add", "--no-checkout", "--detach", str(target), commit)
+            tree = git.Git(target)
+            tree.sparse_checkout("set", *RULESET_DIRS)
+            tree.checkout("--force", "--detach", commit)
+        except git.GitCommandError:
+            shutil.rmtree(target, ignore_errors=True)
+            mirror.worktree("prune")
+            raise
+        return target
+
+    def swap(self, commit):
+        """Point `current` at the checkout of commit"""
+        link_tmp = self.repo_path / f".current.{os.getpid()}.tmp"
+        if link_tmp.is_symlink():
+            link_tmp.unlink()
+        os.symlink(os.path.join("checkouts", commit), link_tmp)
+        os.replace(link_tmp, self.current_link)
+
+    def prune(self):
+        """Remove the oldest checkouts beyond the configured count"""
+        current = self.current_commit()
+        checkouts = sorted(
+            (path for path in self.checkouts_dir.iterdir() if path.is_dir()),
+            key=lambda path: path.stat().st_mtime,
+            reverse=True
+        )
+        for path in checkouts[self.keep:]:
+            if path.name != current:
+                shutil.rmtree(path, ignore_errors=True)
+        self._mirror().worktree("prune")
+
+    def sync(self):
+        """Fetch and, if the branch moved, check out and swap; returns the current commit"""
+        started = time.perf_counter()
+        try:
+            commit = self.fetch()
+            if commit != self.current_commit():
+                self.checkout(commit)
+                self.swap(commit)
+                logger.info(f"Checked out {commit[:12]} of {self.branch}")
+                self.prune()
+        except Exception:
+            GIT_SYNC_SECONDS.labels("error").observe(time.perf_counter() - started)
+            raise
+        GIT_SYNC_SECONDS.labels("ok").observe(time.perf_counter() - started)
+        GIT_SYNC_TIMESTAMP.set(time.time())
+        return commit
+
+    def start(self):
+        """Take the sync role if free and bring the tree up to date"""
+        if self.try_lead():
+            try:
+                self.sync()
+            except (git.GitCommandError, OSError) as e:
+                logger.error(f"Git sync failed: {e}")
+
+    async def watch(self):
+        """Sync every SYNC_INTERVAL seconds while leading; keep trying to lead otherwise"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(SYNC_INTERVAL)
+            try:
+                if self.is_leader or await loop.run_in_executor(None, self.try_lead):
+                    await loop.run_in_executor(None, self.sync)
+            except Exception as e:
+                logger.error(f"Git sync failed: {e}")
+
+sync_worker = GitSyncWorker()
 
 def clone_or_pull():
-    """Mock git sync - returns success"""
-    return {
-        "success": True,
-        "message": "Repository available",
-        "path": str(REPO_PATH),
-        "exists": REPO_PATH.exists()
-    }
+    """Sync the repository now if this process is the syncing one"""
+    if not SYNC_ENABLED:
+        return {
+            "success": True,
+            "message": "Repository available",
+            "path": str(REPO_PATH),
+            "exists": REPO_PATH.exists()
+        }
+    if not sync_worker.try_lead():
+        return {
+            "success": True,
+            "message": "Another worker is syncing",
+            "path": str(SOURCE_PATH),
+            "commit": sync_worker.current_commit()
+        }
+    try:
+        commit = sync_worker.sync()
+    except (git.GitCommandError, OSError) as e:
+        return {"success": False, "message": str(e), "path": str(SOURCE_PATH)}
+    return {"success": True, "message": "Repository synced", "path": str(SOURCE_PATH), "commit": commit}
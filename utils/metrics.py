@@ -0,0 +1,447 @@
+"""
+Prometheus metrics summed across workers
+"""
+import os
+import math
+import mmap
+import time
+import fcntl
+import bisect
+import struct
+import logging
+import threading
+from pathlib import Path
+import yaml
+
+# Load config (not through git_sync, which is itself instrumented)
+config_path = Path(__file__).parent.parent / "config.yaml"
+with open(config_path, "r") as f:
+    config = yaml.safe_load(f)
+
+metrics_config = config.get('metrics', {})
+METRICS_ENABLED = metrics_config.get('enabled', True)
+METRICS_DIR = Path(metrics_config.get('dir', '/dev/shm/wazuh-api-metrics'))  # one file per worker
+ARCHIVE_NAME = "archive"  # counters of workers that have exited
+INITIAL_SIZE = 64 * 1024
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BUILD_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# File layout: bytes used, then (key length, key, padding to 8, value) records
+HEADER = struct.Struct("<Q")
+LENGTH = struct.Struct("<I")
+VALUE = struct.Struct("<d")
+
+logger = logging.getLogger(__name__)
+
+def _records(data, used):
+    """(key, value offset) for every record in a value file's bytes"""
+    pos = HEADER.size
+    while pos < used:
+        (length,) = LENGTH.unpack_from(data, pos)
+        key = bytes(data[pos + LENGTH.size:pos + LENGTH.size + length]).decode()
+        offset = pos + LENGTH.size + length
+        offset += -offset % VALUE.size
+        yield key, offset
+        pos = offset + VALUE.size
+
+def read_values(path):
+    """{key: value} stored in a value file"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        return {}
+    used = min(HEADER.unpack_from(data)[0], len(data))
+    return {key: VALUE.unpack_from(data, offset)[0] for key, offset in _records(data, used)}
+
+class ValueFile:
+    """Float values by key in a memory-mapped file that only this process writes.
+
+    Other workers read the file when they render /metrics. A record is
+    written before the header that makes it visible, and values are aligned
+    doubles, so a reader never sees half a record. Updates take a lock
+    because pool threads share the file.
+    """
+
+    def __init__(self, path=None, size=INITIAL_SIZE):
+        self.path = path
+        self.lock = threading.Lock()
+        self._offsets = {}
+        if path is None:
+            # Metrics disabled: same code path, nothing on disk
+            self._fd = None
+            self._map = mmap.mmap(-1, size)
+        else:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            size = max(size, os.fstat(self._fd).st_size)
+            os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+        self._doubles = memoryview(self._map).cast("d")
+        self._used = HEADER.unpack_from(self._map)[0] or HEADER.size
+        # A file left by an earlier process with the same pid is carried on
+        for key, offset in _records(self._map, self._used):
+            self._offsets[key] = offset // VALUE.size
+
+    def index(self, key):
+        """Index (in doubles) of the value for key, adding a zero value if it is new"""
+        index = self._offsets.get(key)
+        if index is None:
+            with self.lock:
+                index = self._offsets.get(key)
+                if index is None:
+                    index = self._append(key)
+        return index
+
+    def _append(self, key):
+        encoded = key.encode()
+        offset = self._used + LENGTH.size + len(encoded)
+        offset += -offset % VALUE.size
+        end = offset + VALUE.size
+        if end > len(self._map):
+            self._grow(max(2 * len(self._map), end))
+        LENGTH.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + LENGTH.size:self._used + LENGTH.size + len(encoded)] = encoded
+        VALUE.pack_into(self._map, offset, 0.0)
+        self._used = end
+        HEADER.pack_into(self._map, 0, end)
+        self._offsets[key] = offset // VALUE.size
+        return offset // VALUE.size
+
+    def _grow(self, size):
+        size += -size % mmap.PAGESIZE
+        self._doubles.release()
+        if self._fd is None:
+            grown = mmap.mmap(-1, size)
+            grown[:len(self._map)] = self._map
+        else:
+            os.ftruncate(self._fd, size)
+            grown = mmap.mmap(self._fd, size)
+        self._map.close()
+        self._map = grown
+        self._doubles = memoryview(grown).cast("d")
+
+    def add(self, index, amount):
+        with self.lock:
+            self._doubles[index] += amount
+
+    def add_pair(self, index, amount, other_index, other_amount):
+        """Two additions under one lock (a histogram bucket and its sum)"""
+        with self.lock:
+            doubles = self._doubles
+            doubles[index] += amount
+            doubles[other_index] += other_amount
+
+    def set(self, index, value):
+        with self.lock:
+            self._doubles[index] = value
+
+    def values(self):
+        with self.lock:
+            return {key: self._doubles[index] for key, index in self._offsets.items()}
+
+    def close(self):
+        self._doubles.release()
+        self._map.close()
+        if self._fd is not None:
+            os.close(self._fd)
+
+_store = None
+_store_lock = threading.Lock()
+REGISTRY = {}  # name -> metric, in definition order
+
+def store():
+    """This process's ValueFile, opened on first use"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if METRICS_ENABLED:
+                    METRICS_DIR.mkdir(parents=True, exist_ok=True)
+                    _store = ValueFile(METRICS_DIR / f"{os.getpid()}.db")
+                else:
+                    _store = ValueFile()
+    return _store
+
+def _after_fork():
+    # The child writes its own file; cached offsets belong to the parent's
+    global _store
+    _store = None
+    for metric in REGISTRY.values():
+        metric._children.clear()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Metric:
+    """A metric family; labels(...) returns the series to update"""
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        REGISTRY[name] = self
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            label_text = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, values))
+            child = self._children[values] = self._child(label_text)
+        return child
+
+    def _key(self, label_text, suffix="", le=""):
+        return f"{self.name}\0{suffix}\0{label_text}\0{le}"
+
+    def render(self, values):
+        """Exposition lines for this family from the aggregated {key: value}"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key in sorted(values):
+            _, suffix, label_text, _ = key.split("\0")
+            lines.append(f"{self.name}{suffix}{{{label_text}}} {_format(values[key])}" if label_text
+                         else f"{self.name}{suffix} {_format(values[key])}")
+        return lines
+
+class _CounterSeries:
+    __slots__ = ("_store", "_index")
+
+    def __init__(self, values, index):
+        self._store = values
+        self._index = index
+
+    def inc(self, amount=1):
+        self._store.add(self._index, amount)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _child(self, label_text):
+        values = store()
+        return _CounterSeries(values, values.index(self._key(label_text)))
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class _GaugeSeries(_CounterSeries):
+    __slots__ = ()
+
+    def set(self, value):
+        self._store.set(self._index, value)
+
+class Gauge(Metric):
+    """Last value set; workers are combined with max or min (only running ones count)"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), combine=max):
+        super().__init__(name, documentation, labelnames)
+        self.combine = combine
+
+    def _child(self, label_text):
+        values = store()
+        return _GaugeSeries(values, values.index(self._key(label_text)))
+
+    def set(self, value):
+        self.labels().set(value)
+
+class _HistogramSeries:
+    __slots__ = ("_store", "_bounds", "_buckets", "_sum")
+
+    def __init__(self, values, bounds, buckets, sum_offset):
+        self._store = values
+        self._bounds = bounds
+        self._buckets = buckets
+        self._sum = sum_offset
+
+    def observe(self, value):
+        self._store.add_pair(self._buckets[bisect.bisect_left(self._bounds, value)], 1, self._sum, value)
+
+class Histogram(Metric):
+    """Bucket counts are stored per bucket and made cumulative when rendered"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def _child(self, label_text):
+        values = store()
+        return _HistogramSeries(
+            values, self.buckets,
+            [values.index(self._key(label_text, "_bucket", _format(bound))) for bound in self.buckets],
+            values.index(self._key(label_text, "_sum"))
+        )
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self, values):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        series = {}
+        for key, value in values.items():
+            _, suffix, label_text, le = key.split("\0")
+            entry = series.setdefault(label_text, {"sum": 0.0, "buckets": {}})
+            if suffix == "_sum":
+                entry["sum"] = value
+            else:
+                entry["buckets"][le] = value
+        for label_text in sorted(series):
+            prefix = f"{label_text}," if label_text else ""
+            cumulative = 0.0
+            for bound in self.buckets:
+                le = _format(bound)
+                cumulative += series[label_text]["buckets"].get(le, 0.0)
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {_format(cumulative)}')
+            braces = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{self.name}_sum{braces} {_format(series[label_text]['sum'])}")
+            lines.append(f"{self.name}_count{braces} {_format(cumulative)}")
+        return lines
+
+class Timer:
+    """Context manager observing elapsed seconds into a histogram series"""
+    __slots__ = ("_series", "_start")
+
+    def __init__(self, series):
+        self._series = series
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._series.observe(time.perf_counter() - self._start)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _worker_files():
+    """(pid or None for the archive, path) for each value file"""
+    for path in METRICS_DIR.glob("*.db"):
+        if path.stem == ARCHIVE_NAME:
+            yield None, path
+        elif path.stem.isdigit():
+            yield int(path.stem), path
+
+def collect_exited():
+    """Fold the files of exited workers into the archive so their counts are kept.
+
+    Gauges of exited workers are dropped. Run when a worker starts; an flock
+    keeps two workers from folding the same file.
+    """
+    if not METRICS_ENABLED:
+        return
+    METRICS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(METRICS_DIR / ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        archive = None
+        try:
+            for pid, path in _worker_files():
+                if pid is None or pid == os.getpid() or _alive(pid):
+                    continue
+                if archive is None:
+                    archive = ValueFile(METRICS_DIR / f"{ARCHIVE_NAME}.db")
+                for key, value in read_values(path).items():
+                    metric = REGISTRY.get(key.split("\0", 1)[0])
+                    if metric is not None and metric.kind != "gauge":
+                        archive.add(archive.index(key), value)
+                path.unlink()
+        finally:
+            if archive is not None:
+                archive.close()
+
+def render():
+    """Prometheus text exposition of every worker's metrics"""
+    files = [(os.getpid(), None)] if not METRICS_ENABLED else list(_worker_files())
+    totals = {name: {} for name in REGISTRY}
+    own = store()
+    for pid, path in files:
+        try:
+            values = own.values() if pid == os.getpid() else read_values(path)
+        except FileNotFoundError:
+            continue  # folded into the archive meanwhile
+        live = pid is not None and (pid == os.getpid() or _alive(pid))
+        for key, value in values.items():
+            metric = REGISTRY.get(key.split("\0", 1)[0])
+            if metric is None:
+                continue
+            family = totals[metric.name]
+            if metric.kind == "gauge":
+                if live:
+                    family[key] = metric.combine(family[key], value) if key in family else value
+            else:
+                family[key] = family.get(key, 0.0) + value
+    lines = []
+    for name, metric in REGISTRY.items():
+        lines.extend(metric.render(totals[name]))
+    return "\n".join(lines) + "\n"
+
+class MetricsMiddleware:
+    """Times every HTTP request by method, route template and status"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            # The template, not the path, keeps the label set bounded
+            route = scope.get("route")
+            REQUEST_SECONDS.labels(
+                scope["method"], route.path if route is not None else "<unmatched>", status
+            ).observe(time.perf_counter() - start)
+
+REQUEST_SECONDS = Histogram(
+    "wazuh_api_request_duration_seconds", "HTTP requests, until the last body byte is sent",
+    ("method", "route", "status")
+)
+DB_QUERY_SECONDS = Histogram(
+    "wazuh_api_db_query_duration_seconds", "SQLite work run on the connection pool"
+)
+AUTH_SECONDS = Histogram(
+    "wazuh_api_auth_duration_seconds", "Credential checks by how they were resolved", ("method",)
+)
+PACKAGE_BUILD_SECONDS = Histogram(
+    "wazuh_api_package_build_duration_seconds", "Package builds by format", ("format",), BUILD_BUCKETS
+)
+PACKAGE_BUILD_BYTES = Counter(
+    "wazuh_api_package_build_bytes_total", "Bytes of packages built, by format", ("format",)
+)
+PACKAGE_CACHE_LOOKUPS = Counter(
+    "wazuh_api_package_cache_lookups_total", "Package cache lookups by result", ("result",)
+)
+GIT_SYNC_SECONDS = Histogram(
+    "wazuh_api_git_sync_duration_seconds", "Git fetch and checkout passes by result", ("result",), BUILD_BUCKETS
+)
+GIT_SYNC_TIMESTAMP = Gauge(
+    "wazuh_api_git_last_sync_timestamp_seconds", "Unix time of the last successful git sync"
+)
+REVISION_TIMESTAMP = Gauge(
+    "wazuh_api_ruleset_revision_timestamp_seconds",
+    "Commit time of the served ruleset (when it was first seen without git); the oldest across workers",
+    combine=min
+)
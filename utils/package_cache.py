@@ -0,0 +1,664 @@
+"""
+Prebuilt package cache keyed by ruleset revision
+"""
+import io
+import os
+import gzip
+import json
+import base64
+import hashlib
+import time
+import zlib
+import fcntl
+import struct
+import re
+import logging
+import tarfile
+import threading
+import zipfile
+from collections import OrderedDict
+from pathlib import Path
+import yaml
+
+from utils.metrics import PACKAGE_BUILD_SECONDS, PACKAGE_BUILD_BYTES, PACKAGE_CACHE_LOOKUPS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Load config
+config_path = Path(__file__).parent.parent / "config.yaml"
+with open(config_path, "r") as f:
+    config = yaml.safe_load(f)
+
+cache_config = config.get('cache', {})
+CACHE_DIR = Path(cache_config.get('dir', '/tmp/wazuh-api-cache'))
+MAX_ENTRIES = cache_config.get('max_entries', 16)
+MAX_DELTA_ENTRIES = cache_config.get('max_delta_entries', 16)  # deltas are counted apart from packages
+MAX_BYTES = cache_config.get('max_size_mb', 512) * 1024 * 1024
+
+# Archive formats: name -> (media type, file suffix)
+PACKAGE_FORMATS = {
+    "zip": ("application/zip", ".zip"),
+    "tar.gz": ("application/gzip", ".tar.gz"),
+    "tar.xz": ("application/x-xz", ".tar.xz"),
+}
+if zstandard is not None:
+    PACKAGE_FORMATS["tar.zst"] = ("application/zstd", ".tar.zst")
+ZSTD_LEVEL = 19
+# Every archive entry carries this mtime (1980-01-01 UTC, the earliest a zip
+# can store), so the same files always give byte-identical packages
+ARCHIVE_MTIME = 315532800
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+DELTA_PREFIX = "delta-"  # cache keys of /delta archives
+
+# Zip record layouts (PKWARE APPNOTE 4.3); sizes follow each entry in a data
+# descriptor so nothing has to be seeked back to and patched
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+DATA_DESCRIPTOR = struct.Struct("<IIII")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+ZIP64_END_LOCATOR = struct.Struct("<IIQI")
+ZIP64_OFFSET_EXTRA = struct.Struct("<HHQ")
+ZIP32_LIMIT = 0xFFFFFFFF
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+def _dos_datetime(timestamp):
+    t = time.gmtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01 00:00
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    )
+
+def iter_zip(entries, chunk_size=CHUNK_SIZE):
+    """Yield a deflated zip archive in chunks of roughly chunk_size bytes.
+
+    entries are (archive name, source) pairs where source is a file path,
+    read and compressed chunk_size bytes at a time, or bytes. Entries are
+    dated ARCHIVE_MTIME rather than when they were checked out. Nothing is
+    written to disk, and the only state kept between entries is the encoded
+    central directory (about 50 bytes plus the name per entry), so memory
+    does not grow with file sizes. Switches to zip64 end records past 65,535
+    entries or 4 GiB of output.
+    """
+    out = bytearray()
+    central = bytearray()
+    offset = 0
+    count = 0
+    zip64 = False
+
+    for arcname, source in entries:
+        if isinstance(source, bytes):
+            data, mode = source, 0o100644
+        else:
+            data, mode = None, os.stat(source).st_mode
+
+        name = arcname.encode("utf-8")
+        flags = FLAG_DATA_DESCRIPTOR | (0 if name.isascii() else FLAG_UTF8)
+        dos_time, dos_date = _dos_datetime(ARCHIVE_MTIME)
+        out += LOCAL_HEADER.pack(
+            0x04034b50, 20, flags, zipfile.ZIP_DEFLATED, dos_time, dos_date, 0, 0, 0, len(name), 0
+        )
+        out += name
+
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        crc = size = compressed_size = 0
+        with (io.BytesIO(data) if data is not None else open(source, "rb")) as src:
+            for block in iter(lambda: src.read(chunk_size), b""):
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                compressed = compressor.compress(block)
+                compressed_size += len(compressed)
+                out += compressed
+                if len(out) >= chunk_size:
+                    yield bytes(out)
+                    offset += len(out)
+                    out.clear()
+        compressed = compressor.flush()
+        compressed_size += len(compressed)
+        out += compressed
+        if size > ZIP32_LIMIT or compressed_size > ZIP32_LIMIT:
+            raise ValueError(f"{arcname} is too large for a zip entry")
+        out += DATA_DESCRIPTOR.pack(0x08074b50, crc, compressed_size, size)
+
+        # Offsets past 4 GiB move into a zip64 extra field
+        local_offset = offset + len(out) - (
+            LOCAL_HEADER.size + len(name) + compressed_size + DATA_DESCRIPTOR.size
+        )
+        extra = b""
+        if local_offset > ZIP32_LIMIT:
+            extra = ZIP64_OFFSET_EXTRA.pack(0x0001, 8, local_offset)
+            local_offset = ZIP32_LIMIT
+            zip64 = True
+        central += CENTRAL_HEADER.pack(
+            0x02014b50, (3 << 8) | 45, 45 if extra else 20, flags, zipfile.ZIP_DEFLATED,
+            dos_time, dos_date, crc, compressed_size, size, len(name), len(extra),
+            0, 0, 0, (mode & 0xFFFF) << 16, local_offset
+        )
+        central += name
+        central += extra
+        count += 1
+
+        if len(out) >= chunk_size:
+            yield bytes(out)
+            offset += len(out)
+            out.clear()
+
+    if out:
+        yield bytes(out)
+        offset += len(out)
+        out.clear()
+
+    central_offset = offset
+    for start in range(0, len(central), chunk_size):
+        yield bytes(central[start:start + chunk_size])
+    central_size = len(central)
+    offset += central_size
+    del central
+
+    if zip64 or count > 0xFFFF or offset > ZIP32_LIMIT:
+        yield b"".join((
+            ZIP64_END_RECORD.pack(
+                0x06064b50, ZIP64_END_RECORD.size - 12, 45, 45, 0, 0,
+                count, count, central_size, central_offset
+            ),
+            ZIP64_END_LOCATOR.pack(0x07064b50, 0, offset, 1),
+            END_RECORD.pack(0x06054b50, 0, 0, 0xFFFF, 0xFFFF, ZIP32_LIMIT, ZIP32_LIMIT, 0)
+        ))
+    else:
+        yield END_RECORD.pack(0x06054b50, 0, 0, count, count, central_size, central_offset, 0)
+
+class _ChunkSink:
+    """Write-only file object that collects output until it is drained"""
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+def iter_tar(entries, compression, chunk_size=CHUNK_SIZE):
+    """Yield a compressed tar archive ("gz", "xz" or "zst") in chunks.
+
+    Takes the same (archive name, path or bytes) entries as iter_zip.
+    Owners are dropped and times fixed so the archive only depends on the
+    ruleset.
+    """
+    sink = _ChunkSink()
+    if compression == "zst":
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(sink, closefd=False)
+    elif compression == "gz":
+        # tarfile's own gzip stream stamps its header with the current time
+        compressor = gzip.GzipFile(filename="", mode="wb", fileobj=sink, mtime=0)
+    else:
+        compressor = None
+    if compressor is not None:
+        tar = tarfile.open(fileobj=compressor, mode="w|")
+    else:
+        tar = tarfile.open(fileobj=sink, mode=f"w|{compression}")
+
+    with tar:
+        for arcname, source in entries:
+            if isinstance(source, bytes):
+                info = tarfile.TarInfo(arcname)
+                info.size = len(source)
+                info.mode = 0o644
+                info.mtime = ARCHIVE_MTIME
+                tar.addfile(info, io.BytesIO(source))
+            else:
+                info = tar.gettarinfo(source, arcname)
+                info.uid = info.gid = 0
+                info.uname = info.gname = ""
+                info.mtime = ARCHIVE_MTIME
+                with open(source, "rb") as f:
+                    tar.addfile(info, f)
+            if sink.size >= chunk_size:
+                yield sink.drain()
+    if compression == "zst":
+        compressor.flush(zstandard.FLUSH_FRAME)
+    if compressor is not None:
+        compressor.close()
+
+    remaining = sink.drain()
+    if remaining:
+        yield remaining
+
+def iter_package(entries, package_format):
+    """Yield entries as an archive in one of PACKAGE_FORMATS"""
+    if package_format == "zip":
+        return iter_zip(entries)
+    return iter_tar(entries, package_format.split(".", 1)[1])
+
+XML_COMMENT = re.compile(rb"<!--.*?-->", re.DOTALL)
+XML_LINE_BREAK = re.compile(rb">[ \t\r]*\n\s*<")
+
+def minify_xml(data):
+    """Strip comments and the line breaks/indentation between tags.
+
+    Purely lexical, since rule and decoder files are XML fragments rather
+    than documents (several top-level elements, regexes that a strict parser
+    rejects). Whitespace inside a single line is left alone so values such as
+    <match> </match> keep their meaning.
+    """
+    data = XML_COMMENT.sub(b"", data)
+    return XML_LINE_BREAK.sub(b"><", data).strip() + b"\n"
+
+def minified_entries(entries):
+    """Entries with XML sources replaced by their minified bytes"""
+    for arcname, source in entries:
+        if arcname.endswith(".xml"):
+            data = source if isinstance(source, bytes) else Path(source).read_bytes()
+            yield arcname, minify_xml(data)
+        else:
+            yield arcname, source
+
+def iter_file_range(f, start, end, chunk_size=CHUNK_SIZE):
+    """Bytes start..end (inclusive) of an open file, in chunks; closes the file"""
+    with f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def write_chunks(dest_path, chunks):
+    """Write generated archive chunks to a file"""
+    with open(dest_path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+def iter_delta_zip(changed, deleted, metadata):
+    """Stream changed file contents plus a delta.json describing the change set"""
+    delta = json.dumps(dict(
+        metadata,
+        changed=[arcname for arcname, _ in changed],
+        deleted=deleted
+    ), indent=2).encode()
+    return iter_zip(list(changed) + [("delta.json", delta)])
+
+class _Build:
+    """Progress of an artifact that PackageCache.stream() is writing to a file"""
+
+    def __init__(self):
+        self._done = threading.Condition()
+        self.written = 0
+        self.finished = False
+        self.error = None
+
+    def wrote(self, size):
+        with self._done:
+            self.written += size
+            self._done.notify_all()
+
+    def finish(self, error=None):
+        with self._done:
+            self.finished = True
+            self.error = error
+            self._done.notify_all()
+
+    def follow(self, f):
+        """Read f as the build writes it, until the build finishes; closes the file"""
+        position = 0
+        with f:
+            while True:
+                with self._done:
+                    self._done.wait_for(lambda: self.written > position or self.finished)
+                    written, finished, error = self.written, self.finished, self.error
+                if error is not None:
+                    raise error
+                while position < written:
+                    chunk = f.read(min(CHUNK_SIZE, written - position))
+                    position += len(chunk)
+                    yield chunk
+                if finished:
+                    return
+
+class PackageCache:
+    """Bounded on-disk cache of built packages.
+
+    Artifacts are named after their cache key (e.g. the ruleset revision), so
+    every gunicorn worker sharing CACHE_DIR reuses the same file. Builds for
+    one key are single-flight: threads in a worker wait on a per-key lock and
+    workers wait on an flock, then pick up whatever the first builder wrote.
+    Any worker may evict any artifact, so responses are sent from a file
+    opened with open(), which stays readable after the artifact is removed.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES,
+                 max_delta_entries=MAX_DELTA_ENTRIES):
+        self.cache_dir = Path(cache_dir)
+        self.max_entries = max_entries
+        self.max_delta_entries = max_delta_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (path, size), most recent last
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._digests = {}  # (path, inode, size) -> base64 SHA-256
+        self.hits = 0
+        self.misses = 0
+
+    def _path_for(self, key, suffix):
+        return self.cache_dir / f"{key}{suffix}"
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _lock_key(self, key, blocking=True):
+        """Open and flock the lock file for key; None if it is held and not blocking.
+
+        Eviction deletes lock files while holding them, so a lock taken on a
+        file that has since been unlinked is retried on the current one.
+        """
+        lock_path = self._path_for(key, ".lock")
+        while True:
+            lock_file = open(lock_path, "a")
+            try:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    if not blocking:
+                        lock_file.close()
+                        return None
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                        return lock_file
+                except FileNotFoundError:
+                    pass
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    def _remember(self, key, path):
+        with self._lock:
+            self._entries[key] = (path, path.stat().st_size)
+            self._entries.move_to_end(key)
+
+    def _lookup(self, key):
+        """Return the cached path for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0].exists():
+                self._entries.move_to_end(key)
+                return entry[0]
+            self._entries.pop(key, None)
+        return None
+
+    def _find(self, key, suffix):
+        """Return the artifact path for key if any worker has built it, else None"""
+        path = self._lookup(key)
+        if path is None:
+            candidate = self._path_for(key, suffix)
+            if candidate.exists():
+                self._remember(key, candidate)
+                path = candidate
+        return path
+
+    def open(self, key, suffix=".zip", builder=None):
+        """Open the artifact for key if any worker has built it, else return None.
+
+        With a builder, a miss is built first, as get() does. Artifacts
+        evicted by another worker between finding and opening them count as
+        misses.
+        """
+        for _ in range(3):
+            path = self.get(key, builder, suffix) if builder else self._find(key, suffix)
+            if path is None:
+                return None
+            try:
+                artifact = open(path, "rb")
+            except FileNotFoundError:
+                with self._lock:
+                    self._entries.pop(key, None)
+                continue
+            if builder is None:
+                self._counted(hit=True)
+                self._touch(path)
+            return artifact
+        return None
+
+    def _counted(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        PACKAGE_CACHE_LOOKUPS.labels("hit" if hit else "miss").inc()
+
+    def _built(self, path, suffix, started):
+        size = path.stat().st_size
+        package_format = suffix.lstrip(".")
+        PACKAGE_BUILD_SECONDS.labels(package_format).observe(time.perf_counter() - started)
+        PACKAGE_BUILD_BYTES.labels(package_format).inc(size)
+        logger.info(f"Built package {path.name} ({size:,} bytes)")
+
+    def _touch(self, path):
+        """Bump mtime so LRU order is shared by every worker"""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def digest(self, artifact):
+        """Base64 SHA-256 of an open artifact, for Digest headers; computed once per file"""
+        st = os.fstat(artifact.fileno())
+        digest_key = (artifact.name, st.st_ino, st.st_size)
+        with self._lock:
+            digest = self._digests.get(digest_key)
+        if digest is None:
+            sha256 = hashlib.sha256()
+            artifact.seek(0)
+            for chunk in iter(lambda: artifact.read(CHUNK_SIZE), b""):
+                sha256.update(chunk)
+            artifact.seek(0)
+            digest = base64.b64encode(sha256.digest()).decode()
+            with self._lock:
+                if len(self._digests) >= 4 * self.max_entries:
+                    self._digests.clear()
+                self._digests[digest_key] = digest
+        return digest
+
+    def get(self, key, builder, suffix=".zip"):
+        """Return the artifact path for key, building it with builder(dest) on a miss"""
+        path = self._lookup(key)
+        if path:
+            self._counted(hit=True)
+            self._touch(path)
+            return path
+
+        with self._key_lock(key):
+            path = self._lookup(key)
+            if path:
+                self._counted(hit=True)
+                return path
+
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            path = self._path_for(key, suffix)
+
+            with self._lock_key(key) as lock_file:
+                try:
+                    if path.exists():
+                        # Built by another worker while we waited
+                        self._counted(hit=True)
+                        self._touch(path)
+                    else:
+                        self._counted(hit=False)
+                        started = time.perf_counter()
+                        tmp_path = self._path_for(key, f"{suffix}.{os.getpid()}.tmp")
+                        try:
+                            builder(tmp_path)
+                            os.replace(tmp_path, path)
+                        finally:
+                            if tmp_path.exists():
+                                tmp_path.unlink()
+                        self._built(path, suffix, started)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+            self._remember(key, path)
+
+        with self._lock:
+            self._key_locks.pop(key, None)
+
+        self.evict(keep=path)
+        return path
+
+    def stream(self, key, chunks, suffix=".zip"):
+        """Pass chunks through to the caller while saving them as the artifact for key.
+
+        Lets a cache miss be answered as the archive is generated. A thread
+        writes chunks to a temporary file, renames it into place and releases
+        the key's lock as soon as the build is done, however slowly the
+        caller reads; the caller is sent the file as it grows. Requests for a
+        key that another thread or worker is already building wait for the
+        build and are sent the finished artifact, so a key is only ever
+        generated once at a time. A failed build is discarded, and the next
+        request builds it.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path_for(key, suffix)
+        lock_file = self._lock_key(key)
+        building = False
+        try:
+            if path.exists():
+                # Finished by another request before we got the lock; opened
+                # before the lock is released so eviction cannot remove it
+                artifact = open(path, "rb")
+            else:
+                self._counted(hit=False)
+                tmp_path = self._path_for(key, f"{suffix}.{os.getpid()}.{threading.get_ident()}.tmp")
+                out = open(tmp_path, "wb")
+                try:
+                    artifact = open(tmp_path, "rb")
+                except BaseException:
+                    out.close()
+                    tmp_path.unlink(missing_ok=True)
+                    raise
+                build = _Build()
+                threading.Thread(
+                    target=self._build_stream, args=(key, chunks, suffix, out, tmp_path, lock_file, build),
+                    name=f"package-build-{key}", daemon=True
+                ).start()
+                building = True
+        finally:
+            # From here on the build thread releases the lock
+            if not building:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+        if building:
+            yield from build.follow(artifact)
+            return
+
+        self._counted(hit=True)
+        self._touch(path)
+        with artifact:
+            yield from iter(lambda: artifact.read(CHUNK_SIZE), b"")
+
+    def _build_stream(self, key, chunks, suffix, out, tmp_path, lock_file, build):
+        """Write chunks to tmp_path and move it into place, then release the key's lock"""
+        path = self._path_for(key, suffix)
+        started = time.perf_counter()
+        error = None
+        try:
+            with out:
+                for chunk in chunks:
+                    out.write(chunk)
+                    out.flush()
+                    build.wrote(len(chunk))
+            os.replace(tmp_path, path)
+            self._built(path, suffix, started)
+            self._remember(key, path)
+        except BaseException as e:
+            error = e
+            logger.error(f"Building {path.name} failed: {e}")
+            tmp_path.unlink(missing_ok=True)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+            build.finish(error)
+        if error is None:
+            self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """Drop least recently used artifacts until the cache is within bounds.
+
+        Packages and deltas have separate entry limits (max_entries and
+        max_delta_entries) and share max_bytes. An artifact is removed with
+        its lock file, both while holding that lock; an artifact whose key is
+        being built or opened is left for a later pass. Lock files of keys
+        with no artifact (e.g. a failed build) are removed the same way.
+        """
+        artifacts = []
+        lock_keys = set()
+        try:
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".tmp"):
+                    continue
+                if entry.name.endswith(".lock"):
+                    lock_keys.add(entry.name[:-len(".lock")])
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                artifacts.append((st.st_mtime, st.st_size, Path(entry.path)))
+        except FileNotFoundError:
+            return
+
+        artifacts.sort(key=lambda item: item[0], reverse=True)
+        total = 0
+        kept = {False: 0, True: 0}  # artifacts kept so far: packages, deltas
+        for _, size, artifact in artifacts:
+            delta = artifact.name.startswith(DELTA_PREFIX)
+            limit = self.max_delta_entries if delta else self.max_entries
+            key = artifact.name.split(".", 1)[0]
+            total += size
+            if artifact != keep and (kept[delta] >= limit or total > self.max_bytes) and self._remove_key(key, artifact):
+                total -= size
+                logger.info(f"Evicted package {artifact.name}")
+            else:
+                kept[delta] += 1
+                lock_keys.discard(key)
+
+        for key in lock_keys:
+            self._remove_key(key)
+
+    def _remove_key(self, key, artifact=None):
+        """Delete key's artifact and lock file unless the lock is held; True if removed"""
+        lock_file = self._lock_key(key, blocking=False)
+        if lock_file is None:
+            return False
+        with lock_file:
+            if artifact is not None:
+                artifact.unlink(missing_ok=True)
+            self._path_for(key, ".lock").unlink(missing_ok=True)
+        with self._lock:
+            self._entries.pop(key, None)
+        return True
+
+package_cache = PackageCache()
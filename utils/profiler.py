@@ -0,0 +1,244 @@
+"""
+Sampling profiler for live requests
+"""
+import os
+import json
+import signal
+import time
+import random
+import asyncio
+import hmac
+import logging
+import threading
+from collections import Counter
+from pathlib import Path
+
+from utils.git_sync import config
+
+profile_config = config.get('profiling', {})
+PROFILE_DIR = Path(profile_config.get('dir', '/tmp/wazuh-api-profiles'))  # control file and one stack file per worker
+SAMPLE_INTERVAL = profile_config.get('interval_ms', 5) / 1000  # CPU seconds between stack samples
+POLL_INTERVAL = profile_config.get('poll_interval', 1.0)  # seconds between control file checks
+MAX_STACKS = profile_config.get('max_stacks', 20000)  # distinct stacks kept per worker
+MAX_DEPTH = 64
+CONTROL_FILE = "control.json"
+STACK_SUFFIX = ".folded"
+PROFILE_HEADER = b"x-profile"
+OTHER_STACK = "[other stacks]"
+
+logger = logging.getLogger(__name__)
+
+def frame_name(code):
+    # Collapsed stacks use ';' between frames and ' ' before the count
+    return f"{os.path.basename(code.co_filename)}:{code.co_qualname}".replace(";", ",").replace(" ", "_")
+
+def read_control(profile_dir=PROFILE_DIR):
+    """Settings last written by the admin endpoint, or {} when profiling was never enabled"""
+    try:
+        with open(profile_dir / CONTROL_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_control(control, profile_dir=PROFILE_DIR):
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = profile_dir / f".{CONTROL_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(control, f)
+    os.replace(tmp_path, profile_dir / CONTROL_FILE)
+
+def merged_stacks(profile_dir=PROFILE_DIR):
+    """Collapsed stacks of every worker, summed, as a Counter"""
+    stacks = Counter()
+    for path in profile_dir.glob(f"*{STACK_SUFFIX}"):
+        try:
+            with open(path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip("\n").rpartition(" ")
+                    if stack and count.isdigit():
+                        stacks[stack] += int(count)
+        except OSError:
+            continue
+    return stacks
+
+class RequestProfiler:
+    """Samples the event loop's stack while a profiled request is running.
+
+    The middleware marks a request for profiling (a fraction sample_rate of
+    requests, or any request carrying the current X-Profile token). While
+    profiling is on a SIGPROF interval timer fires every SAMPLE_INTERVAL of
+    CPU time; the handler runs on the loop's thread between bytecodes, so
+    it sees exactly what the loop was doing (a sampler thread would mostly
+    get the GIL when the loop is idle). A sample counts only if the running
+    task belongs to a profiled request, so concurrent requests do not
+    pollute each other's stacks; work handed to the thread pool is not
+    seen. Stacks are rooted at the method and route template and written
+    per worker in collapsed format (flamegraph.pl, speedscope). Settings
+    come from a control file shared by all workers and polled every
+    POLL_INTERVAL, so the admin endpoint switches every worker on or off
+    without a restart.
+    """
+
+    def __init__(self, profile_dir=PROFILE_DIR, interval=SAMPLE_INTERVAL, max_stacks=MAX_STACKS):
+        self.profile_dir = profile_dir
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.active = False
+        self.sample_rate = 0.0
+        self.token = None
+        self.until = 0
+        self.generation = None
+        self.samples = 0
+        self._control_mtime = None
+        self._inflight = {}  # task -> ASGI scope
+        self._stacks = Counter()
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._loop = None
+
+    @property
+    def stack_path(self):
+        return self.profile_dir / f"{os.getpid()}{STACK_SUFFIX}"
+
+    def attach(self, loop):
+        """Bind to the event loop serving requests; call from its thread"""
+        if threading.current_thread() is not threading.main_thread():
+            # Signal handlers can only be set, and only run, on the main thread
+            logger.warning("Event loop is not on the main thread; request profiling is unavailable")
+            return
+        self._loop = loop
+        signal.signal(signal.SIGPROF, self._on_signal)
+
+    def apply(self, control):
+        """Take on settings from the control file"""
+        self.until = control.get('until') or 0
+        self.active = self._loop is not None and bool(control.get('enabled')) and (
+            not self.until or self.until > time.time()
+        )
+        self.sample_rate = float(control.get('sample_rate', 0.0)) if self.active else 0.0
+        self.token = control.get('token') if self.active else None
+        if self._loop is not None:
+            # Left running while on: re-arming per request would restart the
+            # countdown, and requests shorter than the interval would never be hit
+            signal.setitimer(signal.ITIMER_PROF, self.interval if self.active else 0, self.interval)
+        generation = control.get('generation')
+        if generation != self.generation:
+            # A reset from the admin endpoint: start a new profile
+            with self._lock:
+                self._stacks.clear()
+                self.samples = 0
+                self._dirty = False
+            self.stack_path.unlink(missing_ok=True)
+            self.generation = generation
+
+    def load_control(self):
+        """Apply the control file if it changed, and switch off once it expires"""
+        try:
+            mtime = os.stat(self.profile_dir / CONTROL_FILE).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._control_mtime:
+            self._control_mtime = mtime
+            self.apply(read_control(self.profile_dir))
+        elif self.active and self.until and self.until <= time.time():
+            self.apply({'generation': self.generation})
+
+    def should_profile(self, scope):
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER:
+                    return hmac.compare_digest(value, self.token.encode())
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def begin(self, scope):
+        task = asyncio.current_task()
+        self._inflight[task] = scope
+        return task
+
+    def end(self, task):
+        self._inflight.pop(task, None)
+
+    def _on_signal(self, signum, frame):
+        scope = self._inflight.get(asyncio.current_task(self._loop))
+        if scope is not None and frame is not None:
+            self._record(scope, frame)
+
+    def _record(self, scope, frame):
+        names = []
+        while frame is not None and len(names) < MAX_DEPTH:
+            names.append(frame_name(frame.f_code))
+            frame = frame.f_back
+        route = scope.get("route")
+        names.append(f"{scope['method']}_{route.path if route is not None else scope['path']}")
+        stack = ";".join(reversed(names))
+        # Never wait in a signal handler: flush() may hold the lock, or this
+        # handler may have interrupted itself
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if stack not in self._stacks and len(self._stacks) >= self.max_stacks:
+                stack = OTHER_STACK
+            self._stacks[stack] += 1
+            self.samples += 1
+            self._dirty = True
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """Write this worker's stacks if they changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            lines = [f"{stack} {count}\n" for stack, count in self._stacks.items()]
+            self._dirty = False
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.profile_dir / f".{os.getpid()}{STACK_SUFFIX}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.stack_path)
+
+    def stop(self):
+        """Disarm the timer (SIGPROF would kill the process once the handler is gone) and save"""
+        if self._loop is not None:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            self.active = False
+        self.flush()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "sample_rate": self.sample_rate,
+            "samples": self.samples,
+            "stacks": len(self._stacks),
+            "in_flight": len(self._inflight)
+        }
+
+    async def watch(self):
+        """Follow the control file and write out samples in the background"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.load_control)
+                await loop.run_in_executor(None, self.flush)
+            except Exception as e:
+                logger.error(f"Profiler update failed: {e}")
+            await asyncio.sleep(POLL_INTERVAL)
+
+class ProfilerMiddleware:
+    """Profiles sampled requests; one attribute check per request while off"""
+
+    def __init__(self, app, profiler=None):
+        self.app = app
+        self.profiler = profiler or request_profiler
+
+    async def __call__(self, scope, receive, send):
+        profiler = self.profiler
+        if not profiler.active or scope["type"] != "http" or not profiler.should_profile(scope):
+            return await self.app(scope, receive, send)
+        task = profiler.begin(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.end(task)
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,206 @@
+"""
+Validation-gated publishing of ruleset revisions
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import asyncio
+import logging
+from datetime import datetime
+
+from utils.repo_index import (
+    PUBLISH_DIR, PUBLISH_META, POLL_INTERVAL, publish_config, source_index, file_sha256
+)
+from utils.validation import Validator
+
+KEEP_SNAPSHOTS = publish_config.get('keep', 5)  # published directories kept for in-flight downloads
+STARTUP_WAIT = publish_config.get('startup_wait', 120)  # seconds other workers wait for the first publish
+
+logger = logging.getLogger(__name__)
+
+class PublishError(Exception):
+    pass
+
+class Publisher:
+    """Validates each new revision of the working tree and publishes the good ones.
+
+    One process (the holder of an flock on the publish directory) follows
+    source_index. Every new revision is validated once; the report is kept
+    in validation/<revision>.json. A revision that passes is copied into
+    snapshots/<revision> (files unchanged since the current snapshot are
+    hard-linked) and the `current` symlink is swapped to it atomically.
+    Until then the previous good revision stays current. Every worker serves
+    `current` through repo_index.
+    """
+
+    def __init__(self, source=source_index, publish_dir=PUBLISH_DIR, keep=KEEP_SNAPSHOTS):
+        self.source = source
+        self.publish_dir = publish_dir
+        self.snapshots_dir = publish_dir / "snapshots"
+        self.reports_dir = publish_dir / "validation"
+        self.current_link = publish_dir / "current"
+        self.keep = keep
+        self.validator = Validator()
+        self._lock_file = None
+        self._attached = False
+
+    @property
+    def is_leader(self):
+        return self._lock_file is not None
+
+    def try_lead(self):
+        """Become the publishing process if no other worker is"""
+        if self._lock_file is None:
+            self.publish_dir.mkdir(parents=True, exist_ok=True)
+            lock_file = open(self.publish_dir / ".leader.lock", "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            logger.info(f"Publishing from {self.source.repo_path} (pid {os.getpid()})")
+            if not self._attached:
+                self.source.add_listener(self.on_source_change)
+                self._attached = True
+        return True
+
+    def _write_json(self, path, data):
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def load_report(self, revision):
+        try:
+            with open(self.reports_dir / f"{revision}.json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def current_meta(self):
+        """Metadata of the published snapshot, or None before the first publish"""
+        try:
+            with open(self.current_link / PUBLISH_META) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def status(self):
+        try:
+            with open(self.publish_dir / "status.json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"published": None, "latest": None}
+
+    def on_source_change(self, snapshot):
+        """Validate a new working tree revision and publish it if it passes"""
+        report = self.load_report(snapshot.revision)
+        if report is None:
+            report = self.validator.validate(snapshot)
+            self.reports_dir.mkdir(parents=True, exist_ok=True)
+            self._write_json(self.reports_dir / f"{snapshot.revision}.json", report)
+
+        current = self.current_meta()
+        if report["valid"] and (current is None or current["revision"] != snapshot.revision):
+            try:
+                current = self.publish(snapshot)
+            except (OSError, PublishError) as e:
+                logger.error(f"Publishing {snapshot.revision} failed: {e}")
+        elif not report["valid"]:
+            logger.error(
+                f"Revision {snapshot.revision} failed validation; still serving "
+                f"{current['revision'] if current else 'nothing'}"
+            )
+
+        summary = {key: value for key, value in report.items() if key not in ("errors", "warnings")}
+        summary["error_count"] = len(report["errors"])
+        summary["warning_count"] = len(report["warnings"])
+        self._write_json(self.publish_dir / "status.json", {
+            "published": {key: value for key, value in current.items() if key != "files"} if current else None,
+            "latest": summary
+        })
+
+    def publish(self, snapshot):
+        """Copy a validated snapshot into its own directory and make it current"""
+        self.snapshots_dir.mkdir(parents=True, exist_ok=True)
+        target = self.snapshots_dir / snapshot.revision
+        meta = {
+            "revision": snapshot.revision,
+            "commit": snapshot.commit,
+            "published_at": datetime.now().isoformat(),
+            "files": {rel_path: entry.sha256 for rel_path, entry in snapshot.files.items()}
+        }
+
+        if not target.exists():
+            current = self.current_meta()
+            previous = current["files"] if current else {}
+            previous_dir = self.current_link.resolve() if current else None
+            staging = self.snapshots_dir / f".{snapshot.revision}.{os.getpid()}.tmp"
+            shutil.rmtree(staging, ignore_errors=True)
+            try:
+                for rel_path, entry in snapshot.files.items():
+                    dest = staging / rel_path
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+                    if previous.get(rel_path) == entry.sha256:
+                        os.link(previous_dir / rel_path, dest)
+                        continue
+                    shutil.copy2(snapshot.repo_path / rel_path, dest)
+                    # The working tree may have moved on since validation
+                    if file_sha256(dest) != entry.sha256:
+                        raise PublishError(f"{rel_path} changed after validation")
+                self._write_json(staging / PUBLISH_META, meta)
+                os.rename(staging, target)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+        else:
+            self._write_json(target / PUBLISH_META, meta)
+
+        link_tmp = self.publish_dir / f".current.{os.getpid()}.tmp"
+        if link_tmp.is_symlink():
+            link_tmp.unlink()
+        os.symlink(os.path.join("snapshots", snapshot.revision), link_tmp)
+        os.replace(link_tmp, self.current_link)
+        logger.info(f"Published revision {snapshot.revision} ({len(snapshot.files)} files)")
+
+        self.prune(keep=target)
+        return meta
+
+    def prune(self, keep=None):
+        """Remove the oldest published directories beyond the configured count"""
+        snapshots = sorted(
+            (path for path in self.snapshots_dir.iterdir() if path.is_dir() and not path.name.startswith(".")),
+            key=lambda path: path.stat().st_mtime,
+            reverse=True
+        )
+        for path in snapshots[self.keep:]:
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def start(self, wait=STARTUP_WAIT):
+        """Take the leader role if free and validate/publish the working tree.
+
+        Other workers wait for the leader's first publish, so they never
+        start out serving an empty ruleset.
+        """
+        if self.try_lead():
+            self.source.refresh(force=True)
+            return
+        deadline = time.monotonic() + wait
+        while not self.current_link.exists() and time.monotonic() < deadline:
+            time.sleep(0.2)
+
+    async def watch(self):
+        """Follow the working tree while leading; keep trying to lead otherwise"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            try:
+                if self.is_leader or await loop.run_in_executor(None, self.try_lead):
+                    await loop.run_in_executor(None, self.source.refresh)
+            except Exception as e:
+                logger.error(f"Publisher refresh failed: {e}")
+
+publisher = Publisher()
@@ -0,0 +1,298 @@
+"""
+In-memory index of the rules repository
+"""
+import os
+import json
+import asyncio
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+from utils.git_sync import (
+    SOURCE_PATH, RULESET_DIRS, config, get_ruleset_files, get_head_commit, get_commit_time, open_repo,
+    resolve_revision, iter_ruleset_blobs, fetch_missing_blobs
+)
+from utils.metrics import REVISION_TIMESTAMP
+
+index_config = config.get('index', {})
+POLL_INTERVAL = index_config.get('poll_interval', 1.0)  # seconds between directory checks
+FULL_RESCAN_INTERVAL = index_config.get('full_rescan_interval', 30)  # catches in-place edits
+
+publish_config = config.get('publish', {})
+PUBLISH_ENABLED = publish_config.get('enabled', False)
+PUBLISH_DIR = Path(publish_config.get('dir', '/opt/wazuh-api/published'))
+PUBLISH_META = ".publish.json"  # written into each published snapshot directory
+HISTORY_SIZE = index_config.get('history_size', 8)  # committed revisions kept indexed for ?revision=
+
+logger = logging.getLogger(__name__)
+
+def file_sha256(path):
+    """Hash a file in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class FileEntry:
+    __slots__ = ("path", "size", "mtime_ns", "sha256")
+
+    def __init__(self, path, size, mtime_ns, sha256):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha256 = sha256
+
+class Snapshot:
+    """One scanned state of the repository and the response bodies derived from it.
+
+    Snapshots are immutable once built, so handlers can use one without
+    locking while the index swaps in a newer one.
+    """
+    historical = False  # True for revisions read from git rather than the served tree
+
+    def __init__(self, repo_path, files, commit, checked_at):
+        self.repo_path = repo_path
+        self.files = files  # relative path -> FileEntry, sorted by path
+        self.commit = commit
+        self.checked_at = checked_at
+
+        revision = hashlib.sha256()
+        for rel_path, entry in files.items():
+            revision.update(f"{rel_path}\0{entry.sha256}\n".encode())
+        self.revision = revision.hexdigest()[:16]
+
+        self.rules = [p.split("/", 1)[1] for p in files if p.startswith("rules/")]
+        self.decoders = [p.split("/", 1)[1] for p in files if p.startswith("decoders/")]
+        counts = {
+            "rules": len(self.rules),
+            "decoders": len(self.decoders),
+            "total": len(self.rules) + len(self.decoders)
+        }
+
+        # Everything except the per-request fields, serialized once
+        self._list_body = json.dumps({
+            "rules": self.rules,
+            "decoders": self.decoders,
+            "counts": counts
+        })[1:-1].encode()
+        self._stats_body = json.dumps({
+            "repository": str(repo_path),
+            "file_counts": counts,
+            "last_checked": checked_at
+        })[1:-1].encode()
+        self.manifest_body = json.dumps({
+            "revision": self.revision,
+            "commit": commit,
+            "files": [
+                {"path": entry.path, "size": entry.size, "sha256": entry.sha256}
+                for entry in files.values()
+            ]
+        }).encode()
+
+    def source_files(self, rel_paths=None):
+        """(archive name, absolute path) pairs for packaging"""
+        return [(rel_path, self.repo_path / rel_path) for rel_path in (self.files if rel_paths is None else rel_paths)]
+
+    def read_files(self, rel_paths):
+        """(relative path, content) for each path"""
+        for rel_path in rel_paths:
+            yield rel_path, (self.repo_path / rel_path).read_bytes()
+
+    def list_body(self, server_id):
+        """JSON body for /api/rules/list"""
+        return b"".join((
+            b'{"success": true, "server": ', json.dumps(server_id).encode(), b", ",
+            self._list_body,
+            b', "timestamp": ', json.dumps(datetime.now().isoformat()).encode(), b"}"
+        ))
+
+    def stats_body(self, server_id):
+        """JSON body for /api/rules/stats"""
+        return b"".join((
+            b'{"server": ', json.dumps(server_id).encode(), b", ", self._stats_body, b"}"
+        ))
+
+class RepoIndex:
+    """Keeps a Snapshot of the repository current without rescanning per request.
+
+    refresh() compares the mtimes of the rules/ and decoders/ directories,
+    which change whenever files are added, removed or replaced (as git
+    does), and rescans only then. A full stat pass every
+    FULL_RESCAN_INTERVAL seconds catches files edited in place. Files whose
+    size and mtime are unchanged keep their previous hash.
+    """
+
+    def __init__(self, repo_path=SOURCE_PATH, poll_interval=POLL_INTERVAL,
+                 full_rescan_interval=FULL_RESCAN_INTERVAL, commit_reader=None):
+        self.repo_path = repo_path
+        self.commit_reader = commit_reader or get_head_commit
+        self.poll_interval = poll_interval
+        self.full_rescan_interval = full_rescan_interval
+        self._snapshot = None
+        self._signature = None
+        self._last_full_scan = 0.0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Call callback(snapshot) from the refreshing thread whenever the revision changes"""
+        self._listeners.append(callback)
+
+    def _directory_signature(self):
+        signature = []
+        for subdir in RULESET_DIRS:
+            try:
+                st = os.stat(self.repo_path / subdir)
+                signature.append((st.st_ino, st.st_mtime_ns))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _scan(self, root):
+        # Hashes are only reused within the same directory (a published
+        # snapshot switch changes root)
+        same_root = self._snapshot and self._snapshot.repo_path == root
+        previous = self._snapshot.files if same_root else {}
+        files = {}
+        for rel_path, abs_path in get_ruleset_files(root):
+            try:
+                st = abs_path.stat()
+            except FileNotFoundError:
+                continue
+            entry = previous.get(rel_path)
+            if not (entry and entry.size == st.st_size and entry.mtime_ns == st.st_mtime_ns):
+                entry = FileEntry(rel_path, st.st_size, st.st_mtime_ns, file_sha256(abs_path))
+            files[rel_path] = entry
+        return files
+
+    def refresh(self, force=False):
+        """Rescan if the tree may have changed; returns the current Snapshot"""
+        with self._lock:
+            now = time.monotonic()
+            signature = self._directory_signature()
+            full_scan_due = now - self._last_full_scan >= self.full_rescan_interval
+            if not force and self._snapshot and signature == self._signature and not full_scan_due:
+                return self._snapshot
+
+            # Resolved once, so a snapshot keeps reading the directory it scanned
+            # even if repo_path is a symlink that gets swapped
+            root = Path(os.path.realpath(self.repo_path))
+            files = self._scan(root)
+            self._signature = signature
+            self._last_full_scan = now
+
+            previous = snapshot = self._snapshot
+            changed = snapshot is None or files.keys() != snapshot.files.keys() or any(
+                files[rel_path] is not snapshot.files[rel_path] for rel_path in files
+            )
+            commit = self.commit_reader(root)
+            if changed or commit != snapshot.commit or root != snapshot.repo_path:
+                self._snapshot = Snapshot(root, files, commit, datetime.now().isoformat())
+                logger.info(f"Ruleset revision {self._snapshot.revision} ({len(files)} files)")
+            snapshot = self._snapshot
+            new_revision = previous is None or snapshot.revision != previous.revision
+
+        if new_revision:
+            for callback in self._listeners:
+                try:
+                    callback(snapshot)
+                except Exception as e:
+                    logger.error(f"Repository index listener failed: {e}")
+        return snapshot
+
+    async def watch(self):
+        """Poll for changes in the background so requests never wait on a scan"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await loop.run_in_executor(None, self.refresh)
+            except Exception as e:
+                logger.error(f"Repository index refresh failed: {e}")
+
+    @property
+    def snapshot(self):
+        """Current Snapshot; only the very first access scans synchronously"""
+        return self._snapshot or self.refresh(force=True)
+
+class GitSnapshot(Snapshot):
+    """A committed revision read from the git object database, with no checkout.
+
+    Holds only blob ids; contents are read again when a package is built.
+    """
+    historical = True
+
+    def __init__(self, repo_path, files, blobs, commit, committed_at):
+        self._blobs = blobs  # relative path -> binary blob id
+        super().__init__(repo_path, files, commit, committed_at)
+
+    def read_files(self, rel_paths):
+        repo = open_repo(self.repo_path)
+        try:
+            for rel_path in rel_paths:
+                yield rel_path, repo.odb.stream(self._blobs[rel_path]).read()
+        finally:
+            repo.close()
+
+    def source_files(self, rel_paths=None):
+        return self.read_files(self.files if rel_paths is None else rel_paths)
+
+_history = OrderedDict()  # commit -> GitSnapshot, most recent last
+_history_lock = threading.Lock()
+
+def snapshot_at(revision):
+    """Snapshot of a commit, tag or branch, or None if the repository does not
+    have it (or, with a blob-less mirror, cannot get its files)"""
+    commit = resolve_revision(revision)
+    if commit is None:
+        return None
+    with _history_lock:
+        snapshot = _history.get(commit)
+        if snapshot is not None:
+            _history.move_to_end(commit)
+            return snapshot
+
+    if not fetch_missing_blobs(commit):
+        return None
+    repo = open_repo()
+    try:
+        files = {}
+        blobs = {}
+        for rel_path, blob in sorted(iter_ruleset_blobs(repo, commit), key=lambda item: item[0]):
+            data = blob.data_stream.read()
+            files[rel_path] = FileEntry(rel_path, len(data), 0, hashlib.sha256(data).hexdigest())
+            blobs[rel_path] = blob.binsha
+        committed_at = repo.commit(commit).committed_datetime.isoformat()
+    finally:
+        repo.close()
+    snapshot = GitSnapshot(SOURCE_PATH, files, blobs, commit, committed_at)
+    logger.info(f"Indexed commit {commit[:12]} as revision {snapshot.revision} ({len(files)} files)")
+
+    with _history_lock:
+        _history[commit] = snapshot
+        while len(_history) > HISTORY_SIZE:
+            _history.popitem(last=False)
+    return snapshot
+
+def record_revision_time(snapshot):
+    """Listener exporting when the served revision was committed (or first seen)"""
+    committed_at = get_commit_time(snapshot.commit) if snapshot.commit else None
+    REVISION_TIMESTAMP.set(committed_at or time.time())
+
+def published_commit(root):
+    """Commit recorded when a snapshot directory was published"""
+    try:
+        with open(root / PUBLISH_META) as f:
+            return json.load(f).get('commit')
+    except (OSError, ValueError):
+        return None
+
+# source_index follows the working tree; repo_index is what the API serves,
+# which is the last published (validated) snapshot when publishing is enabled
+source_index = RepoIndex()
+repo_index = RepoIndex(PUBLISH_DIR / "current", commit_reader=published_commit) if PUBLISH_ENABLED else source_index
@@ -0,0 +1,82 @@
+"""
+Wakes requests waiting for a new ruleset revision
+"""
+import asyncio
+import random
+import resource
+import logging
+
+from utils.git_sync import config
+from utils.repo_index import repo_index
+
+watch_config = config.get('watch', {})
+WATCH_TIMEOUT = watch_config.get('timeout', 55)  # seconds a long-poll is held by default
+MAX_WATCH_TIMEOUT = watch_config.get('max_timeout', 300)
+WAKE_JITTER = watch_config.get('jitter', 5.0)  # seconds over which waiters are woken
+SSE_KEEPALIVE = watch_config.get('keepalive', 15)  # seconds between SSE comments
+
+logger = logging.getLogger(__name__)
+
+def raise_fd_limit():
+    """Lift the soft open-file limit to the hard one; every held watch is a socket"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            logger.warning(f"Could not raise the open file limit from {soft}: {e}")
+            return soft
+    return hard
+
+class RevisionWatch:
+    """Lets any number of requests wait for the next revision of repo_index.
+
+    All waiters share one future per revision, so a new revision wakes them
+    with a single set_result(). An idle watcher costs a done-callback on that
+    future plus the timer asyncio.wait() schedules for its timeout, but no
+    task beyond its request's own. notify() is a
+    repo_index listener and runs in the refreshing thread; it hands over to
+    the event loop, which resolves the future and replaces it. Each woken
+    waiter then sleeps a random fraction of WAKE_JITTER so the pullers it
+    answers do not all ask for the package in the same instant.
+    """
+
+    def __init__(self, index=repo_index, jitter=WAKE_JITTER):
+        self.index = index
+        self.jitter = jitter
+        self.waiting = 0
+        self._loop = None
+        self._next = None
+
+    def attach(self, loop):
+        """Bind to the event loop serving requests"""
+        self._loop = loop
+        self._next = loop.create_future()
+
+    def notify(self, snapshot):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake, snapshot)
+
+    def _wake(self, snapshot):
+        woken, self._next = self._next, self._loop.create_future()
+        woken.set_result(snapshot)
+        if self.waiting:
+            logger.info(f"Revision {snapshot.revision}: waking {self.waiting} watchers")
+
+    async def wait(self, since, timeout):
+        """The current Snapshot once its revision differs from since, or None after timeout"""
+        snapshot = self.index.snapshot
+        if snapshot.revision != since or self._next is None:
+            return snapshot
+        self.waiting += 1
+        try:
+            done, _ = await asyncio.wait((self._next,), timeout=timeout)
+        finally:
+            self.waiting -= 1
+        if not done:
+            return None
+        if self.jitter:
+            await asyncio.sleep(random.uniform(0, self.jitter))
+        return self.index.snapshot
+
+revision_watch = RevisionWatch()
@@ -0,0 +1,273 @@
+"""
+Parsed index of rule and decoder definitions
+"""
+import re
+import bisect
+import logging
+import threading
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+# Rule files are XML fragments whose regexes may hold bare & and <, which a
+# strict parser rejects; these get escaped before a second parse attempt
+BARE_AMPERSAND = re.compile(rb"&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)")
+BARE_LESS_THAN = re.compile(rb"<(?![A-Za-z_/!?])")
+XML_DECLARATION = re.compile(rb"^\s*<\?xml[^>]*\?>")
+WORD = re.compile(r"[a-z0-9_]+")
+
+def split_list(value):
+    """Split a comma/space separated tag or id list"""
+    return [item for item in re.split(r"[,\s]+", value or "") if item]
+
+def parse_ids(value):
+    ids = []
+    for item in split_list(value):
+        try:
+            ids.append(int(item))
+        except ValueError:
+            pass
+    return ids
+
+class RuleInfo:
+    __slots__ = (
+        "id", "level", "file", "description", "groups", "if_sid", "if_matched_sid",
+        "if_group", "if_matched_group", "decoded_as", "mitre", "overwrite"
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class DecoderInfo:
+    __slots__ = ("name", "parent", "file")
+
+    def __init__(self, name, parent, file):
+        self.name = name
+        self.parent = parent
+        self.file = file
+
+    def to_dict(self):
+        return {"name": self.name, "parent": self.parent, "file": self.file}
+
+def parse_fragment(data, lenient=True):
+    """Parse a rule/decoder file under a synthetic root element"""
+    body = XML_DECLARATION.sub(b"", data)
+    try:
+        return ET.fromstring(b"<root>" + body + b"</root>")
+    except ET.ParseError:
+        if not lenient:
+            raise
+        body = BARE_LESS_THAN.sub(b"&lt;", BARE_AMPERSAND.sub(b"&amp;", body))
+        return ET.fromstring(b"<root>" + body + b"</root>")
+
+def _text(element, tag):
+    child = element.find(tag)
+    return child.text.strip() if child is not None and child.text else None
+
+def _collect_rules(element, rel_path, inherited_groups, rules):
+    for child in element:
+        if child.tag == "group":
+            _collect_rules(child, rel_path, inherited_groups + split_list(child.get("name")), rules)
+        elif child.tag == "rule":
+            groups = list(inherited_groups)
+            for group in child.findall("group"):
+                groups.extend(split_list(group.text))
+            try:
+                rule_id = int(child.get("id"))
+            except (TypeError, ValueError):
+                continue
+            try:
+                level = int(child.get("level"))
+            except (TypeError, ValueError):
+                level = None
+            if_matched_sid = parse_ids(_text(child, "if_matched_sid"))
+            rules.append(RuleInfo(
+                id=rule_id,
+                level=level,
+                file=rel_path,
+                description=_text(child, "description") or "",
+                groups=list(dict.fromkeys(groups)),
+                if_sid=parse_ids(_text(child, "if_sid")),
+                if_matched_sid=if_matched_sid[0] if if_matched_sid else None,
+                if_group=split_list(_text(child, "if_group")),
+                if_matched_group=split_list(_text(child, "if_matched_group")),
+                decoded_as=_text(child, "decoded_as"),
+                mitre=[node.text.strip() for node in child.findall("mitre/id") if node.text],
+                overwrite=child.get("overwrite", "no").lower() == "yes"
+            ))
+
+def parse_ruleset_file(rel_path, data):
+    """Parse one rule or decoder file into (rules, decoders)"""
+    return definitions_from_tree(rel_path, parse_fragment(data))
+
+def definitions_from_tree(rel_path, root):
+    """Rules and decoders defined under a parsed root element"""
+    rules = []
+    _collect_rules(root, rel_path, [], rules)
+    decoders = [
+        DecoderInfo(decoder.get("name"), _text(decoder, "parent"), rel_path)
+        for decoder in root.iter("decoder") if decoder.get("name")
+    ]
+    return rules, decoders
+
+class ParsedRuleset:
+    """Rules and decoders of one revision with lookup indexes.
+
+    Immutable once built, like the repo_index Snapshot it was built from.
+    """
+
+    def __init__(self, revision, files, rules, decoders, errors):
+        self.revision = revision
+        self.files = files  # every parsed relative path
+        self.rules = sorted(rules, key=lambda rule: (rule.id, rule.file))
+        self.decoders = decoders
+        self.errors = errors  # relative path -> parse error
+        self.subsets = {}  # (Selection, include_all_decoders) -> files, see utils.subsets
+
+        self.rule_ids = [rule.id for rule in self.rules]  # sorted, for id ranges
+        self.by_id = {}
+        self.by_level = {}
+        self.by_group = {}
+        self.by_word = {}
+        self.rules_by_file = {}
+        for position, rule in enumerate(self.rules):
+            self.by_id.setdefault(rule.id, []).append(position)
+            self.rules_by_file.setdefault(rule.file, []).append(position)
+            self.by_level.setdefault(rule.level, []).append(position)
+            for group in rule.groups:
+                self.by_group.setdefault(group.lower(), []).append(position)
+            for word in set(WORD.findall(rule.description.lower())):
+                self.by_word.setdefault(word, []).append(position)
+
+        self.decoders_by_name = {}
+        self.decoder_children = {}
+        self.decoders_by_file = {}
+        for decoder in decoders:
+            self.decoders_by_name.setdefault(decoder.name, []).append(decoder)
+            self.decoders_by_file.setdefault(decoder.file, []).append(decoder)
+            if decoder.parent:
+                self.decoder_children.setdefault(decoder.parent, []).append(decoder)
+
+    def search_rules(self, rule_id=None, id_from=None, id_to=None, level=None, min_level=None,
+                     group=None, text=None):
+        """Rules matching every given filter, in id order"""
+        candidates = None
+
+        def narrow(positions):
+            nonlocal candidates
+            positions = set(positions)
+            candidates = positions if candidates is None else candidates & positions
+
+        if rule_id is not None:
+            narrow(self.by_id.get(rule_id, ()))
+        if id_from is not None or id_to is not None:
+            start = bisect.bisect_left(self.rule_ids, id_from) if id_from is not None else 0
+            end = bisect.bisect_right(self.rule_ids, id_to) if id_to is not None else len(self.rule_ids)
+            narrow(range(start, end))
+        if level is not None:
+            narrow(self.by_level.get(level, ()))
+        if group:
+            narrow(self.by_group.get(group.lower(), ()))
+        if text:
+            words = WORD.findall(text.lower())
+            for word in words:
+                narrow(self.by_word.get(word, ()))
+            if not words:
+                narrow(())
+
+        positions = range(len(self.rules)) if candidates is None else sorted(candidates)
+        return [
+            self.rules[position] for position in positions
+            if min_level is None or (self.rules[position].level or 0) >= min_level
+        ]
+
+    def search_decoders(self, name=None, parent=None):
+        """Decoders matching name and/or parent"""
+        if name is not None:
+            decoders = self.decoders_by_name.get(name, [])
+        elif parent is not None:
+            decoders = self.decoder_children.get(parent, [])
+        else:
+            decoders = self.decoders
+        return [decoder for decoder in decoders if parent is None or decoder.parent == parent]
+
+class RuleIndex:
+    """Keeps a ParsedRuleset in step with the repository index.
+
+    Parse results are kept per file and reused while the file's SHA-256 is
+    unchanged, so a new revision only re-parses the files that changed.
+    """
+
+    def __init__(self):
+        self._parsed = {}  # relative path -> (sha256, rules, decoders, error)
+        self._current = None
+        self._lock = threading.Lock()
+
+    def _build(self, snapshot, previous):
+        """ParsedRuleset for snapshot, reusing parse results from previous; returns it and the per-file results"""
+        parsed = {}
+        stale = []
+        for rel_path, entry in snapshot.files.items():
+            cached = previous.get(rel_path)
+            if cached and cached[0] == entry.sha256:
+                parsed[rel_path] = cached
+            else:
+                stale.append(rel_path)
+
+        try:
+            for rel_path, data in snapshot.read_files(stale):
+                sha256 = snapshot.files[rel_path].sha256
+                try:
+                    rules, decoders = parse_ruleset_file(rel_path, data)
+                    parsed[rel_path] = (sha256, rules, decoders, None)
+                except ET.ParseError as e:
+                    logger.warning(f"Could not parse {rel_path}: {e}")
+                    parsed[rel_path] = (sha256, [], [], str(e))
+        except OSError as e:
+            # The tree changed under the scan; the next refresh rebuilds
+            logger.warning(f"Could not read {snapshot.revision}: {e}")
+
+        parsed = {rel_path: parsed[rel_path] for rel_path in snapshot.files if rel_path in parsed}
+        ruleset = ParsedRuleset(
+            snapshot.revision,
+            list(parsed),
+            [rule for _, rules, _, _ in parsed.values() for rule in rules],
+            [decoder for _, _, decoders, _ in parsed.values() for decoder in decoders],
+            {rel_path: error for rel_path, (_, _, _, error) in parsed.items() if error}
+        )
+        logger.info(
+            f"Rule index for {snapshot.revision}: {len(ruleset.rules)} rules, "
+            f"{len(ruleset.decoders)} decoders ({len(stale)} files parsed)"
+        )
+        return ruleset, parsed
+
+    def update(self, snapshot):
+        """Build the ParsedRuleset for a repo_index Snapshot"""
+        with self._lock:
+            if self._current and self._current.revision == snapshot.revision:
+                return self._current
+            self._current, self._parsed = self._build(snapshot, self._parsed)
+            return self._current
+
+    def get(self, snapshot):
+        """ParsedRuleset for snapshot, building it if the listener has not yet.
+
+        Historical snapshots (see repo_index.snapshot_at) get their own
+        ParsedRuleset, kept on the snapshot, and leave the current one alone.
+        """
+        current = self._current
+        if current and current.revision == snapshot.revision:
+            return current
+        if snapshot.historical:
+            ruleset = getattr(snapshot, "ruleset", None)
+            if ruleset is None:
+                ruleset, _ = self._build(snapshot, self._parsed)
+                snapshot.ruleset = ruleset
+            return ruleset
+        return self.update(snapshot)
+
+rule_index = RuleIndex()
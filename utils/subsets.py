@@ -0,0 +1,145 @@
+"""
+Dependency-aware ruleset subsets
+"""
+import hashlib
+import logging
+from fnmatch import fnmatchcase
+from typing import NamedTuple, Tuple
+
+from utils.git_sync import config
+
+subsets_config = config.get('subsets', {})
+INCLUDE_ALL_DECODERS = subsets_config.get('include_all_decoders', True)
+
+logger = logging.getLogger(__name__)
+
+class Selection(NamedTuple):
+    """Rule groups (fnmatch patterns) and inclusive rule id ranges to package"""
+    groups: Tuple[str, ...] = ()
+    rule_ranges: Tuple[Tuple[int, int], ...] = ()
+
+    @property
+    def key(self):
+        """Short stable name for cache keys and headers"""
+        canonical = ",".join(self.groups) + "|" + ",".join(f"{lo}-{hi}" for lo, hi in self.rule_ranges)
+        return hashlib.sha256(canonical.encode()).hexdigest()[:12]
+
+    def __bool__(self):
+        return bool(self.groups or self.rule_ranges)
+
+    def union(self, other):
+        return make_selection(self.groups + other.groups, self.rule_ranges + other.rule_ranges)
+
+def parse_ranges(values):
+    """Parse ids and "low-high" ranges (strings or ints) into (low, high) pairs"""
+    ranges = []
+    for value in values:
+        for item in str(value).split(","):
+            item = item.strip()
+            if not item:
+                continue
+            low, _, high = item.partition("-")
+            try:
+                ranges.append((int(low), int(high or low)))
+            except ValueError:
+                raise ValueError(f"Invalid rule id range: {item}")
+    return ranges
+
+def make_selection(groups=(), rule_ranges=()):
+    """Normalized Selection, so equal selections share cache entries"""
+    groups = sorted({group.strip().lower() for group in groups if group.strip()})
+    return Selection(tuple(groups), tuple(sorted(set(rule_ranges))))
+
+def selection_from_config(entry):
+    """Selection from a subsets.environments/locations entry"""
+    return make_selection(entry.get('groups', []), parse_ranges(entry.get('rule_ids', [])))
+
+ENVIRONMENT_SELECTIONS = {
+    name: selection_from_config(entry) for name, entry in subsets_config.get('environments', {}).items()
+}
+LOCATION_SELECTIONS = {
+    name: selection_from_config(entry) for name, entry in subsets_config.get('locations', {}).items()
+}
+
+def selection_for(environment=None, location=None):
+    """Selection configured for a server's environment and location (their union),
+    or None when neither has one and the server gets the full ruleset"""
+    selection = None
+    for configured in (ENVIRONMENT_SELECTIONS.get(environment), LOCATION_SELECTIONS.get(location)):
+        if configured:
+            selection = configured if selection is None else selection.union(configured)
+    return selection
+
+def configured_selections():
+    """Every distinct selection in the config"""
+    return set(ENVIRONMENT_SELECTIONS.values()) | set(LOCATION_SELECTIONS.values())
+
+def _selected(rule, selection):
+    if any(lo <= rule.id <= hi for lo, hi in selection.rule_ranges):
+        return True
+    return any(
+        fnmatchcase(group.lower(), pattern) for group in rule.groups for pattern in selection.groups
+    )
+
+def resolve_subset(ruleset, selection, include_all_decoders=INCLUDE_ALL_DECODERS):
+    """Files needed to load the selected rules, as a sorted tuple of relative paths.
+
+    Starts from the files defining the selected rules and adds, until nothing
+    changes, the files defining what their rules depend on: if_sid and
+    if_matched_sid parents, rules providing if_group/if_matched_group groups,
+    and decoded_as decoders with their parent chain. Whole files are the unit
+    because analysisd loads files, so every rule in an included file pulls in
+    its own parents too. Parents not in the repository (the stock Wazuh
+    ruleset) are left to the manager. Results are kept on the ruleset.
+    """
+    cached = ruleset.subsets.get((selection, include_all_decoders))
+    if cached is not None:
+        return cached
+
+    files = set()
+    pending = [rule.file for rule in ruleset.rules if _selected(rule, selection)]
+    missing = set()
+
+    def add_decoder(name):
+        seen = set()
+        while name and name not in seen:
+            seen.add(name)
+            decoders = ruleset.decoders_by_name.get(name)
+            if not decoders:
+                missing.add(f"decoder:{name}")
+                return
+            pending.extend(decoder.file for decoder in decoders)
+            name = decoders[0].parent
+
+    while pending:
+        rel_path = pending.pop()
+        if rel_path in files:
+            continue
+        files.add(rel_path)
+        for decoder in ruleset.decoders_by_file.get(rel_path, ()):
+            add_decoder(decoder.parent)
+        for position in ruleset.rules_by_file.get(rel_path, ()):
+            rule = ruleset.rules[position]
+            parent_ids = list(rule.if_sid)
+            if rule.if_matched_sid is not None:
+                parent_ids.append(rule.if_matched_sid)
+            for parent_id in parent_ids:
+                positions = ruleset.by_id.get(parent_id)
+                if positions:
+                    pending.extend(ruleset.rules[p].file for p in positions)
+                else:
+                    missing.add(parent_id)
+            for group in rule.if_group + rule.if_matched_group:
+                pending.extend(ruleset.rules[p].file for p in ruleset.by_group.get(group.lower(), ()))
+            if not include_all_decoders and rule.decoded_as:
+                add_decoder(rule.decoded_as)
+
+    if include_all_decoders:
+        files.update(rel_path for rel_path in ruleset.files if rel_path.startswith("decoders/"))
+
+    logger.info(
+        f"Subset {selection.key} of {ruleset.revision}: {len(files)} files, "
+        f"{len(missing)} parents outside the repository"
+    )
+    result = ruleset.subsets[(selection, include_all_decoders)] = tuple(sorted(files))
+    return result
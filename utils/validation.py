@@ -0,0 +1,163 @@
+"""
+Ruleset validation run before a revision is published
+"""
+import os
+import time
+import logging
+import multiprocessing
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from utils.git_sync import config
+from utils.rule_index import parse_fragment, definitions_from_tree
+
+validation_config = config.get('validation', {})
+MAX_REGEX_LENGTH = validation_config.get('max_regex_length', 2048)
+BUILTIN_RULE_MAX = validation_config.get('builtin_rule_max', 99999)  # stock Wazuh rule ids
+EXTERNAL_DECODERS = set(validation_config.get('external_decoders', []))  # stock parent decoders
+PARALLEL_THRESHOLD = validation_config.get('parallel_threshold', 200)  # files before using processes
+WORKERS = validation_config.get('workers') or os.cpu_count() or 1
+
+# Elements whose text analysisd compiles as a pattern
+PATTERN_TAGS = {
+    "regex", "match", "prematch", "program_name", "hostname", "field", "url", "user",
+    "srcip", "dstip", "srcport", "dstport", "location", "action", "id", "status",
+    "extra_data", "data", "system_name", "protocol"
+}
+
+logger = logging.getLogger(__name__)
+
+def problem(check, file, message, **details):
+    return dict(check=check, file=file, message=message, **details)
+
+def validate_file(rel_path, abs_path):
+    """Checks that need only one file; returns (rules, decoders, errors, warnings)"""
+    errors = []
+    warnings = []
+    try:
+        with open(abs_path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        return [], [], [problem("read", rel_path, str(e))], []
+
+    try:
+        root = parse_fragment(data, lenient=False)
+    except ET.ParseError as strict_error:
+        try:
+            root = parse_fragment(data)
+            warnings.append(problem("xml", rel_path, f"Unescaped & or < ({strict_error})"))
+        except ET.ParseError as e:
+            return [], [], [problem("xml", rel_path, f"Malformed XML: {e}")], []
+
+    for element in root.iter():
+        if element.tag in PATTERN_TAGS and element.text and len(element.text) > MAX_REGEX_LENGTH:
+            errors.append(problem(
+                "regex_length", rel_path,
+                f"<{element.tag}> is {len(element.text)} characters (limit {MAX_REGEX_LENGTH})"
+            ))
+
+    rules, decoders = definitions_from_tree(rel_path, root)
+    return rules, decoders, errors, warnings
+
+def cross_file_checks(parsed):
+    """Checks across the whole ruleset: duplicate ids and dangling references"""
+    errors = []
+    definitions = {}
+    decoder_names = set(EXTERNAL_DECODERS)
+    for rel_path, (rules, decoders, _, _) in parsed.items():
+        for rule in rules:
+            definitions.setdefault(rule.id, []).append(rule)
+        decoder_names.update(decoder.name for decoder in decoders)
+
+    for rule_id, rules in definitions.items():
+        originals = [rule for rule in rules if not rule.overwrite]
+        if len(originals) > 1:
+            errors.append(problem(
+                "duplicate_id", originals[1].file,
+                f"Rule {rule_id} is also defined in {originals[0].file}",
+                rule_id=rule_id, files=sorted({rule.file for rule in originals})
+            ))
+
+    for rel_path, (rules, decoders, _, _) in parsed.items():
+        for rule in rules:
+            parents = list(rule.if_sid)
+            if rule.if_matched_sid is not None:
+                parents.append(rule.if_matched_sid)
+            for parent in parents:
+                if parent > BUILTIN_RULE_MAX and parent not in definitions:
+                    errors.append(problem(
+                        "dangling_if_sid", rel_path,
+                        f"Rule {rule.id} depends on undefined rule {parent}",
+                        rule_id=rule.id, parent=parent
+                    ))
+        for decoder in decoders:
+            if decoder.parent and decoder.parent not in decoder_names:
+                errors.append(problem(
+                    "dangling_decoder_parent", rel_path,
+                    f"Decoder {decoder.name} has undefined parent {decoder.parent}",
+                    decoder=decoder.name, parent=decoder.parent
+                ))
+    return errors
+
+class Validator:
+    """Validates repository snapshots, re-parsing only files whose hash changed.
+
+    Per-file checks for large change sets run in a process pool; the
+    cross-file checks are cheap and always run over the whole ruleset.
+    """
+
+    def __init__(self, workers=WORKERS, parallel_threshold=PARALLEL_THRESHOLD):
+        self.workers = workers
+        self.parallel_threshold = parallel_threshold
+        self._files = {}  # relative path -> (sha256, per-file result)
+
+    def _validate_files(self, jobs):
+        if len(jobs) < self.parallel_threshold or self.workers < 2:
+            return [validate_file(rel_path, abs_path) for rel_path, abs_path in jobs]
+        # spawn, since the API process has threads a fork could inherit locks from
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+            paths = [rel_path for rel_path, _ in jobs]
+            sources = [abs_path for _, abs_path in jobs]
+            return list(pool.map(validate_file, paths, sources, chunksize=64))
+
+    def validate(self, snapshot):
+        """Validate a repo_index Snapshot; returns a JSON-serializable report"""
+        start = time.perf_counter()
+        results = {}
+        jobs = []
+        for rel_path, entry in snapshot.files.items():
+            cached = self._files.get(rel_path)
+            if cached and cached[0] == entry.sha256:
+                results[rel_path] = cached[1]
+            else:
+                jobs.append((rel_path, snapshot.repo_path / rel_path))
+
+        for (rel_path, _), result in zip(jobs, self._validate_files(jobs)):
+            results[rel_path] = result
+        self._files = {
+            rel_path: (snapshot.files[rel_path].sha256, result) for rel_path, result in results.items()
+        }
+
+        errors = [error for _, _, file_errors, _ in results.values() for error in file_errors]
+        warnings = [warning for _, _, _, file_warnings in results.values() for warning in file_warnings]
+        errors.extend(cross_file_checks(results))
+
+        report = {
+            "revision": snapshot.revision,
+            "commit": snapshot.commit,
+            "valid": not errors,
+            "checked_at": datetime.now().isoformat(),
+            "files": len(results),
+            "files_parsed": len(jobs),
+            "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+            "errors": errors,
+            "warnings": warnings
+        }
+        logger.log(
+            logging.INFO if report["valid"] else logging.ERROR,
+            f"Validation of {snapshot.revision}: {len(errors)} errors, {len(warnings)} warnings "
+            f"({len(jobs)} of {len(results)} files parsed in {report['duration_ms']} ms)"
+        )
+        return report
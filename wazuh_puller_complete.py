@@ -3,17 +3,62 @@
 Complete Wazuh API Puller for Production
 """
 import requests
+import base64
+import hashlib
 import zipfile
+import tarfile
 import tempfile
 import shutil
 import os
 import sys
 import json
 import time
+import random
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 import subprocess
 from datetime import datetime
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Returned by the download methods when there is nothing new to deploy
+NOT_MODIFIED = object()
+
+# Package formats we can extract, most compact first (q-values for Accept)
+PACKAGE_MEDIA_TYPES = [
+    ("application/zstd", 1.0),
+    ("application/x-xz", 0.9),
+    ("application/gzip", 0.5),
+    ("application/zip", 0.1),
+]
+if zstandard is None:
+    PACKAGE_MEDIA_TYPES = PACKAGE_MEDIA_TYPES[1:]
+
+def file_sha256(path):
+    """Hash a file in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def extract_tar(tar, dest):
+    """Extract regular files and directories only, never outside dest"""
+    if hasattr(tarfile, "data_filter"):
+        tar.extractall(dest, filter="data")
+        return
+    
+    # Older Pythons without extraction filters
+    root = os.path.realpath(dest)
+    for member in tar:
+        target = os.path.realpath(os.path.join(root, member.name))
+        if not (member.isfile() or member.isdir()) or os.path.commonpath([root, target]) != root:
+            raise ValueError(f"Unsafe path in package: {member.name}")
+        tar.extract(member, root)
+
 class WazuhAPIPuller:
     def __init__(self, config_path="/etc/wazuh/api_puller.json"):
         self.config = self.load_config(config_path)
@@ -25,6 +70,16 @@ class WazuhAPIPuller:
         self.rules_dir = Path("/var/ossec/etc/rules")
         self.decoders_dir = Path("/var/ossec/etc/decoders")
         self.backup_dir = Path("/var/ossec/backups")
+        self.state_file = Path(self.config['state_file'])
+        # An interrupted package download, kept so the next attempt can resume it
+        self.partial_file = self.state_file.with_name(".api_puller_package.part")
+        self.partial_meta = self.state_file.with_name(".api_puller_package.part.json")
+        self.state = self.load_state()
+        self.package_revision = None
+        self.package_commit = None
+        self.package_etag = None
+        # Subset the API serves this server (None = full ruleset)
+        self.package_subset = self.state.get('subset')
         
         # Headers for API requests
         self.headers = {
@@ -43,7 +98,15 @@ class WazuhAPIPuller:
             "server_id": "unknown",
             "create_backup": True,
             "restart_wazuh": True,
-            "verify_ssl": False
+            "verify_ssl": False,
+            "state_file": "/var/ossec/etc/.api_puller_state.json",
+            "package_format": "",  # e.g. "tar.xz"; empty lets the API pick from our Accept list
+            "revision": "",  # pin to a commit, tag or branch (rollback, canaries); empty = latest
+            "watch_timeout": 55,  # seconds each /api/rules/watch long-poll is held
+            "watch_retry": 30,  # seconds to wait after a failed update or watch request
+            "max_retries": 5,  # times a busy (429/503) download is retried within one run
+            "retry_jitter": 10,  # seconds of random delay added to the server's Retry-After
+            "max_retry_after": 900  # longest wait we accept before giving up on this run
         }
         
         config_file = Path(config_path)
@@ -54,6 +117,60 @@ class WazuhAPIPuller:
         
         return default_config
     
+    def load_state(self):
+        """Load what was deployed by the previous run"""
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def save_state(self):
+        """Persist deployment state for the next run"""
+        try:
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.state_file.with_suffix(".tmp")
+            with open(tmp_file, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            print(f"Warning: Failed to save state: {e}")
+    
+    def update_state(self):
+        """Remember the deployed revision and the hashes of deployed files"""
+        if self.package_revision:
+            self.state['revision'] = self.package_revision
+        if self.package_commit:
+            self.state['commit'] = self.package_commit
+        if self.package_etag:
+            self.state['etag'] = self.package_etag
+        self.state['subset'] = self.package_subset
+        self.hash_local_files()
+        self.save_state()
+    
+    def hash_local_files(self):
+        """SHA-256 of deployed rules and decoders.
+        
+        Hashes are cached in the state file with each file's size and mtime,
+        so only files that changed since the last run are read again.
+        """
+        cached = self.state.get('hashes', {})
+        hashes = {}
+        
+        for subdir, directory in (("rules", self.rules_dir), ("decoders", self.decoders_dir)):
+            if not directory.exists():
+                continue
+            for xml_file in directory.glob("*.xml"):
+                rel_path = f"{subdir}/{xml_file.name}"
+                st = xml_file.stat()
+                entry = cached.get(rel_path)
+                if not (entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns):
+                    entry = [st.st_size, st.st_mtime_ns, file_sha256(xml_file)]
+                hashes[rel_path] = entry
+        
+        self.state['hashes'] = hashes
+        return {rel_path: entry[2] for rel_path, entry in hashes.items()}
+    
     def create_backup(self):
         """Create backup of current rules and decoders"""
         if not self.config['create_backup']:
@@ -86,6 +203,40 @@ class WazuhAPIPuller:
             print(f"❌ Backup failed: {e}")
             return False
     
+    def retry_delay(self, response):
+        """Seconds the API asked us to wait (Retry-After), or None"""
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+    
+    def request(self, method, url, **kwargs):
+        """requests.request, waiting out 429/503 answers as long as Retry-After says.
+        
+        The server spreads busy clients over a window; the random jitter on
+        top keeps managers that were told the same second from colliding.
+        """
+        for attempt in range(self.config['max_retries'] + 1):
+            response = requests.request(method, url, **kwargs)
+            if response.status_code not in (429, 503) or attempt == self.config['max_retries']:
+                return response
+            delay = self.retry_delay(response)
+            if delay is None:
+                delay = self.config['watch_retry']
+            if delay > self.config['max_retry_after']:
+                return response
+            delay += random.uniform(0, self.config['retry_jitter'])
+            response.close()
+            print(f"⏳ API busy ({response.status_code}), retrying in {delay:.0f}s")
+            time.sleep(delay)
+    
     def test_connection(self):
         """Test API connection"""
         try:
@@ -108,12 +259,36 @@ class WazuhAPIPuller:
             print(f"❌ API Connection error: {e}")
             return False
     
+    def authenticate(self):
+        """Exchange the API key for a short-lived access token for this run"""
+        try:
+            # Always the API key: the current header may hold an expired token
+            response = requests.post(
+                f"{self.api_url}/api/auth/token",
+                headers=dict(self.headers, Authorization=f"Bearer {self.api_key}"),
+                timeout=10,
+                verify=self.config['verify_ssl']
+            )
+            
+            if response.status_code == 200:
+                token = response.json()['access_token']
+                self.headers["Authorization"] = f"Bearer {token}"
+                return True
+            else:
+                print(f"⚠️  Token exchange failed ({response.status_code}), using API key")
+                return False
+                
+        except Exception as e:
+            print(f"⚠️  Token exchange error: {e}, using API key")
+            return False
+    
     def get_rules_info(self):
         """Get information about available rules"""
         try:
             response = requests.get(
                 f"{self.api_url}/api/rules/list",
                 headers=self.headers,
+                params={"revision": self.config['revision']} if self.config.get('revision') else None,
                 timeout=30,
                 verify=self.config['verify_ssl']
             )
@@ -128,44 +303,282 @@ class WazuhAPIPuller:
             print(f"❌ Rules info error: {e}")
             return None
     
+    def load_partial(self):
+        """ETag of an interrupted package download and the bytes we have of it"""
+        try:
+            with open(self.partial_meta, 'r') as f:
+                etag = json.load(f)['etag']
+            return etag, self.partial_file.stat().st_size
+        except (OSError, ValueError, KeyError):
+            return None, 0
+    
+    def discard_partial(self):
+        for path in (self.partial_file, self.partial_meta):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+    
+    def verify_digest(self, path, response):
+        """Compare a downloaded package with the SHA-256 the API sent (Repr-Digest or Digest)"""
+        expected = None
+        for header in ("Repr-Digest", "Digest"):
+            for item in response.headers.get(header, "").split(","):
+                algorithm, _, value = item.strip().partition("=")
+                if algorithm.lower() == "sha-256" and value:
+                    expected = value.strip(":")
+                    break
+            if expected:
+                break
+        if expected is None:
+            print(f"⚠️  No digest from the API, package not verified")
+            return True
+        
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+        return base64.b64encode(digest.digest()).decode() == expected
+    
     def download_package(self):
-        """Download rules package from API"""
+        """Download rules package from API, resuming an interrupted download"""
         try:
             print(f"Downloading rules package from {self.api_url}...")
             
-            response = requests.get(
-                f"{self.api_url}/api/rules/package",
+            headers = dict(self.headers)
+            if self.state.get('etag'):
+                headers["If-None-Match"] = self.state['etag']
+            elif self.state.get('revision'):
+                headers["If-None-Match"] = f'"{self.state["revision"]}"'
+            
+            params = {}
+            if self.config.get('revision'):
+                params["revision"] = self.config['revision']
+            if self.config.get('package_format'):
+                params["format"] = self.config['package_format']
+            else:
+                headers["Accept"] = ", ".join(f"{media_type};q={q}" for media_type, q in PACKAGE_MEDIA_TYPES)
+            
+            for attempt in range(self.config['max_retries'] + 1):
+                request_headers = dict(headers)
+                partial_etag, offset = self.load_partial()
+                if partial_etag and offset:
+                    # Only the rest, and only if the package is still the one we started
+                    request_headers["Range"] = f"bytes={offset}-"
+                    request_headers["If-Range"] = partial_etag
+                    print(f"↪️  Resuming download at {offset:,} bytes")
+                
+                response = self.request(
+                    "GET",
+                    f"{self.api_url}/api/rules/package",
+                    headers=request_headers,
+                    params=params,
+                    stream=True,
+                    timeout=60,
+                    verify=self.config['verify_ssl']
+                )
+                
+                if response.status_code == 304:
+                    self.discard_partial()
+                    print(f"✅ Rules unchanged since last deployment")
+                    return NOT_MODIFIED
+                elif response.status_code == 416:
+                    self.discard_partial()
+                    continue
+                elif response.status_code not in (200, 206):
+                    print(f"❌ Download failed: {response.status_code}")
+                    return None
+                
+                self.package_revision = response.headers.get("X-Ruleset-Revision")
+                self.package_commit = response.headers.get("X-Ruleset-Commit")
+                self.package_etag = response.headers.get("ETag")
+                self.package_subset = response.headers.get("X-Ruleset-Subset")
+                
+                if response.status_code == 200:
+                    offset = 0
+                    if self.package_etag:
+                        self.partial_file.parent.mkdir(parents=True, exist_ok=True)
+                        with open(self.partial_meta, 'w') as f:
+                            json.dump({"etag": self.package_etag}, f)
+                
+                try:
+                    with open(self.partial_file, 'r+b' if offset else 'wb') as f:
+                        f.seek(offset)
+                        f.truncate()
+                        for chunk in response.iter_content(chunk_size=65536):
+                            f.write(chunk)
+                except (requests.ConnectionError, requests.Timeout,
+                        requests.exceptions.ChunkedEncodingError) as e:
+                    print(f"⚠️  Download interrupted at {self.partial_file.stat().st_size:,} bytes: {e}")
+                    continue
+                
+                if not self.verify_digest(self.partial_file, response):
+                    self.discard_partial()
+                    if offset:
+                        # The resumed bytes did not match the start we had; fetch it all again
+                        print(f"⚠️  Resumed package digest mismatch, downloading again from the start")
+                        continue
+                    print(f"❌ Package digest mismatch, discarded")
+                    return None
+                try:
+                    self.partial_meta.unlink()
+                except FileNotFoundError:
+                    pass
+                
+                file_size = os.path.getsize(self.partial_file)
+                package_format = response.headers.get("X-Package-Format", "zip")
+                print(f"✅ Downloaded: {file_size:,} bytes ({package_format})")
+                return str(self.partial_file)
+            
+            print(f"❌ Download failed after {self.config['max_retries'] + 1} attempts")
+            return None
+                
+        except Exception as e:
+            print(f"❌ Download error: {e}")
+            return None
+    
+    def download_delta(self):
+        """Download only the files changed since the last deployed commit"""
+        since = self.state.get('commit')
+        if not since:
+            return None
+        
+        try:
+            print(f"Downloading changes since {since[:8]} from {self.api_url}...")
+            
+            response = self.request(
+                "GET",
+                f"{self.api_url}/api/rules/delta",
+                params={"since": since},
                 headers=self.headers,
                 stream=True,
                 timeout=60,
                 verify=self.config['verify_ssl']
             )
             
-            if response.status_code == 200:
-                # Save to temporary file
+            # A delta only covers files that changed, not ones the subset gained
+            if response.status_code in (200, 304) and \
+                    response.headers.get("X-Ruleset-Subset") != self.state.get('subset'):
+                print(f"⚠️  Rule subset changed, falling back to full sync")
+                return None
+            
+            if response.status_code == 304:
+                print(f"✅ Rules unchanged since last deployment")
+                return NOT_MODIFIED
+            elif response.status_code == 200:
+                self.package_revision = response.headers.get("X-Ruleset-Revision")
+                self.package_commit = response.headers.get("X-Ruleset-Commit")
+                
                 temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
                 for chunk in response.iter_content(chunk_size=8192):
                     temp_file.write(chunk)
                 temp_file.close()
                 
                 file_size = os.path.getsize(temp_file.name)
-                print(f"✅ Downloaded: {file_size:,} bytes")
+                print(f"✅ Downloaded delta: {file_size:,} bytes")
                 return temp_file.name
             else:
-                print(f"❌ Download failed: {response.status_code}")
+                print(f"⚠️  Delta unavailable ({response.status_code}), falling back to full package")
                 return None
                 
         except Exception as e:
-            print(f"❌ Download error: {e}")
+            print(f"⚠️  Delta error: {e}, falling back to full package")
+            return None
+    
+    def download_manifest_changes(self):
+        """Download only the files whose hashes differ from the local copies"""
+        try:
+            print(f"Comparing local rules with manifest from {self.api_url}...")
+            
+            headers = dict(self.headers)
+            if self.state.get('revision'):
+                subset = f"-s{self.state['subset']}" if self.state.get('subset') else ""
+                headers["If-None-Match"] = f'"{self.state["revision"]}{subset}"'
+            
+            response = self.request(
+                "GET",
+                f"{self.api_url}/api/rules/manifest",
+                headers=headers,
+                timeout=30,
+                verify=self.config['verify_ssl']
+            )
+            
+            if response.status_code == 304:
+                print(f"✅ Rules unchanged since last deployment")
+                return NOT_MODIFIED
+            elif response.status_code != 200:
+                print(f"⚠️  Manifest unavailable ({response.status_code}), falling back to full package")
+                return None
+            
+            manifest = response.json()
+            self.package_revision = manifest.get('revision')
+            self.package_commit = manifest.get('commit')
+            self.package_subset = manifest.get('subset')
+            
+            local = self.hash_local_files()
+            remote = {entry['path']: entry['sha256'] for entry in manifest['files']}
+            changed = sorted(path for path, sha in remote.items() if local.get(path) != sha)
+            deleted = sorted(path for path in local if path not in remote)
+            
+            if not changed and not deleted:
+                print(f"✅ Local rules already match the manifest")
+                return NOT_MODIFIED
+            
+            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
+            # One batched request for every file that differs; made even if
+            # only deletions remain, since it is what records the deployment
+            response = self.request(
+                "POST",
+                f"{self.api_url}/api/rules/files",
+                json={"files": changed},
+                headers=self.headers,
+                stream=True,
+                timeout=60,
+                verify=self.config['verify_ssl']
+            )
+            if response.status_code != 200:
+                temp_file.close()
+                os.unlink(temp_file.name)
+                print(f"⚠️  File download failed ({response.status_code}), falling back to full package")
+                return None
+            for chunk in response.iter_content(chunk_size=8192):
+                temp_file.write(chunk)
+            temp_file.close()
+            
+            with zipfile.ZipFile(temp_file.name, 'a') as zipf:
+                zipf.writestr("delta.json", json.dumps({"changed": changed, "deleted": deleted}))
+            
+            file_size = os.path.getsize(temp_file.name)
+            print(f"✅ Downloaded {len(changed)} changed files: {file_size:,} bytes")
+            return temp_file.name
+            
+        except Exception as e:
+            print(f"⚠️  Manifest sync error: {e}, falling back to full package")
             return None
     
     def extract_package(self, zip_path):
-        """Extract zip package to temporary directory"""
+        """Extract a zip, tar.gz, tar.xz or tar.zst package to a temporary directory"""
         try:
             temp_dir = tempfile.mkdtemp(prefix="wazuh_rules_")
             
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
+            # Detect the format from the content rather than the file name
+            with open(zip_path, 'rb') as f:
+                magic = f.read(6)
+            
+            if magic.startswith(b"PK"):
+                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                    zip_ref.extractall(temp_dir)
+            elif magic.startswith(b"\x28\xb5\x2f\xfd"):
+                if zstandard is None:
+                    raise RuntimeError("zstd package received but the zstandard module is not installed")
+                with open(zip_path, 'rb') as f:
+                    reader = zstandard.ZstdDecompressor().stream_reader(f)
+                    with tarfile.open(fileobj=reader, mode='r|') as tar:
+                        extract_tar(tar, temp_dir)
+            else:
+                # gzip and xz are detected by tarfile itself
+                with tarfile.open(zip_path, 'r:*') as tar:
+                    extract_tar(tar, temp_dir)
             
             print(f"✅ Extracted to: {temp_dir}")
             return temp_dir
@@ -175,48 +588,74 @@ class WazuhAPIPuller:
             return None
     
     def deploy_files(self, extract_dir):
-        """Deploy extracted files to Wazuh directories"""
+        """Deploy extracted files to Wazuh directories.
+        
+        Only files whose content differs from what is deployed are written.
+        Returns the number of files changed, or None on failure.
+        """
         try:
             extract_path = Path(extract_dir)
-            rules_deployed = 0
-            decoders_deployed = 0
             
-            # Deploy rules
-            rules_source = extract_path / "rules"
-            if rules_source.exists():
-                # Clear existing rules
-                for xml_file in self.rules_dir.glob("*.xml"):
-                    xml_file.unlink()
-                
-                # Copy new rules
-                for xml_file in rules_source.glob("*.xml"):
-                    shutil.copy2(xml_file, self.rules_dir / xml_file.name)
-                    rules_deployed += 1
-            
-            # Deploy decoders
-            decoders_source = extract_path / "decoders"
-            if decoders_source.exists():
-                # Clear existing decoders
-                for xml_file in self.decoders_dir.glob("*.xml"):
-                    xml_file.unlink()
-                
-                # Copy new decoders
-                for xml_file in decoders_source.glob("*.xml"):
-                    shutil.copy2(xml_file, self.decoders_dir / xml_file.name)
-                    decoders_deployed += 1
+            delta_file = extract_path / "delta.json"
+            if delta_file.exists():
+                with open(delta_file, 'r') as f:
+                    delta = json.load(f)
+                return self.apply_changes(extract_path, delta.get('changed', []), delta.get('deleted', []))
             
-            # Set proper permissions
-            subprocess.run(["chown", "-R", "root:wazuh", str(self.rules_dir)], check=False)
-            subprocess.run(["chown", "-R", "root:wazuh", str(self.decoders_dir)], check=False)
-            subprocess.run(["chmod", "-R", "640", str(self.rules_dir)], check=False)
-            subprocess.run(["chmod", "-R", "640", str(self.decoders_dir)], check=False)
+            # Full package: diff it against the deployed files
+            local = self.hash_local_files()
+            changed = []
+            packaged = set()
+            for subdir in ("rules", "decoders"):
+                source = extract_path / subdir
+                if not source.exists():
+                    continue
+                packaged.add(subdir)
+                for xml_file in source.glob("*.xml"):
+                    rel_path = f"{subdir}/{xml_file.name}"
+                    if local.get(rel_path) != file_sha256(xml_file):
+                        changed.append(rel_path)
             
-            print(f"✅ Deployed: {rules_deployed} rules, {decoders_deployed} decoders")
-            return rules_deployed + decoders_deployed > 0
+            deleted = [
+                rel_path for rel_path in local
+                if rel_path.split("/", 1)[0] in packaged and not (extract_path / rel_path).exists()
+            ]
+            return self.apply_changes(extract_path, sorted(changed), sorted(deleted))
             
         except Exception as e:
             print(f"❌ Deployment error: {e}")
-            return False
+            return None
+    
+    def set_permissions(self):
+        """Set proper ownership and permissions on deployed files"""
+        subprocess.run(["chown", "-R", "root:wazuh", str(self.rules_dir)], check=False)
+        subprocess.run(["chown", "-R", "root:wazuh", str(self.decoders_dir)], check=False)
+        subprocess.run(["chmod", "-R", "640", str(self.rules_dir)], check=False)
+        subprocess.run(["chmod", "-R", "640", str(self.decoders_dir)], check=False)
+    
+    def apply_changes(self, extract_path, changed, deleted):
+        """Write changed files and remove deleted ones, leaving the rest untouched"""
+        targets = {"rules": self.rules_dir, "decoders": self.decoders_dir}
+        
+        for rel_path in deleted:
+            subdir, name = rel_path.split("/", 1)
+            target = targets[subdir] / name
+            if target.exists():
+                target.unlink()
+        
+        for rel_path in changed:
+            subdir, name = rel_path.split("/", 1)
+            target = targets[subdir] / name
+            # Replace atomically so analysisd never reads a half-written file
+            tmp_target = target.with_name(f".{name}.tmp")
+            shutil.copy2(extract_path / rel_path, tmp_target)
+            os.replace(tmp_target, target)
+        
+        if changed or deleted:
+            self.set_permissions()
+        
+        print(f"✅ Deployed: {len(changed)} changed, {len(deleted)} deleted")
+        return len(changed) + len(deleted)
     
     def restart_wazuh(self):
         """Restart Wazuh manager service"""
@@ -243,6 +682,14 @@ class WazuhAPIPuller:
             print(f"❌ Restart error: {e}")
             return False
     
+    def restart_and_record(self):
+        """Restart Wazuh, remembering a failure so the next run retries the
+        restart even when it has nothing new to deploy"""
+        success = self.restart_wazuh()
+        self.state['restart_pending'] = not success
+        self.save_state()
+        return success
+    
     def report_deployment(self, success, file_count=0, error=""):
         """Report deployment status back to API"""
         try:
@@ -287,6 +734,8 @@ class WazuhAPIPuller:
             self.report_deployment(False, 0, "API connection failed")
             return False
         
+        self.authenticate()
+        
         # Step 2: Get rules info
         rules_info = self.get_rules_info()
         if not rules_info:
@@ -296,16 +745,32 @@ class WazuhAPIPuller:
         print(f"📁 Available: {rules_info.get('counts', {}).get('rules', 0)} rules, "
               f"{rules_info.get('counts', {}).get('decoders', 0)} decoders")
         
-        # Step 3: Create backup
-        if not self.create_backup():
-            print("⚠️  Backup failed, continuing anyway...")
-        
-        # Step 4: Download package
-        zip_path = self.download_package()
+        # Step 3: Download changes, or the full package if no delta is possible
+        # (a pinned revision always comes as a package)
+        zip_path = None
+        if not self.config.get('revision'):
+            zip_path = self.download_delta()
+            if zip_path is None:
+                zip_path = self.download_manifest_changes()
+        if zip_path is None:
+            zip_path = self.download_package()
+        if zip_path is NOT_MODIFIED:
+            if self.state.get('restart_pending'):
+                print("Retrying the restart that failed on the previous run")
+                if not self.restart_and_record():
+                    self.report_deployment(False, 0, "Restart failed")
+                    return False
+            self.update_state()
+            self.report_deployment(True, 0)
+            return True
         if not zip_path:
             self.report_deployment(False, 0, "Download failed")
             return False
         
+        # Step 4: Create backup
+        if not self.create_backup():
+            print("⚠️  Backup failed, continuing anyway...")
+        
         # Step 5: Extract package
         extract_dir = self.extract_package(zip_path)
         if not extract_dir:
@@ -313,14 +778,16 @@ class WazuhAPIPuller:
             return False
         
         # Step 6: Deploy files
-        deployment_success = self.deploy_files(extract_dir)
+        changed_files = self.deploy_files(extract_dir)
         
-        # Step 7: Restart Wazuh if files were deployed
-        if deployment_success:
-            restart_success = self.restart_wazuh()
-            overall_success = deployment_success and restart_success
-        else:
+        # Step 7: Restart Wazuh if files were changed, or if the previous
+        # run deployed files but failed to restart
+        if changed_files is None:
             overall_success = False
+        elif changed_files or self.state.get('restart_pending'):
+            overall_success = self.restart_and_record()
+        else:
+            overall_success = True
         
         # Step 8: Cleanup
         try:
@@ -329,6 +796,9 @@ class WazuhAPIPuller:
         except:
             pass
         
+        if overall_success:
+            self.update_state()
+        
         # Step 9: Report
         elapsed = time.time() - start_time
         self.report_deployment(
@@ -346,6 +816,55 @@ class WazuhAPIPuller:
         
         return overall_success
 
+    def wait_for_revision(self, since):
+        """Block on /api/rules/watch until the API serves a revision other than since.
+        
+        Returns the response body ("changed" false after a timeout), or None
+        on errors.
+        """
+        timeout = self.config['watch_timeout']
+        for attempt in range(2):
+            try:
+                response = requests.get(
+                    f"{self.api_url}/api/rules/watch",
+                    headers=self.headers,
+                    params={"since": since, "timeout": timeout} if since else {"timeout": timeout},
+                    timeout=timeout + 30,
+                    verify=self.config['verify_ssl']
+                )
+            except Exception as e:
+                print(f"❌ Watch error: {e}")
+                return None
+            
+            if response.status_code == 401 and attempt == 0:
+                # The access token expired while we were waiting
+                self.authenticate()
+                continue
+            if response.status_code == 200:
+                return response.json()
+            print(f"❌ Watch failed: {response.status_code}")
+            return None
+    
+    def watch(self):
+        """Deploy, then block until a new revision is published and deploy again"""
+        print(f"👀 Watching {self.api_url} for new rules revisions")
+        self.authenticate()
+        since = self.state.get('revision')
+        while True:
+            result = self.wait_for_revision(since)
+            if result is None:
+                time.sleep(self.config['watch_retry'])
+                continue
+            if not result.get('changed'):
+                continue
+            
+            print(f"🔔 Revision {result['revision']} available")
+            if self.run():
+                # The revision we were told about, even if our package was unchanged
+                since = result['revision']
+            else:
+                time.sleep(self.config['watch_retry'])
+
 def main():
     import argparse
     
@@ -356,6 +875,8 @@ def main():
                        help="Test mode - check connection only")
     parser.add_argument("--dry-run", action="store_true",
                        help="Dry run - don't make changes")
+    parser.add_argument("--watch", action="store_true",
+                       help="Keep running and update whenever the API publishes a new revision")
     
     args = parser.parse_args()
     
@@ -372,6 +893,11 @@ def main():
             return 0
         else:
             return 1
+    elif args.watch:
+        try:
+            puller.watch()
+        except KeyboardInterrupt:
+            return 0
     else:
         success = puller.run()
         return 0 if success else 1